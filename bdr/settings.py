@@ -275,11 +275,27 @@ BDR_REGISTRY_TOKEN = env("BDR_REGISTRY_TOKEN", "")
 
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 1000000
 
+# HTTP client used for both registries
+REGISTRY_POOL_SIZE = env("REGISTRY_POOL_SIZE", 10)
+REGISTRY_CONNECT_TIMEOUT = env("REGISTRY_CONNECT_TIMEOUT", 10)
+REGISTRY_READ_TIMEOUT = env("REGISTRY_READ_TIMEOUT", 500)
+REGISTRY_MAX_RETRIES = env("REGISTRY_MAX_RETRIES", 3)
+REGISTRY_RETRY_BACKOFF = env("REGISTRY_RETRY_BACKOFF", 2)
+# Keep the registry exports on disk to skip syncs when they do not change
+REGISTRY_SNAPSHOT_DIR = env("REGISTRY_SNAPSHOT_DIR", "")
+# Sync BDR and ECR in separate django_q tasks from the fetch endpoint
+FETCH_PARALLEL = env("FETCH_PARALLEL", False)
+# Run the syncs started from the fetch endpoint on the django_q cluster
+ASYNC_FETCH = env("ASYNC_FETCH", True)
+
 ECR_REGISTRY_URL = env("ECR_REGISTRY_URL", "")
 ECR_COMPANY_PATH = env("ECR_COMPANY_PATH", "/undertaking/list")
 ECR_PERSON_PATH = env("ECR_PERSON_PATH", "/misc/user/export/json")
 ECR_REGISTRY_TOKEN = env("ECR_REGISTRY_TOKEN", "")
 ECR_DOMAINS = env("ECR_DOMAINS", "").split(",")
+ECR_FETCH_WORKERS = env("ECR_FETCH_WORKERS", 4)
+ECR_FETCH_QUEUE_SIZE = env("ECR_FETCH_QUEUE_SIZE", 1000)
+ECR_FULL_SYNC_INTERVAL = env("ECR_FULL_SYNC_INTERVAL", 7)  # days
 ECR_ACCEPTED_COMPANIES_STATUS = env("ECR_ACCEPTED_COMPANIES_STATUS", "").split(",")
 
 DOUBLE_CHECK_COMPANIES = ["F-gases EU", "F-gases NONEU", "ODS"]
@@ -312,6 +328,42 @@ Q_CLUSTER = {
     },
 }
 
+# Fetch jobs still running after this many seconds are considered failed
+FETCH_JOB_TIMEOUT = Q_CLUSTER["timeout"]
+
+# Only one sync of a registry runs at a time: the lock is a lease renewed
+# every tenth of FETCH_LOCK_LEASE while the sync runs, and a sync finding it
+# taken waits up to FETCH_LOCK_WAIT seconds before it is skipped
+FETCH_LOCK_LEASE = 600
+FETCH_LOCK_WAIT = 0
+
+# Emails are sent over a pool of connections kept open by each worker: at
+# most EMAIL_POOL_SIZE at a time, each replaced after EMAIL_POOL_MAX_MESSAGES
+# messages and checked before reuse when idle for EMAIL_POOL_CHECK_AFTER
+# seconds
+EMAIL_POOL_SIZE = env("EMAIL_POOL_SIZE", 4)
+EMAIL_POOL_MAX_MESSAGES = env("EMAIL_POOL_MAX_MESSAGES", 100)
+EMAIL_POOL_CHECK_AFTER = 10
+
+# Emails sent to a company group per second, by all the workers together;
+# 0 for no limit. Each group can set its own rate, and the connections each
+# worker uses for it, in the admin
+EMAIL_SEND_RATE = env("EMAIL_SEND_RATE", 0)
+# Tokens a worker takes from the shared bucket at a time
+EMAIL_SEND_BATCH = 10
+
+# Group sends are split in chunks of about this many recipients, sent in
+# parallel by the django_q workers
+SEND_CHUNK_SIZE = 500
+# Recipients rendered, stored and sent at a time by a worker
+SEND_BATCH_SIZE = 50
+# Sends none of whose chunks finished or beat for this many seconds are
+# considered failed, and can be resumed; a sending chunk beats every tenth of it
+SEND_JOB_TIMEOUT = Q_CLUSTER["timeout"]
+
+# Seconds the company groups are cached for by each process
+GROUPS_CACHE_TIMEOUT = 300
+
 SILENCED_SYSTEM_CHECKS = ["ckeditor.W001",] # ignore ckeditor warnings
 
 if not DEBUG:
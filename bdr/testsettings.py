@@ -11,6 +11,9 @@ DATABASES = {
 }
 
 ASYNC_EMAILS = False
+ASYNC_FETCH = False
+# Sent one at a time, in order
+EMAIL_POOL_SIZE = 1
 ALLOW_EDITING_COMPANIES = True
 
 SECRET_KEY = "app_tests_secret_key"
@@ -5,6 +5,7 @@ from django.conf import settings
 from django.contrib import admin
 from simple_history import admin as admin_simple_history
 
+from .forms import expire_send_jobs, resume_send_job
 from .models import (
     Stage,
     CompaniesGroup,
@@ -13,6 +14,11 @@ from .models import (
     Cycle,
     CycleEmailTemplate,
     CycleNotification,
+    RegistrySyncState,
+    FetchJob,
+    SendJob,
+    SyncCheckpoint,
+    SyncLock,
 )
 
 
@@ -22,11 +28,30 @@ class StageAdmin(admin.ModelAdmin):
 
 
 class CompaniesGroupAdmin(admin.ModelAdmin):
-    list_display = ("title", "code", "count_emailtemplates")
+    list_display = (
+        "title",
+        "code",
+        "count_emailtemplates",
+        "send_rate",
+        "send_connections",
+    )
     prepopulated_fields = {"code": ("title",)}
 
 
-class CompanyAdmin(admin.ModelAdmin):
+class RegistryRecordAdmin(admin.ModelAdmin):
+    """Companies and persons come from the registries. Their fingerprint
+    is cleared when they are edited here, so that the next sync writes the
+    registry values back.
+    """
+
+    exclude = ("fingerprint",)
+
+    def save_model(self, request, obj, form, change):
+        obj.fingerprint = ""
+        super(RegistryRecordAdmin, self).save_model(request, obj, form, change)
+
+
+class CompanyAdmin(RegistryRecordAdmin):
     list_display = ("external_id", "name", "vat", "country", "group")
     list_filter = ("group",)
     search_fields = ("id", "external_id", "name", "vat", "country")
@@ -38,7 +63,7 @@ class CompanyAdmin(admin.ModelAdmin):
         return settings.ALLOW_EDITING_COMPANIES
 
 
-class PersonAdmin(admin.ModelAdmin):
+class PersonAdmin(RegistryRecordAdmin):
     list_display = ("username", "name", "email", "admin_company")
     list_filter = ("company__group",)
     search_fields = ("username", "name", "email", "company__name")
@@ -87,6 +112,63 @@ class CycleNotificationAdmin(admin.ModelAdmin):
         return False
 
 
+class RegistrySyncStateAdmin(admin.ModelAdmin):
+    list_display = ("registry", "domain", "last_updated", "last_full_sync", "digest")
+    list_filter = ("registry",)
+
+
+class FetchJobAdmin(admin.ModelAdmin):
+    list_display = ("pk", "status", "created_at", "started_at", "finished_at")
+    list_filter = ("status",)
+    readonly_fields = ("commands", "status", "progress", "started_at", "finished_at")
+
+
+class SendJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "pk",
+        "emailtemplate",
+        "status",
+        "chunks",
+        "chunks_done",
+        "chunks_failed",
+        "sent",
+        "created_at",
+        "finished_at",
+    )
+    list_filter = ("status",)
+    readonly_fields = (
+        "emailtemplate",
+        "status",
+        "chunks",
+        "chunks_done",
+        "chunks_failed",
+        "chunk_states",
+        "retries",
+        "sent",
+        "errors",
+        "started_at",
+        "finished_at",
+    )
+    exclude = ("recipients",)
+    actions = ["resume"]
+
+    @admin.action(description="Send the chunks not done of the failed sends")
+    def resume(self, request, queryset):
+        expire_send_jobs()
+        for job in queryset.filter(status=SendJob.FAILED):
+            resume_send_job(job)
+
+
+class SyncCheckpointAdmin(admin.ModelAdmin):
+    list_display = ("command", "started_at", "updated_at")
+    readonly_fields = ("command", "digest", "done", "started_at", "updated_at")
+
+
+class SyncLockAdmin(admin.ModelAdmin):
+    list_display = ("command", "holder", "acquired_at", "expires_at", "age")
+    readonly_fields = ("command", "holder", "acquired_at", "expires_at")
+
+
 admin.site.register(Stage, StageAdmin)
 admin.site.register(CompaniesGroup, CompaniesGroupAdmin)
 admin.site.register(Company, CompanyAdmin)
@@ -94,3 +176,8 @@ admin.site.register(Person, PersonAdmin)
 admin.site.register(Cycle, CycleAdmin)
 admin.site.register(CycleEmailTemplate, CycleEmailTemplateAdmin)
 admin.site.register(CycleNotification, CycleNotificationAdmin)
+admin.site.register(RegistrySyncState, RegistrySyncStateAdmin)
+admin.site.register(FetchJob, FetchJobAdmin)
+admin.site.register(SendJob, SendJobAdmin)
+admin.site.register(SyncCheckpoint, SyncCheckpointAdmin)
+admin.site.register(SyncLock, SyncLockAdmin)
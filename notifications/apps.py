@@ -6,3 +6,7 @@ from django.apps import AppConfig
 
 class NotificationsConfig(AppConfig):
     name = "notifications"
+
+    def ready(self):
+        # Connects the signals invalidating the cached groups
+        from notifications import groups  # noqa: F401
@@ -0,0 +1,196 @@
+import datetime
+import gzip
+import json
+import os
+import random
+
+from django.conf import settings
+from django.test.utils import override_settings
+
+from notifications import BDR_GROUP_CODES
+from notifications.registries import BDRRegistry, EuropeanCacheRegistry
+
+# Paths the generated exports are saved under; the ECR company path is
+# overridden so that every domain gets its own export.
+ECR_COMPANY_PATH = "/undertaking/[domain]/list"
+
+EU_COUNTRIES = [("RO", "Romania"), ("DK", "Denmark"), ("FR", "France")]
+NONEU_COUNTRIES = [("CN", "China"), ("UA", "Ukraine"), ("US", "United States")]
+
+
+class SyntheticRegistry(object):
+    """Deterministic BDR and ECR exports of any size, for benchmarks.
+
+    Every company has ``users`` users. A ``overlap`` fraction of the users
+    have their email as username, as BDR users do, so that persons are
+    matched across both fields. At every run after the first, a ``churn``
+    fraction of the companies change: they are renamed, get a newer
+    ``date_updated`` and one of their users is replaced.
+    """
+
+    base_date = datetime.datetime(2020, 1, 1)
+
+    def __init__(
+        self,
+        companies=1000,
+        users=3,
+        domains=("FGAS", "ODS"),
+        overlap=0.1,
+        churn=0.05,
+        seed=0,
+    ):
+        self.companies = companies
+        self.users = users
+        self.domains = list(domains)
+        self.overlap = overlap
+        self.churn = churn
+        self.seed = seed
+
+    def params(self):
+        return {
+            "companies": self.companies,
+            "users": self.users,
+            "domains": self.domains,
+            "overlap": self.overlap,
+            "churn": self.churn,
+            "seed": self.seed,
+        }
+
+    def random(self, *key):
+        return random.Random("-".join(map(str, (self.seed,) + key))).random()
+
+    def last_change(self, index, run):
+        """The last run, up to ``run``, that changed the company, or 0."""
+        for change in range(run, 0, -1):
+            if self.random("churn", index, change) < self.churn:
+                return change
+        return 0
+
+    def user(self, index, position, change):
+        if change and position == self.users - 1:
+            user_id = "{}-{}".format(index, change)
+        else:
+            user_id = index * self.users + position
+        email = "user{}@example.com".format(user_id)
+        overlaps = self.random("overlap", user_id) < self.overlap
+        return {
+            "username": email if overlaps else "user{}".format(user_id),
+            "first_name": "First{}".format(user_id),
+            "last_name": "Last{}".format(user_id),
+            "email": email,
+        }
+
+    def company(self, index, run):
+        change = self.last_change(index, run)
+        name = "Company {}".format(index)
+        if change:
+            name += " v{}".format(change)
+        users = [self.user(index, position, change) for position in range(self.users)]
+        return index, name, change, users
+
+    def ecr_companies(self, domain, run=0):
+        for index in range(
+            self.domains.index(domain), self.companies, len(self.domains)
+        ):
+            index, name, change, users = self.company(index, run)
+            if index % 2:
+                code, country_name = EU_COUNTRIES[index % len(EU_COUNTRIES)]
+                country_type = "EU_TYPE"
+            else:
+                code, country_name = NONEU_COUNTRIES[index % len(NONEU_COUNTRIES)]
+                country_type = "NONEU_TYPE"
+            # Distinct dates, so that the unchanged companies are older
+            # than the high-water mark of an incremental sync
+            updated = self.base_date + datetime.timedelta(
+                days=1000 * change, seconds=index
+            )
+            yield {
+                "company_id": index,
+                "name": name,
+                "vat": "VAT{}".format(index),
+                "domain": domain,
+                "status": "VALID",
+                "check_passed": index % 50 != 49,
+                "date_updated": updated.strftime("%Y-%m-%d %H:%M:%S"),
+                "address": {
+                    "country": {
+                        "code": code,
+                        "type": country_type,
+                        "name": country_name,
+                    }
+                },
+                "representative": None,
+                "users": users,
+            }
+
+    def ecr_persons(self, run=0):
+        for index in range(self.companies):
+            yield from self.company(index, run)[3]
+
+    def bdr_companies(self, run=0):
+        for index in range(self.companies):
+            index, name, change, users = self.company(index, run)
+            yield {
+                "userid": "bdr-{}".format(index),
+                "name": name,
+                "vat_number": "VAT{}".format(index),
+                "country_name": NONEU_COUNTRIES[index % len(NONEU_COUNTRIES)][1],
+                "obligation": BDR_GROUP_CODES[index % len(BDR_GROUP_CODES)],
+            }
+
+    def bdr_persons(self, run=0):
+        for index in range(self.companies):
+            index, name, change, users = self.company(index, run)
+            for user in users:
+                yield {
+                    "userid": "bdr-{}".format(index),
+                    "companyname": name,
+                    "country": NONEU_COUNTRIES[index % len(NONEU_COUNTRIES)][1],
+                    "contactname": "{first_name} {last_name}".format(**user),
+                    "contactemail": user["email"],
+                }
+
+    def settings(self, snapshot_dir):
+        """The settings the registries need to replay the exports."""
+        return override_settings(
+            REGISTRY_SNAPSHOT_DIR=snapshot_dir,
+            ECR_DOMAINS=self.domains,
+            ECR_COMPANY_PATH=ECR_COMPANY_PATH,
+        )
+
+    def write_snapshots(self, snapshot_dir, run=0):
+        """Save the exports of ``run`` as registry snapshots and return the
+        number of records written for each registry.
+        """
+        with self.settings(snapshot_dir):
+            bdr = BDRRegistry(offline=True)
+            ecr = EuropeanCacheRegistry(offline=True)
+            exports = [
+                (bdr, settings.BDR_COMPANIES_PATH, self.bdr_companies(run)),
+                (bdr, settings.BDR_PERSONS_PATH, self.bdr_persons(run)),
+                (ecr, settings.ECR_PERSON_PATH, self.ecr_persons(run)),
+            ] + [
+                (ecr, ecr.get_domain_path(domain), self.ecr_companies(domain, run))
+                for domain in self.domains
+            ]
+            counts = {"bdr": 0, "ecr": 0}
+            for registry, path, items in exports:
+                key = "bdr" if registry is bdr else "ecr"
+                counts[key] += write_json_array(registry.get_snapshot_path(path), items)
+            bdr.close()
+            ecr.close()
+        return counts
+
+
+def write_json_array(path, items):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as export:
+        export.write("[")
+        for item in items:
+            if count:
+                export.write(",\n")
+            json.dump(item, export)
+            count += 1
+        export.write("]")
+    return count
@@ -1,9 +1,15 @@
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from django import forms
 from django.conf import settings
-from django.core.mail import get_connection
 from django.core.validators import validate_email
-from django.db import transaction
+from django.db import DatabaseError, IntegrityError, connection, transaction
 from django.forms import ModelChoiceField
+from django.utils import timezone
 from django.utils.html import strip_tags
 
 from django_q.tasks import async_task
@@ -14,7 +20,10 @@ from bdr.settings import (
     INVITATIONS_OTRS_EMAIL_HEADERS,
     CARSVANS_OTRS_EMAIL_HEADERS,
 )
-from notifications import ACCEPTED_PARAMS, BDR_GROUP_CODES
+from notifications import BDR_GROUP_CODES
+from notifications.groups import get_group_by_id
+from notifications.rendering import TemplateRenderer
+from notifications.toolz import chunked
 from notifications.models import Stage
 from .models import (
     Company,
@@ -22,30 +31,12 @@ from .models import (
     CycleEmailTemplate,
     CycleNotification,
     Person,
+    PersonCompany,
+    SendJob,
 )
-from .mail_send import send_mail
-
-
-def set_values_for_parameters(emailtemplate, person, company):
-    params = {}
-    for param, value in ACCEPTED_PARAMS.items():
-        if value:
-            params[param] = eval(value)
-        else:
-            params[param] = value
-    return params
-
-
-def format_body(emailtemplate, person, company):
-    params = set_values_for_parameters(emailtemplate, person, company)
-    email_body = emailtemplate.body_html.format(**params)
-    return email_body
+from .mail_send import Throttle, send_mail
 
-
-def format_subject(emailtemplate, person, company):
-    params = set_values_for_parameters(emailtemplate, person, company)
-    subject = emailtemplate.subject.format(**params)
-    return subject
+logger = logging.getLogger(__name__)
 
 
 def get_email_headers(group):
@@ -55,76 +46,392 @@ def get_email_headers(group):
         return INVITATIONS_OTRS_EMAIL_HEADERS
 
 
-def make_messages(companies, emailtemplate):
+def get_recipients(companies):
+    """The ``(company_id, person_id)`` pairs the ``companies`` are sent to,
+    read once from the current links with a single query, so that they all
+    come from the same set of links and a sync promoting new links during
+    the send changes none of its batches.
+    """
+    return [
+        tuple(pair)
+        for pair in PersonCompany.objects.filter(company__in=companies)
+        .order_by("company_id", "pk")
+        .values_list("company_id", "person_id")
+    ]
+
+
+def make_messages(recipients, emailtemplate, renderer=None):
+    """Render the emails to the ``(company_id, person_id)`` recipients and
+    return them with their notifications, not stored yet.
+    """
+    renderer = renderer or TemplateRenderer(emailtemplate)
+    companies = Company.objects.in_bulk({company_id for company_id, _ in recipients})
+    persons = Person.objects.in_bulk({person_id for _, person_id in recipients})
+
     emails = []
     notifications = []
-    for company in companies:
-        for person in company.active_users:
-            subject = format_subject(emailtemplate, person, company)
-            email_body = format_body(emailtemplate, person, company)
-            recipient_email = [person.email]
-            headers = get_email_headers(company.group)
-            emails.append((subject, recipient_email, email_body, headers))
-
-            # store sent email
-            notifications.append(
-                CycleNotification(
-                    subject=subject,
-                    email=person.email,
-                    body_html=email_body,
-                    emailtemplate=emailtemplate,
-                    person=person,
-                    company=company,
-                )
+    for company_id, person_id in recipients:
+        company = companies.get(company_id)
+        person = persons.get(person_id)
+        if company is None or person is None:
+            # Deleted since the send started
+            continue
+        subject, email_body = renderer.render(person, company)
+        recipient_email = [person.email]
+        headers = get_email_headers(get_group_by_id(company.group_id))
+        emails.append((subject, recipient_email, email_body, headers))
+
+        # stored once sent
+        notifications.append(
+            CycleNotification(
+                subject=subject,
+                email=person.email,
+                body_html=email_body,
+                emailtemplate=emailtemplate,
+                person=person,
+                company=company,
             )
+        )
 
-    CycleNotification.objects.bulk_create(notifications)
-    return emails
+    return emails, notifications
+
+
+def stream_messages(recipients, emailtemplate):
+    """Yield the emails to the ``recipients`` and their notifications
+    SEND_BATCH_SIZE at a time, each batch rendered once the previous one is
+    sent, so that only a batch is held in memory.
+    """
+    renderer = TemplateRenderer(emailtemplate)
+    for batch in chunked(recipients, settings.SEND_BATCH_SIZE):
+        yield make_messages(batch, emailtemplate, renderer)
+
+
+def send_messages(sender, recipients, emailtemplate, bcc=BCC):
+    """Send the template to the ``(company_id, person_id)`` recipients as
+    their emails are rendered and return how many were sent and how many
+    were not. Only the notifications of the emails sent are stored, so that
+    the others are sent again when the send is resumed.
+    """
+    sent = failed = 0
+    group = emailtemplate.group
+    throttle = get_throttle(group)
+    for emails, notifications in stream_messages(recipients, emailtemplate):
+        delivered = []
+        try:
+            results = deliver_each(sender, emails, bcc, group, throttle)
+            for result, notification in zip(results, notifications):
+                if result:
+                    delivered.append(notification)
+        finally:
+            CycleNotification.objects.bulk_create(delivered)
+        sent += len(delivered)
+        failed += len(emails) - len(delivered)
+    return sent, failed
+
+
+def get_throttle(group):
+    """The Throttle pacing the emails to ``group``, None if not limited."""
+    if group is None or not group.get_send_rate():
+        return None
+    return Throttle(group, group.get_send_rate(), settings.EMAIL_SEND_BATCH)
+
+
+def deliver_emails(sender, emails, bcc=BCC, group=None, throttle=None):
+    """Send the ``(subject, recipient, body, headers)`` emails over the
+    connection pool and return how many were sent. The emails to a
+    ``group`` are paced at its send rate, over its number of connections;
+    a ``throttle`` shared by the batches of a send keeps the tokens they
+    took.
+    """
+    return sum(deliver_each(sender, emails, bcc, group, throttle))
+
+
+def deliver_each(sender, emails, bcc=BCC, group=None, throttle=None):
+    """Send the emails as ``deliver_emails`` does and yield, in their order,
+    1 for each email sent and 0 for each refused or failed.
+    """
+
+    def send(email):
+        subject, recipient_email, email_body, headers = email
+        plain_html = strip_tags(email_body)
+        try:
+            return send_mail(
+                subject,
+                plain_html,
+                sender,
+                recipient_email,
+                fail_silently=True,
+                bcc=bcc,
+                html_message=email_body,
+                headers=headers,
+            )
+        except Exception:
+            logger.exception("Could not send %r to %s", subject, recipient_email)
+            return 0
+
+    connections = settings.EMAIL_POOL_SIZE
+    if group is not None:
+        connections = group.get_send_connections()
+    if throttle is None:
+        throttle = get_throttle(group)
+
+    if connections > 1:
+        futures = []
+        error = None
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            try:
+                for email in emails:
+                    if throttle:
+                        throttle.wait()
+                    futures.append(executor.submit(send, email))
+            except Exception as e:
+                # The emails submitted already are sent all the same
+                error = e
+        for future in futures:
+            yield future.result()
+        if error is not None:
+            raise error
+        return
+    for email in emails:
+        if throttle:
+            throttle.wait()
+        yield send(email)
 
 
 def send_emails(sender, emailtemplate, companies=None, is_test=False, data=None):
-    with transaction.atomic():
-        bcc = BCC
-        if companies:
-            sender = EMAIL_SENDER
-            emails = make_messages(companies, emailtemplate)
-        elif is_test:
-            company = Company.objects.filter(name=data.get("company")).first()
-            person = Person.objects.filter(name=data.get("contact")).first()
-            values = set_values_for_parameters(emailtemplate, person, company)
-            email = [data["email"].strip()]
-            body_html = emailtemplate.body_html.format(**values)
-            subject = emailtemplate.subject.format(**values)
-            headers = get_email_headers(company.group)
-            emails = [(subject, email, body_html, headers)]
-            bcc = None
-        else:
-            recipients = Company.objects.filter(group=emailtemplate.group)
-            sender = EMAIL_SENDER
-            emails = make_messages(recipients, emailtemplate)
+    if companies:
+        send_messages(EMAIL_SENDER, get_recipients(companies), emailtemplate)
+    elif is_test:
+        company = Company.objects.filter(name=data.get("company")).first()
+        person = Person.objects.filter(name=data.get("contact")).first()
+        email = [data["email"].strip()]
+        subject, body_html = TemplateRenderer(emailtemplate).render(person, company)
+        headers = get_email_headers(get_group_by_id(company.group_id))
+        deliver_emails(sender, [(subject, email, body_html, headers)], bcc=None)
+    else:
+        companies = Company.objects.filter(group=emailtemplate.group)
+        send_messages(EMAIL_SENDER, get_recipients(companies), emailtemplate)
 
-    connection = get_connection()
-    for subject, recipient_email, email_body, headers in emails:
-        plain_html = strip_tags(email_body)
-        send_mail(
-            subject,
-            plain_html,
-            sender,
-            recipient_email,
-            fail_silently=True,
-            bcc=bcc,
-            html_message=email_body,
-            headers=headers,
-            connection=connection,
-        )
+    if not is_test:
+        emailtemplate.status = emailtemplate.SENT
+        emailtemplate.save()
 
-    connection.close()
 
-    if not is_test:
+# Sends triggered for a group are split in chunks of about SEND_CHUNK_SIZE
+# recipients, read once when the send starts, that the django_q workers send
+# in parallel. A SendJob keeps the recipients and the state of each chunk and
+# marks the template sent after the last one. A send that failed, or whose
+# workers died, is resumed by enqueuing again only the chunks not done.
+
+
+def chunk_recipients(recipients, size):
+    """Lists of about ``size`` of the ``(company_id, person_id)``
+    recipients; the persons of a company are never split between chunks.
+    """
+    chunk = []
+    for company_id, group in itertools.groupby(recipients, key=lambda pair: pair[0]):
+        chunk.extend(group)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def finish_send_job(job):
+    job.status = SendJob.FAILED if job.chunks_failed else SendJob.DONE
+    job.finished_at = timezone.now()
+    if job.status == SendJob.DONE:
+        emailtemplate = job.emailtemplate
         emailtemplate.status = emailtemplate.SENT
         emailtemplate.save()
 
 
+def update_send_job(job_id, chunk, sent=0, error=None):
+    """Mark a chunk of the job as done, or as failed with ``error``, and
+    count the emails it sent; the template is sent once every chunk is done.
+    """
+    with transaction.atomic():
+        job = (
+            SendJob.objects.select_for_update()
+            .select_related("emailtemplate")
+            .defer("recipients")
+            .get(pk=job_id)
+        )
+        job.sent += sent
+        if error is None:
+            job.chunk_states[chunk] = SendJob.CHUNK_DONE
+        else:
+            job.chunk_states[chunk] = SendJob.CHUNK_FAILED
+            job.errors.append(error)
+        job.count_chunks()
+        if job.status == SendJob.QUEUED:
+            job.status = SendJob.RUNNING
+            job.started_at = timezone.now()
+        if job.is_finished:
+            finish_send_job(job)
+        job.save()
+
+
+def get_unnotified(recipients, emailtemplate):
+    """The recipients the template was not sent to yet, by an attempt of
+    the chunk that failed or died midway.
+    """
+    company_ids = {company_id for company_id, _ in recipients}
+    notified = set(
+        CycleNotification.objects.filter(
+            emailtemplate=emailtemplate, company_id__in=company_ids
+        ).values_list("company_id", "person_id")
+    )
+    return [pair for pair in recipients if tuple(pair) not in notified]
+
+
+class SendHeartbeat(threading.Thread):
+    """Touches the send job every ``interval`` seconds while a chunk sends,
+    from its own thread and database connection, so that a chunk paced
+    slower than SEND_JOB_TIMEOUT does not expire the job it is sending.
+    """
+
+    def __init__(self, job_id, interval):
+        super(SendHeartbeat, self).__init__(daemon=True)
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                self.beat()
+        finally:
+            connection.close()
+
+    def beat(self):
+        try:
+            SendJob.objects.filter(pk=self.job_id).update(updated_at=timezone.now())
+        except DatabaseError:
+            # Retried with the next beat, well before the job expires
+            logger.warning("Could not touch send job %s", self.job_id, exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_send_chunk(job_id, chunk, recipients, attempt=0):
+    job = (
+        SendJob.objects.select_related("emailtemplate")
+        .defer("recipients")
+        .get(pk=job_id)
+    )
+    if attempt != job.retries or job.chunk_states[chunk] == SendJob.CHUNK_DONE:
+        # Enqueued again since, or sent already
+        return
+    emailtemplate = job.emailtemplate
+    heartbeat = SendHeartbeat(job_id, settings.SEND_JOB_TIMEOUT / 10)
+    heartbeat.start()
+    try:
+        if attempt:
+            recipients = get_unnotified(recipients, emailtemplate)
+        sent, failed = send_messages(EMAIL_SENDER, recipients, emailtemplate)
+    except Exception as e:
+        logger.exception("Send job %s: chunk %s failed", job_id, chunk)
+        update_send_job(job_id, chunk, error=str(e))
+    else:
+        # The emails not sent are sent again when the job is resumed
+        error = "%s emails not sent" % failed if failed else None
+        update_send_job(job_id, chunk, sent=sent, error=error)
+    finally:
+        heartbeat.stop()
+
+
+def enqueue_send_chunks(job, chunks):
+    for chunk in chunks:
+        args = (job.pk, chunk, job.recipients[chunk], job.retries)
+        if not settings.ASYNC_EMAILS:  # TESTING
+            run_send_chunk(*args)
+        else:
+            async_task(run_send_chunk, *args)
+
+
+def expire_send_jobs():
+    """Fail the jobs none of whose chunks finished or beat for
+    SEND_JOB_TIMEOUT seconds: their workers died, or were stopped by the
+    cluster.
+    """
+    expired = timezone.now() - timedelta(seconds=settings.SEND_JOB_TIMEOUT)
+    SendJob.objects.active().filter(updated_at__lt=expired).update(
+        status=SendJob.FAILED, finished_at=timezone.now()
+    )
+
+
+def resume_send_job(job):
+    """Enqueue again the chunks of a failed job that are not done and return
+    the job; a job that did not fail is returned as it is. The recipients
+    already sent to by the previous attempts are skipped.
+    """
+    with transaction.atomic():
+        job = SendJob.objects.select_for_update().get(pk=job.pk)
+        # The chunks of the jobs started before they were kept are unknown
+        if job.status != SendJob.FAILED or len(job.chunk_states) != job.chunks:
+            return job
+        chunks = [
+            chunk
+            for chunk, state in enumerate(job.chunk_states)
+            if state != SendJob.CHUNK_DONE
+        ]
+        for chunk in chunks:
+            job.chunk_states[chunk] = SendJob.CHUNK_QUEUED
+        job.count_chunks()
+        job.retries += 1
+        job.status = SendJob.QUEUED
+        job.finished_at = None
+        if job.is_finished:
+            finish_send_job(job)
+        job.save()
+
+    logger.info("Send job %s: resuming %s chunks", job.pk, len(chunks))
+    enqueue_send_chunks(job, chunks)
+    job.refresh_from_db()
+    return job
+
+
+def start_send_job(emailtemplate, companies):
+    """Mark the template as processing and enqueue the chunks sending it to
+    the persons of the ``companies``. A template triggered already is not
+    sent again: its send is returned, resumed if it failed.
+    """
+    expire_send_jobs()
+    job = emailtemplate.send_jobs.order_by("-pk").first()
+    if job is not None and emailtemplate.is_triggered:
+        return resume_send_job(job)
+
+    recipients = get_recipients(companies)
+    chunks = list(chunk_recipients(recipients, settings.SEND_CHUNK_SIZE))
+    try:
+        with transaction.atomic():
+            job = SendJob.objects.create(
+                emailtemplate=emailtemplate,
+                chunks=len(chunks),
+                recipients=chunks,
+                chunk_states=[SendJob.CHUNK_QUEUED] * len(chunks),
+            )
+    except IntegrityError:
+        # Started by a concurrent request
+        return (
+            emailtemplate.send_jobs.active().first()
+            or emailtemplate.send_jobs.latest("pk")
+        )
+    emailtemplate.status = emailtemplate.PROCESSING
+    emailtemplate.save()
+    if job.is_finished:
+        finish_send_job(job)
+        job.save()
+
+    enqueue_send_chunks(job, range(len(chunks)))
+    job.refresh_from_db()
+    return job
+
+
 def send_mail_sender(task):
     # TODO implement mail
     print("Done")
@@ -197,19 +504,7 @@ class CycleEmailTemplateTestForm(forms.Form):
 
 class CycleEmailTemplateTriggerForm(forms.Form):
     def send_emails(self, emailtemplate, companies):
-        emailtemplate.status = emailtemplate.PROCESSING
-        emailtemplate.save()
-
-        if not settings.ASYNC_EMAILS:  # TESTING
-            send_emails(EMAIL_SENDER, emailtemplate, companies)
-            emailtemplate.status = emailtemplate.SENT
-            emailtemplate.save()
-        else:
-            async_task(
-                send_emails,
-                *(EMAIL_SENDER, emailtemplate, companies),
-                hook="notifications.forms.send_mail_sender"
-            )
+        return start_send_job(emailtemplate, companies)
 
 
 class ResendEmailForm(forms.Form):
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from memoize import delete_memoized, memoize
+
+from notifications.models import CompaniesGroup
+
+# The company groups hardly ever change, so they are read once and kept in
+# the cache instead of being queried for every company. Saving or deleting
+# a group invalidates them in the process doing it; the other processes
+# pick the change up when the cache times out.
+
+
+@memoize(timeout=settings.GROUPS_CACHE_TIMEOUT)
+def get_groups():
+    """All the company groups, by code."""
+    return {group.code: group for group in CompaniesGroup.objects.order_by("pk")}
+
+
+def get_group(code):
+    """The group with the ``code``; raises CompaniesGroup.DoesNotExist."""
+    try:
+        return get_groups()[code]
+    except KeyError:
+        raise CompaniesGroup.DoesNotExist("No company group {}".format(code))
+
+
+def get_group_by_id(pk):
+    for group in get_groups().values():
+        if group.pk == pk:
+            return group
+    raise CompaniesGroup.DoesNotExist("No company group {}".format(pk))
+
+
+def get_group_ids(codes):
+    """The ids of the existing groups among ``codes``."""
+    groups = get_groups()
+    return [groups[code].pk for code in codes if code in groups]
+
+
+@receiver(post_save, sender=CompaniesGroup)
+@receiver(post_delete, sender=CompaniesGroup)
+def invalidate_groups(**kwargs):
+    delete_memoized(get_groups)
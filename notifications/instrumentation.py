@@ -0,0 +1,139 @@
+import resource
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+
+from django.db import connection
+
+
+class QueryCounter(object):
+    """Counts the queries run on ``connection`` and the time spent in them."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.monotonic() - started
+
+
+def peak_rss():
+    """Peak resident memory of the process so far, in bytes. It includes
+    whatever ran before in the process and never decreases: the memory used
+    by a step is the growth of the peak during it, if any.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def measure(rows=0, trace_memory=False):
+    """Measure the wall time, queries and memory of the block. The yielded
+    dict is filled in when the block exits.
+    """
+    result = {}
+    queries = QueryCounter()
+    if trace_memory:
+        tracemalloc.start()
+    rss_before = peak_rss()
+    started = time.monotonic()
+    try:
+        with connection.execute_wrapper(queries):
+            yield result
+    finally:
+        seconds = time.monotonic() - started
+        rows = result.get("rows", rows)
+        result.update(
+            rows=rows,
+            seconds=round(seconds, 3),
+            rows_per_second=round(rows / seconds, 1) if seconds else None,
+            queries=queries.count,
+            query_seconds=round(queries.seconds, 3),
+            peak_rss=peak_rss(),
+        )
+        result["rss_growth"] = result["peak_rss"] - rss_before
+        if trace_memory:
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+class PhaseRecorder(object):
+    """Splits a run in consecutive phases and records, for each of them,
+    the wall time, the queries and the time spent in them, the growth of
+    the ``counters`` (e.g. rows processed, bytes downloaded), the peak
+    resident memory of the process at its end and its growth during the
+    phase.
+
+    ``counters`` is called at every phase change and returns the current,
+    cumulative, value of each counter.
+    """
+
+    def __init__(self, counters=dict):
+        self.counters = counters
+        self.queries = QueryCounter()
+        self.phases = []
+        self.current = None
+        self.stack = ExitStack()
+        self.started = None
+        self.initial = {}
+
+    def start(self):
+        self.stack.enter_context(connection.execute_wrapper(self.queries))
+        self.started = time.monotonic()
+        self.initial = self.counters()
+
+    def snapshot(self):
+        return dict(
+            self.counters(),
+            started=time.monotonic(),
+            queries=self.queries.count,
+            query_seconds=self.queries.seconds,
+            peak_rss=peak_rss(),
+        )
+
+    def phase(self, name):
+        """End the current phase, if any, and start the ``name`` one."""
+        if self.current and self.current[0] == name:
+            return
+        self.end_phase()
+        self.current = (name, self.snapshot())
+
+    def end_phase(self):
+        if self.current is None:
+            return
+        name, before = self.current
+        after = self.snapshot()
+        record = {
+            "name": name,
+            "seconds": round(after["started"] - before["started"], 3),
+            "queries": after["queries"] - before["queries"],
+            "query_seconds": round(after["query_seconds"] - before["query_seconds"], 3),
+            "peak_rss": after["peak_rss"],
+            "rss_growth": after["peak_rss"] - before["peak_rss"],
+        }
+        for key, value in after.items():
+            if key not in ("started", "queries", "query_seconds", "peak_rss"):
+                record[key] = value - before.get(key, 0)
+        self.phases.append(record)
+        self.current = None
+
+    def stop(self):
+        """End the run and return its record."""
+        self.end_phase()
+        self.stack.close()
+        record = {
+            key: value - self.initial.get(key, 0)
+            for key, value in self.counters().items()
+        }
+        record.update(
+            seconds=round(time.monotonic() - self.started, 3),
+            queries=self.queries.count,
+            query_seconds=round(self.queries.seconds, 3),
+            peak_rss=peak_rss(),
+            phases=self.phases,
+        )
+        return record
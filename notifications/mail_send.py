@@ -1,5 +1,162 @@
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
 from django.core.mail import EmailMultiAlternatives, get_connection
 
+from notifications.models import SendBucket
+
+logger = logging.getLogger(__name__)
+
+# Errors after which a connection is dropped and the message sent again over
+# a new one; anything else is a problem with the message itself.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class PooledConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.sent = 0
+        self.used_at = time.monotonic()
+
+
+class ConnectionPool(object):
+    """Email backend connections kept open between the messages and tasks
+    of a worker. At most ``size`` are open at a time; a connection is
+    replaced after ``max_messages`` messages, and one left idle for more than
+    ``check_after`` seconds is checked before being used again.
+    """
+
+    def __init__(self, size=1, max_messages=100, check_after=10, backend=None):
+        self.size = size
+        self.max_messages = max_messages
+        self.check_after = check_after
+        self.backend = backend
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.pid = os.getpid()
+
+    def open(self):
+        # Errors must reach the pool to reconnect; send() fails silently
+        connection = get_connection(self.backend, fail_silently=False)
+        connection.open()
+        return PooledConnection(connection)
+
+    def close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception:
+            logger.debug("Error closing an email connection", exc_info=True)
+
+    def is_alive(self, pooled):
+        if pooled.sent >= self.max_messages:
+            return False
+        if time.monotonic() - pooled.used_at < self.check_after:
+            return True
+        # Only the SMTP backend has a server to lose
+        smtp = getattr(pooled.connection, "connection", None)
+        if not isinstance(smtp, smtplib.SMTP):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def checkout(self):
+        while True:
+            try:
+                pooled = self.idle.get_nowait()
+            except queue.Empty:
+                return self.open()
+            if self.is_alive(pooled):
+                return pooled
+            self.close(pooled)
+
+    @contextmanager
+    def connection(self):
+        """An open connection, returned to the pool unless it failed."""
+        with self.slots:
+            pooled = self.checkout()
+            try:
+                yield pooled
+            except BaseException:
+                self.close(pooled)
+                raise
+            pooled.used_at = time.monotonic()
+            self.idle.put(pooled)
+
+    def send(self, message, fail_silently=False):
+        """Send the message, over a new connection if the pooled one turns
+        out to be dropped.
+        """
+        try:
+            for attempt in (1, 2):
+                try:
+                    with self.connection() as pooled:
+                        message.connection = pooled.connection
+                        sent = message.send()
+                        pooled.sent += 1
+                        return sent
+                except CONNECTION_ERRORS:
+                    if attempt == 2:
+                        raise
+                    logger.warning("Email connection lost, reconnecting")
+        except Exception:
+            if not fail_silently:
+                raise
+            logger.exception("Sending %r failed", message.subject)
+            return 0
+
+    def close_all(self):
+        while True:
+            try:
+                self.close(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class Throttle(object):
+    """Paces the emails sent to a company group at its send rate, shared
+    with the other workers through the group's SendBucket. The tokens are
+    taken a few at a time, to not query the bucket for every email.
+    """
+
+    def __init__(self, group, rate, batch=10):
+        self.group = group
+        self.rate = rate
+        self.batch = max(min(batch, int(rate)), 1)
+        self.tokens = 0
+
+    def wait(self):
+        """Block until the next email can be sent."""
+        while not self.tokens:
+            self.tokens, delay = SendBucket.take(self.group, self.rate, self.batch)
+            if delay:
+                time.sleep(delay)
+        self.tokens -= 1
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The connection pool of this process, created on first use."""
+    global pool
+    with pool_lock:
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(
+                size=settings.EMAIL_POOL_SIZE,
+                max_messages=settings.EMAIL_POOL_MAX_MESSAGES,
+                check_after=settings.EMAIL_POOL_CHECK_AFTER,
+            )
+        return pool
+
 
 def send_mail(
     subject,
@@ -17,18 +174,15 @@ def send_mail(
 ):
     """
     Override django send_mail function to allow use of custom email headers.
+    Without a ``connection`` or credentials, the mail is sent over the
+    connection pool of the process.
     """
 
-    connection = connection or get_connection(
-        username=auth_user, password=auth_password, fail_silently=fail_silently
-    )
-
     mail = EmailMultiAlternatives(
         subject,
         message,
         from_email,
         recipient_list,
-        connection=connection,
         headers=headers,
         cc=cc,
         bcc=bcc,
@@ -37,4 +191,10 @@ def send_mail(
     if html_message:
         mail.attach_alternative(html_message, "text/html")
 
+    if connection is None and auth_user is None and auth_password is None:
+        return get_pool().send(mail, fail_silently=fail_silently)
+
+    mail.connection = connection or get_connection(
+        username=auth_user, password=auth_password, fail_silently=fail_silently
+    )
     return mail.send()
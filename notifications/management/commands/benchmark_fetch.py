@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from notifications.benchmark import SyntheticRegistry
+from notifications.instrumentation import measure
+from notifications.models import (
+    CompaniesGroup,
+    Company,
+    Person,
+    RegistrySyncState,
+    SyncCheckpoint,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Command(BaseCommand):
+    """Measure the fetch commands against synthetic registry exports. The
+    syncs commit like in production, so that their commits are measured
+    too, and the fetched data is deleted at the end unless --keep is given:
+    without it, the database must not hold any registry data.
+    """
+
+    help = "Benchmark fetch_bdr and fetch_ecr against generated registry exports"
+    commands = {"bdr": "fetch_bdr", "ecr": "fetch_ecr"}
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-c", "--companies", default=1000, type=int, help="Number of companies"
+        )
+        parser.add_argument(
+            "-u", "--users", default=3, type=int, help="Number of users per company"
+        )
+        parser.add_argument(
+            "--domains", default="FGAS,ODS", help="Comma separated ECR domains"
+        )
+        parser.add_argument(
+            "--overlap",
+            default=0.1,
+            type=float,
+            help="Fraction of the users having their email as username",
+        )
+        parser.add_argument(
+            "--churn",
+            default=0.05,
+            type=float,
+            help="Fraction of the companies changed between runs",
+        )
+        parser.add_argument(
+            "--runs",
+            default=2,
+            type=int,
+            help="Number of syncs; the first one loads everything",
+        )
+        parser.add_argument("--seed", default=0, type=int, help="Random seed")
+        parser.add_argument(
+            "--registry",
+            choices=sorted(self.commands),
+            action="append",
+            dest="registries",
+            help="Registry to benchmark, both by default",
+        )
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            default=False,
+            help="Write companies in batches",
+        )
+        parser.add_argument("--batch-size", dest="batch_size", default=1000, type=int)
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            default=False,
+            help="Use incremental ECR syncs after the first run",
+        )
+        parser.add_argument(
+            "--staging",
+            action="store_true",
+            default=False,
+            help="Do the full syncs through staging tables (PostgreSQL only)",
+        )
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            dest="trace_memory",
+            default=False,
+            help="Measure the peak Python memory of each phase (slower)",
+        )
+        parser.add_argument("--label", default="", help="Label stored with the results")
+        parser.add_argument(
+            "--results",
+            default="fetch_benchmarks.jsonl",
+            help="File the results are appended to, one JSON record per line",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            default=False,
+            help="Keep the fetched data instead of deleting it",
+        )
+
+    def handle(self, *args, **options):
+        generator = SyntheticRegistry(
+            companies=options["companies"],
+            users=options["users"],
+            domains=options["domains"].split(","),
+            overlap=options["overlap"],
+            churn=options["churn"],
+            seed=options["seed"],
+        )
+        registries = options["registries"] or sorted(self.commands)
+        record = {
+            "date": timezone.now().isoformat(),
+            "label": options["label"],
+            "params": dict(
+                generator.params(),
+                runs=options["runs"],
+                registries=registries,
+                bulk=options["bulk"],
+                batch_size=options["batch_size"],
+                incremental=options["incremental"],
+                staging=options["staging"],
+            ),
+            "phases": [],
+        }
+
+        if not options["keep"] and self.has_registry_data():
+            raise CommandError(
+                "The database already holds registry data, which the benchmark "
+                "would delete; use an empty database or --keep"
+            )
+        load_groups = not CompaniesGroup.objects.exists()
+        if load_groups:
+            call_command("loaddata", "companiesgroups.json", verbosity=0)
+        try:
+            with tempfile.TemporaryDirectory() as snapshot_dir:
+                for run in range(options["runs"]):
+                    self.run(generator, snapshot_dir, run, registries, record, options)
+        finally:
+            if not options["keep"]:
+                self.cleanup(load_groups)
+
+        previous = self.get_previous(options["results"], record["params"])
+        with open(options["results"], "a") as results:
+            results.write(json.dumps(record) + "\n")
+        return self.format(record, previous)
+
+    def has_registry_data(self):
+        return (
+            Company.objects.really_all().exists()
+            or Person.objects.exists()
+            or RegistrySyncState.objects.exists()
+        )
+
+    def cleanup(self, groups=False):
+        """Delete the data fetched by the benchmark, and the company
+        ``groups`` if it loaded them.
+        """
+        Company.objects.really_all().delete()
+        Person.objects.all().delete()
+        RegistrySyncState.objects.all().delete()
+        SyncCheckpoint.objects.filter(command__in=self.commands.values()).delete()
+        if groups:
+            CompaniesGroup.objects.all().delete()
+
+    def get_previous(self, path, params):
+        """The last stored record of a benchmark with the same parameters."""
+        previous = None
+        if not os.path.exists(path):
+            return previous
+        with open(path) as results:
+            for line in results:
+                record = json.loads(line)
+                if record["params"] == params:
+                    previous = record
+        return previous
+
+    def run(self, generator, snapshot_dir, run, registries, record, options):
+        trace_memory = options["trace_memory"]
+        with measure(trace_memory=trace_memory) as phase:
+            counts = generator.write_snapshots(snapshot_dir, run)
+            phase["rows"] = sum(counts.values())
+        record["phases"].append(dict(phase, name="generate", run=run))
+
+        for name in registries:
+            fetch_options = {
+                "from_snapshot": True,
+                "force": True,
+                "bulk": options["bulk"],
+                "batch_size": options["batch_size"],
+                "staging": options["staging"],
+            }
+            if name == "ecr" and options["incremental"] and run:
+                fetch_options["incremental"] = True
+            with generator.settings(snapshot_dir):
+                with measure(counts[name], trace_memory) as phase:
+                    summary = call_command(
+                        self.commands[name], stdout=StringIO(), **fetch_options
+                    )
+            fetched = json.loads(summary)
+            record["phases"].append(
+                dict(
+                    phase,
+                    name=name,
+                    run=run,
+                    summary=fetched["summary"],
+                    phases=fetched["phases"],
+                )
+            )
+            logger.info("Run %s %s: %s", run, name, fetched["summary"])
+
+    def format(self, record, previous=None):
+        previous_phases = {
+            (phase["run"], phase["name"]): phase
+            for phase in (previous or {}).get("phases", [])
+        }
+        lines = []
+        for phase in record["phases"]:
+            line = (
+                "{run:>3} {name:<8} {rows:>9} rows {seconds:>9.3f}s "
+                "{rows_per_second:>10} rows/s {queries:>8} queries "
+                "({query_seconds:.3f}s) cumulative peak RSS {rss:.1f} MiB "
+                "(+{growth:.1f} MiB)".format(
+                    rss=phase["peak_rss"] / 2**20,
+                    growth=phase["rss_growth"] / 2**20,
+                    **phase
+                )
+            )
+            if "peak_memory" in phase:
+                line += ", traced {:.1f} MiB".format(phase["peak_memory"] / 2**20)
+            before = previous_phases.get((phase["run"], phase["name"]))
+            if before:
+                line += " (previous {:.3f}s, {} queries)".format(
+                    before["seconds"], before["queries"]
+                )
+            lines.append(line)
+            for step in phase.get("phases", []):
+                lines.append(
+                    "      {name:<20} {rows:>9} rows {seconds:>9.3f}s "
+                    "{queries:>8} queries ({query_seconds:.3f}s)".format(**step)
+                )
+        return "\n".join(lines)
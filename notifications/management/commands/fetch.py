@@ -1,17 +1,101 @@
+import itertools
+import json
 import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
 
-from django.db.models import Q
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import DatabaseError, IntegrityError, connection, transaction
 
-from notifications.models import Person, Company
+from notifications.models import (
+    Person,
+    Company,
+    PersonCompany,
+    RegistrySyncState,
+    SyncCheckpoint,
+    SyncLock,
+)
+from notifications.instrumentation import PhaseRecorder
+from notifications.sync import LinkReconciler, PersonIndex, update_fetch_job
+from notifications.toolz import chunked, fingerprint
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+class LockHeartbeat(threading.Thread):
+    """Renews the lock of a sync every ``interval`` seconds, from its own
+    thread and database connection, so that the lease is kept through long
+    downloads, loops and transactions of the sync. The progress of the sync
+    is published to its fetch job at the same time.
+    """
+
+    def __init__(self, command, interval):
+        super(LockHeartbeat, self).__init__(daemon=True)
+        self.command = command
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        try:
+            while not self.lost and not self.stopped.wait(self.interval):
+                self.beat()
+        finally:
+            connection.close()
+
+    def beat(self):
+        command = self.command
+        try:
+            if not SyncLock.renew(
+                command.command_name, command.holder, settings.FETCH_LOCK_LEASE
+            ):
+                logger.error("The lock of %s was taken over", command.command_name)
+                self.lost = True
+                return
+            command.publish()
+        except DatabaseError:
+            # Retried with the next beat, well before the lease expires
+            logger.warning(
+                "Could not renew the lock of %s", command.command_name, exc_info=True
+            )
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 class BaseFetchCommand:
 
     test_registry = None
     registry = None
+    group_codes = ()
+    batch_size = 1000
+    staging_class = None
+
+    def __init__(self, *args, **kwargs):
+        super(BaseFetchCommand, self).__init__(*args, **kwargs)
+        self.stats = Counter()
+        self.job_id = None
+        self.phase = None
+        self.started = time.monotonic()
+        self.client = None
+        self.recorder = PhaseRecorder(self.get_counters)
+        self.companies = None
+        self.checkpoint = None
+        self.dry_run = False
+        self.holder = None
+        self.heartbeat = None
+        # Transactions open when the sync started, e.g. in tests
+        self.atomic_depth = 0
+        # Registry exports used by the sync, when not all of them
+        self.export_paths = None
+        # Primary keys given to the records a dry run would create
+        self.placeholder_pks = itertools.count(-1, -1)
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -21,11 +105,214 @@ class BaseFetchCommand:
             default=False,
             help="Fetch test data",
         )
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            dest="bulk",
+            default=False,
+            help="Write companies in batches instead of row by row",
+        )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            default=self.batch_size,
+            type=int,
+            help="Number of registry records written per batch",
+        )
+        parser.add_argument(
+            "--from-snapshot",
+            action="store_true",
+            dest="from_snapshot",
+            default=False,
+            help="Replay the registry exports saved in REGISTRY_SNAPSHOT_DIR "
+            "instead of downloading them",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            dest="force",
+            default=False,
+            help="Sync even if the registry exports did not change",
+        )
+        parser.add_argument(
+            "--staging",
+            action="store_true",
+            dest="staging",
+            default=False,
+            help="Do full syncs through staging tables (PostgreSQL only)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Only report what a full sync would change, without writing",
+        )
+        parser.add_argument(
+            "--wait",
+            dest="wait",
+            default=settings.FETCH_LOCK_WAIT,
+            type=int,
+            help="Seconds to wait for a running sync of the same registry to "
+            "finish before skipping this one",
+        )
+        parser.add_argument(
+            "--job",
+            dest="job",
+            default=None,
+            type=int,
+            help="Report the progress to this fetch job",
+        )
+
+    def execute(self, *args, **options):
+        self.job_id = options.get("job")
+        return super(BaseFetchCommand, self).execute(*args, **options)
 
     def get_registry(self, options):
+        if options["staging"] and connection.vendor != "postgresql":
+            raise CommandError("--staging requires a PostgreSQL database")
         if options["test"]:  # TESTING
-            return self.test_registry()
-        return self.registry()
+            self.client = self.test_registry()
+            return self.client
+        if options["from_snapshot"] and not settings.REGISTRY_SNAPSHOT_DIR:
+            raise CommandError("--from-snapshot requires REGISTRY_SNAPSHOT_DIR")
+        self.client = self.registry(offline=options["from_snapshot"])
+        if self.dry_run and not options["from_snapshot"]:
+            # Streamed, so that the next sync still sees the changed exports
+            self.client.snapshot_dir = None
+        return self.client
+
+    def get_counters(self):
+        """Rows processed and bytes downloaded so far, for the run record."""
+        links = sum(
+            self.stats[key]
+            for key in (
+                "links_added",
+                "links_activated",
+                "links_deactivated",
+                "links_removed",
+            )
+        )
+        return {
+            "rows": links + (self.client.items if self.client else 0),
+            "bytes": self.client.bytes_received if self.client else 0,
+        }
+
+    @property
+    def command_name(self):
+        return self.__module__.rsplit(".", 1)[-1]
+
+    def report(self, phase=None):
+        """Start a new phase of the run record and report the current
+        phase and counts to the fetch job, if any. Inside a transaction of
+        the sync, they are left to the heartbeat, to not keep the job locked
+        until the transaction ends.
+        """
+        if phase:
+            self.recorder.phase(phase)
+        self.phase = phase or self.phase
+        if self.heartbeat is not None and self.heartbeat.lost:
+            raise CommandError(
+                "The lock of {} expired and was taken over".format(self.command_name)
+            )
+        if len(connection.atomic_blocks) > self.atomic_depth:
+            return
+        self.publish()
+
+    def publish(self):
+        """Report the current phase and counts to the fetch job, if any."""
+        if self.job_id is None:
+            return
+        while True:
+            try:
+                counts = dict(self.stats)
+                break
+            except RuntimeError:
+                # Counted meanwhile, by the sync or the heartbeat
+                continue
+        update_fetch_job(
+            self.job_id,
+            self.command_name,
+            phase=self.phase,
+            counts=counts,
+            seconds=round(time.monotonic() - self.started, 3),
+        )
+
+    # Only one sync of a registry runs at a time, whether started by the
+    # cron, by hand or from the fetch endpoint: the others wait for it, or
+    # are skipped, since it syncs the same exports. The lease of the lock is
+    # renewed by a heartbeat thread while the sync runs.
+
+    def acquire_lock(self, wait):
+        """Take the lock of the registry, waiting up to ``wait`` seconds
+        for the sync holding it. Returns the lock held by the other sync if
+        it could not be taken, None otherwise.
+        """
+        holder = "{}:{}".format(socket.gethostname(), os.getpid())
+        if self.job_id is not None:
+            holder += " job {}".format(self.job_id)
+        deadline = time.monotonic() + wait
+        lease = settings.FETCH_LOCK_LEASE
+        while not SyncLock.acquire(self.command_name, holder, lease):
+            lock = SyncLock.objects.filter(command=self.command_name).first()
+            remaining = deadline - time.monotonic()
+            if lock is not None and remaining <= 0:
+                return lock
+            if lock is not None:
+                logger.info("Waiting for the sync of %s to finish", lock)
+                time.sleep(min(remaining, 5))
+        self.holder = holder
+        self.heartbeat = LockHeartbeat(self, lease / 10)
+        self.heartbeat.start()
+        return None
+
+    def release_lock(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat = None
+        if self.holder is not None:
+            SyncLock.release(self.command_name, self.holder)
+            self.holder = None
+
+    def get_export_paths(self, registry, options):
+        """The registry exports used by the sync, None for all of them."""
+        return None
+
+    def is_unchanged(self, registry, options):
+        """Download the registry exports and check whether any of them
+        changed since the last successful sync.
+        """
+        self.report("downloading")
+        self.export_paths = self.get_export_paths(registry, options)
+        if self.dry_run or options["force"] or registry.refresh(self.export_paths):
+            return False
+        # Downloaded unchanged, but maybe by a sync that failed
+        digest = registry.get_digest(self.export_paths)
+        if not digest or digest != self.get_synced_digest():
+            return False
+        if SyncCheckpoint.objects.filter(command=self.command_name).exists():
+            logger.info("Registry exports unchanged, resuming the interrupted sync")
+            return False
+        logger.info("Registry exports unchanged, nothing to sync")
+        return True
+
+    def get_synced_digest(self):
+        state = RegistrySyncState.objects.filter(
+            registry=self.command_name, domain=""
+        ).first()
+        return state and state.digest
+
+    def save_synced_digest(self):
+        """Remember the exports of the sync that just succeeded, unless some
+        could not be retrieved.
+        """
+        if self.client is None or self.client.errors:
+            return
+        digest = self.client.get_digest(self.export_paths)
+        if digest:
+            RegistrySyncState.objects.update_or_create(
+                registry=self.command_name, domain="", defaults={"digest": digest}
+            )
 
     def cleanup(self, code):
         """Delete all persons and companies existing"""
@@ -33,51 +320,31 @@ class BaseFetchCommand:
         Company.objects.filter(group__code=code).delete()
 
     def create_company(self, **kwargs):
-        """Create or update a company."""
+        """Create or update a company, unless it did not change."""
 
         name = kwargs["name"]
         external_id = kwargs["external_id"]
+        kwargs["fingerprint"] = fingerprint(kwargs)
 
-        company, created = Company.objects.update_or_create(
-            external_id=external_id, defaults=kwargs
-        )
-
-        if created:
+        company = Company.objects.get_or_none(external_id=external_id)
+        if company is None:
+            company = Company.objects.create(**kwargs)
+            self.stats["companies_created"] += 1
             logger.info("Fetched company %s (%s)", name, external_id)
+        elif company.fingerprint == kwargs["fingerprint"]:
+            self.stats["companies_unchanged"] += 1
         else:
+            for field, value in kwargs.items():
+                setattr(company, field, value)
+            company.save()
+            self.stats["companies_updated"] += 1
             logger.info("Updated company %s %s (%s)", company.id, name, external_id)
 
         return company
 
-    def create_person(self, **kwargs):
-        """Create or update a person."""
-        name = kwargs["name"]
-        username = kwargs["username"]
-        email = kwargs["email"]
-
-        # XXX This will not catch duplicates
-        person = Person.objects.filter(
-            Q(email=email)
-            | Q(username=username)
-            | Q(username=email)
-            | Q(email=username)
-        ).first()
-
-        if person:
-            person.email = email
-            person.name = name
-            person.save()
-            created = False
-        else:
-            person, created = Person.objects.update_or_create(
-                username=username, email=email, defaults=kwargs
-            )
-        if created:
-            logger.info("Fetched person %s (%s)", name, username)
-        else:
-            logger.info("Updated person %s %s (%s)", person.id, name, username)
-
-        return person
+    def person_fingerprint(self, data):
+        """Only the email and the name of a matched person are updated."""
+        return fingerprint({"email": data["email"], "name": data["name"]})
 
     def parse_person_data(self, person):
         """Custom way of creating a person"""
@@ -91,31 +358,391 @@ class BaseFetchCommand:
         """Custom way of picking a group"""
         raise NotImplementedError
 
+    def get_companies(self, registry):
+        """The registry companies to be processed."""
+        return registry.get_companies()
+
+    # Checkpoints: the registry records are written in batches, each in its
+    # own transaction together with the checkpoint of the sync. A sync that
+    # is interrupted leaves the checkpoint behind, and the next sync of the
+    # same exports skips the writes of the batches already committed.
+
+    def load_checkpoint(self, registry, options, mode="full"):
+        """Resume the interrupted sync of the same exports, if any, or
+        start a new checkpoint. Resuming needs the exports to be kept as
+        snapshots, to know they did not change.
+        """
+        if self.dry_run:
+            return
+        digest = registry.get_digest(self.export_paths)
+        if digest:
+            key = [digest, mode, options["bulk"], options["batch_size"]]
+            digest = fingerprint({"key": key})
+        checkpoint, created = SyncCheckpoint.objects.get_or_create(
+            command=self.command_name
+        )
+        if digest and checkpoint.digest == digest:
+            logger.info("Resuming the sync after %s", checkpoint.done)
+        else:
+            checkpoint.digest = digest or ""
+            checkpoint.done = {}
+            checkpoint.save()
+        self.checkpoint = checkpoint
+        if checkpoint.done and self.companies is None:
+            # Needed to link the records of the committed batches
+            self.load_companies()
+
+    def finish_checkpoint(self):
+        SyncCheckpoint.objects.filter(command=self.command_name).delete()
+
+    def batches(self, phase, items):
+        """Yield the batches of ``items`` with whether they were committed
+        by the interrupted sync already. The other batches are processed in
+        a transaction, committed with the checkpoint.
+        """
+        for index, batch in enumerate(chunked(items, self.batch_size)):
+            if self.checkpoint is None:
+                yield batch, False
+                continue
+            if self.checkpoint.is_committed(phase, index):
+                self.stats["batches_resumed"] += 1
+                yield batch, True
+                continue
+            with transaction.atomic():
+                yield batch, False
+                self.checkpoint.commit(phase, index)
+
     def fetch_companies(self, registry):
         company_count = 0
-        for item in registry.get_companies():
-            parsed_company_data = self.parse_company_data(item)
-            if parsed_company_data:
-                self.create_company(**parsed_company_data)
+        for batch, committed in self.batches("companies", self.get_companies(registry)):
+            for item in batch:
+                parsed_company_data = self.parse_company_data(item)
+                if not parsed_company_data:
+                    continue
+                if not committed:
+                    self.create_company(**parsed_company_data)
                 company_count += 1
         return company_count
 
     def fetch_persons(self, registry):
         person_count = 0
-        for person in registry.get_persons():
-            self.create_person(**self.parse_person_data(person))
-            person_count += 1
-        return person_count
+        errors = []
+        for batch, committed in self.batches("persons", registry.get_persons()):
+            if committed:
+                person_count += len(batch)
+                continue
+            rows = [self.parse_person_data(item) for item in batch]
+            batch_errors = self.upsert_persons(rows)
+            person_count += len(rows) - len(batch_errors)
+            errors += batch_errors
+            self.report()
+        return person_count, errors
 
-    def handle(self, *args, **options):
-        registry = self.get_registry(options)
-        company_count = self.fetch_companies(registry)
-        person_count, errors = self.fetch_persons(registry)
+    # Persons, and companies in bulk mode, are loaded once in memory, matched
+    # there with the registry data, and written with a few statements per
+    # batch instead of a few queries per row.
+
+    def company_key(self, external_id, group_id):
+        """Key used to match a registry company with an existing one."""
+        return str(external_id)
+
+    def load_companies(self):
+        self.companies = {}
+        companies = Company.objects.really_all().filter(
+            group__code__in=self.group_codes
+        )
+        for company in companies.order_by("pk"):
+            key = self.company_key(company.external_id, company.group_id)
+            self.companies.setdefault(key, company)
+
+    def load_persons(self):
+        self.person_index = PersonIndex.load()
+        self.ambiguous_persons = []
+        self.ambiguous_usernames = set()
+
+    def match_person(self, username, email):
+        """Same matching rules as the registry always had: the email or
+        the username compared with both fields, case insensitively. When
+        several persons match, the oldest one is used and the match is
+        reported.
+        """
+        matches = self.person_index.match(username, email)
+        if len(matches) > 1:
+            if username not in self.ambiguous_usernames:
+                self.ambiguous_usernames.add(username)
+                self.ambiguous_persons.append(
+                    (username, email, [person.pk for person in matches])
+                )
+                self.stats["persons_ambiguous"] += 1
+                logger.warning(
+                    "Person %s (%s) matches several persons: %s",
+                    username,
+                    email,
+                    ", ".join(str(person) for person in matches),
+                )
+        return matches[0] if matches else None
+
+    def load_links(self, partial=False):
+        """The person-company links are collected during the sync and only
+        the differences with the stored ones are written at the end.
+        """
+        self.links = LinkReconciler(
+            PersonCompany.objects.really_all().filter(
+                company__group__code__in=self.group_codes
+            ),
+            batch_size=self.batch_size,
+            partial=partial,
+        )
+
+    def save_links(self):
+        self.report("links")
+        if self.client is not None and self.client.errors:
+            # The links of the companies missed by a failed export are kept
+            logger.warning(
+                "Only reconciling the links of the companies read, some "
+                "exports failed: %s",
+                ", ".join(sorted(self.client.errors)),
+            )
+            self.links.partial = True
+        self.stats.update(self.links.apply(dry_run=self.dry_run))
+
+    def bulk_write(self, objs, fields=None):
+        """Insert (or update ``fields`` of) ``objs`` with a single statement.
+        If the batch is rejected, the rows are retried one by one so that
+        only the offending ones are skipped.
+        """
+        if not objs:
+            return []
+        if self.dry_run:
+            if not fields:
+                for obj in objs:
+                    obj.pk = next(self.placeholder_pks)
+            return []
+        manager = objs[0]._meta.model._base_manager
+
+        def write(batch):
+            with transaction.atomic():
+                if fields:
+                    manager.bulk_update(batch, fields)
+                else:
+                    manager.bulk_create(batch)
 
+        try:
+            write(objs)
+            return []
+        except IntegrityError:
+            if not fields:
+                # Primary keys set before the rollback are not valid anymore
+                for obj in objs:
+                    obj.pk = None
+
+        errors = []
+        for obj in objs:
+            try:
+                write([obj])
+            except IntegrityError as e:
+                logger.info("Skipped %s (%s)", obj, e)
+                errors.append((e, str(obj)))
+        return errors
+
+    def bulk_upsert_companies(self, rows, create=True):
+        """Create or update the companies described by ``rows``. When
+        ``create`` is False only the existing companies are updated.
+        """
+        to_create = []
+        to_update = {}
+        fields = set()
+        for data in rows:
+            group = data.get("group")
+            key = self.company_key(data["external_id"], group and group.pk)
+            data = dict(data, fingerprint=fingerprint(data))
+            company = self.companies.get(key)
+            if company is None:
+                if not create:
+                    continue
+                company = Company(**data)
+                self.companies[key] = company
+                to_create.append(company)
+                continue
+            if company.fingerprint == data["fingerprint"]:
+                if company.pk is not None and company.pk not in to_update:
+                    self.stats["companies_unchanged"] += 1
+                continue
+            for field, value in data.items():
+                setattr(company, field, value)
+            fields.update(data)
+            if company.pk is not None:
+                to_update[company.pk] = company
+
+        create_errors = self.bulk_write(to_create)
+        update_errors = self.bulk_write(list(to_update.values()), sorted(fields))
+        self.stats["companies_created"] += len(to_create) - len(create_errors)
+        self.stats["companies_updated"] += len(to_update) - len(update_errors)
+        return create_errors + update_errors
+
+    def upsert_persons(self, rows):
+        """Create or update the persons described by ``rows``."""
+        to_create = []
+        to_update = {}
+        for data in rows:
+            data = dict(data, fingerprint=self.person_fingerprint(data))
+            person = self.match_person(data["username"], data["email"])
+            if person is None:
+                person = Person(**data)
+                self.person_index.add(person)
+                to_create.append(person)
+                continue
+            if person.fingerprint == data["fingerprint"]:
+                if person.pk is not None and person.pk not in to_update:
+                    self.stats["persons_unchanged"] += 1
+                continue
+            if person.email != data["email"]:
+                self.person_index.set_email(person, data["email"])
+            person.name = data["name"]
+            person.fingerprint = data["fingerprint"]
+            if person.pk is not None:
+                to_update[person.pk] = person
+
+        create_errors = self.bulk_write(to_create)
+        update_errors = self.bulk_write(
+            list(to_update.values()), ["email", "name", "fingerprint"]
+        )
+        self.stats["persons_created"] += len(to_create) - len(create_errors)
+        self.stats["persons_updated"] += len(to_update) - len(update_errors)
+        return create_errors + update_errors
+
+    def fetch_companies_bulk(self, registry):
+        company_count = 0
+        errors = []
+        for batch, committed in self.batches("companies", self.get_companies(registry)):
+            rows = [data for data in map(self.parse_company_data, batch) if data]
+            if committed:
+                company_count += len(rows)
+                continue
+            batch_errors = self.bulk_upsert_companies(rows)
+            company_count += len(rows) - len(batch_errors)
+            errors += batch_errors
+            self.report()
+        return company_count, errors
+
+    def prepare(self, options):
+        self.batch_size = options["batch_size"]
+        self.report("loading")
+        self.load_persons()
+        if options["bulk"]:
+            self.load_companies()
+
+    def sync_staged(self, registry, options):
+        """Full sync of the registry through staging tables, see
+        `notifications.staging`. Returns the company and person counts and
+        the errors.
+        """
+        self.batch_size = options["batch_size"]
+        staging = self.staging_class(self)
+        self.stats.update(staging.run(registry))
+        return staging.company_count, staging.person_count, staging.errors
+
+    def get_summary(self, company_count, person_count, errors):
         if errors:
             msg = "Registry fetched with errors: {}"
             msg = msg.format(errors)
         else:
             msg = "Registry fetched successfully: {} companies, {} persons"
             msg = msg.format(company_count, person_count)
+        if self.dry_run:
+            msg = "Dry run, nothing written. " + msg
+        counts = []
+        for kind in ("companies", "persons"):
+            count = (
+                "{kind}: {created} created, {updated} updated, {unchanged} unchanged"
+            )
+            counts.append(
+                count.format(
+                    kind=kind,
+                    created=self.stats[kind + "_created"],
+                    updated=self.stats[kind + "_updated"],
+                    unchanged=self.stats[kind + "_unchanged"],
+                )
+            )
+        if self.stats["companies_rejected"]:
+            counts[0] += ", {} rejected".format(self.stats["companies_rejected"])
+        counts = "; ".join(counts)
+        if self.stats["persons_ambiguous"]:
+            counts += ", {} ambiguous".format(self.stats["persons_ambiguous"])
+        if self.stats["persons_unmatched"]:
+            counts += ", {} without a matching company".format(
+                self.stats["persons_unmatched"]
+            )
+        if self.stats["batches_resumed"]:
+            counts += "; resumed after {} committed batches".format(
+                self.stats["batches_resumed"]
+            )
+        counts += "; links: {} added, {} activated, {} deactivated".format(
+            self.stats["links_added"],
+            self.stats["links_activated"],
+            self.stats["links_deactivated"],
+        )
+        if self.stats["links_removed"]:
+            counts += ", {} duplicates removed".format(self.stats["links_removed"])
+        return "{} ({})".format(msg, counts)
+
+    def sync(self, options):
+        registry = self.get_registry(options)
+        self.prepare(options)
+        self.load_checkpoint(registry, options)
+        self.report("companies")
+        company_count = self.fetch_companies(registry)
+        self.report("persons")
+        person_count, errors = self.fetch_persons(registry)
+
+        msg = self.get_summary(company_count, person_count, errors)
         logger.info(msg)
+        return msg
+
+    def skip(self, lock):
+        summary = "Skipped: {} is being synced by {} for {} seconds".format(
+            self.command_name, lock.holder, int(lock.age.total_seconds())
+        )
+        logger.info(summary)
+        return json.dumps(
+            {
+                "command": self.command_name,
+                "summary": summary,
+                "skipped": True,
+                "holder": lock.holder,
+                "acquired_at": lock.acquired_at.isoformat(),
+            }
+        )
+
+    def handle(self, *args, **options):
+        """Sync the registry and return the record of the run, as JSON: the
+        summary, the counts, and the time, queries, rows, bytes and memory
+        of the run and of each of its phases.
+        """
+        self.dry_run = options["dry_run"]
+        self.atomic_depth = len(connection.atomic_blocks)
+        if self.dry_run:
+            # A full diff, computed in memory
+            options = dict(options, bulk=True, staging=False, incremental=False)
+        if not self.dry_run:
+            lock = self.acquire_lock(options["wait"])
+            if lock is not None:
+                return self.skip(lock)
+        self.recorder.start()
+        try:
+            summary = self.sync(options)
+            if not self.dry_run:
+                self.finish_checkpoint()
+                self.save_synced_digest()
+        finally:
+            record = self.recorder.stop()
+            self.release_lock()
+        record.update(
+            command=self.command_name,
+            summary=summary,
+            counts=dict(self.stats),
+            dry_run=self.dry_run,
+        )
+        record = json.dumps(record)
+        logger.info("Fetch record: %s", record)
+        return record
@@ -1,8 +1,9 @@
+import json
 import logging
 
 from django.core.management.base import BaseCommand
-from django.core.management import call_command
 from notifications.management.commands.fetch import BaseFetchCommand
+from notifications.sync import fetch_registries
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -12,12 +13,37 @@ class Command(BaseFetchCommand, BaseCommand):
     """Command to fetch companies and persons from both BDR and European Registry"""
 
     help = "Fetch companies from BDR and European Registry"
+    commands = ("fetch_bdr", "fetch_ecr")
 
-    def handle(self, *args, **options):
-        logger.info("Starting fetching companies from BDR registry")
-        call_command("fetch_bdr")
-        logger.info("Finished fetching companies from BDR registry")
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--parallel",
+            action="store_true",
+            dest="parallel",
+            default=False,
+            help="Fetch both registries at the same time, in separate processes",
+        )
 
-        logger.info("Starting fetching companies from ECR registry")
-        call_command("fetch_ecr")
-        logger.info("Finished fetching companies from ECR registry")
+    def handle(self, *args, **options):
+        fetch_options = {
+            option: options[option]
+            for option in (
+                "test",
+                "bulk",
+                "batch_size",
+                "from_snapshot",
+                "force",
+                "staging",
+                "dry_run",
+                "wait",
+            )
+        }
+        logger.info("Starting fetching companies from BDR and ECR registries")
+        results = fetch_registries(
+            self.commands, parallel=options["parallel"], **fetch_options
+        )
+        logger.info("Finished fetching companies from BDR and ECR registries")
+        return json.dumps(
+            {name: json.loads(result) for name, result in results.items()}
+        )
@@ -1,12 +1,16 @@
 import logging
+from collections import defaultdict
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError
 
 from notifications import BDR_GROUP_CODES
 from notifications.management.commands.fetch import BaseFetchCommand
-from notifications.models import CompaniesGroup, Company, PersonCompany
+from notifications.groups import get_group
+from notifications.models import Company
 from notifications.registries import BDRRegistry
+from notifications.staging import BDRStagingSync
+from notifications.sync import normalize
 from notifications.tests.base.registry_mock import BDRRegistryMock
 
 logger = logging.getLogger(__name__)
@@ -19,18 +23,14 @@ class Command(BaseFetchCommand, BaseCommand):
     help = "Fetch companies from BDR registry"
     registry = BDRRegistry
     test_registry = BDRRegistryMock
+    group_codes = BDR_GROUP_CODES
+    staging_class = BDRStagingSync
 
     def __init__(self):
         super(Command, self).__init__()
 
-    def set_all_persons_to_current_false(self):
-        persons_companies = PersonCompany.objects.filter(
-            company__group__code__in=BDR_GROUP_CODES
-        )
-        persons_companies.update(current=False)
-
     def get_group(self, company):
-        return CompaniesGroup.objects.get(code=company["obligation"])
+        return get_group(company["obligation"])
 
     def parse_company_data(self, company):
         if company["obligation"] in BDR_GROUP_CODES:
@@ -53,48 +53,89 @@ class Command(BaseFetchCommand, BaseCommand):
             email=person["contactemail"],
         )
 
-    def set_current_user_true(self, person, companies):
-        for company in companies:
-            try:
-                person_company = PersonCompany.objects.really_all().get(
-                    company=company, person=person
-                )
-                person_company.delete()
-                person_company = PersonCompany.objects.create(
-                    company=company, person=person, current=True
-                )
-            except PersonCompany.DoesNotExist:
-                person_company = PersonCompany.objects.create(
-                    company=company, person=person, current=True
-                )
+    def company_name_key(self, name, country):
+        return normalize(name), normalize(country)
+
+    def load_company_index(self):
+        """The ids of the BDR companies by normalized name and country, read
+        with one query. The companies loaded in memory are indexed as they
+        are now, so that the ones a dry run would create or rename match.
+        """
+        index = defaultdict(list)
+        loaded = {
+            company.pk: company
+            for company in (self.companies or {}).values()
+            if company.pk is not None
+        }
+        companies = Company.objects.really_all().filter(group__code__in=BDR_GROUP_CODES)
+        for pk, name, country in companies.values_list("pk", "name", "country"):
+            if pk not in loaded:
+                index[self.company_name_key(name, country)].append(pk)
+        for pk, company in loaded.items():
+            index[self.company_name_key(company.name, company.country)].append(pk)
+        return index
 
     def fetch_persons(self, registry):
         person_count = 0
         errors = []
-        for item in registry.get_persons():
-            try:
-                person = self.create_person(**self.parse_person_data(item))
-                person_count += 1
-                companies = Company.objects.filter(
-                    name=item["companyname"], country=item["country"]
+        company_index = self.load_company_index()
+        for batch, committed in self.batches("persons", registry.get_persons()):
+            if not committed:
+                batch_errors = self.upsert_persons(
+                    [self.parse_person_data(item) for item in batch]
                 )
-                self.set_current_user_true(person, companies)
-            except IntegrityError as e:
-                logger.info("Skipped person: %s (%s)", item["contactemail"], e)
-                errors.append((e, item["contactemail"]))
+                person_count -= len(batch_errors)
+                errors += batch_errors
+            person_count += len(batch)
+            for item in batch:
+                person = self.match_person(item["contactemail"], item["contactemail"])
+                if person is None or person.pk is None:
+                    continue
+                key = self.company_name_key(item["companyname"], item["country"])
+                if key not in company_index:
+                    self.stats["persons_unmatched"] += 1
+                    logger.info(
+                        "No company %s (%s) for person %s",
+                        item["companyname"],
+                        item["country"],
+                        item["contactemail"],
+                    )
+                    continue
+                for company_id in company_index[key]:
+                    self.links.add(person.pk, company_id)
         return person_count, errors
 
-    def handle(self, *args, **options):
-        self.set_all_persons_to_current_false()
+    def save_links(self):
+        if settings.BDR_PERSONS_PATH in self.client.errors:
+            # The other persons of the companies read may come after the failure
+            self.links.companies.clear()
+        super(Command, self).save_links()
+
+    def sync(self, options):
         registry = self.get_registry(options)
-        company_count = self.fetch_companies(registry)
-        person_count, errors = self.fetch_persons(registry)
+        if self.is_unchanged(registry, options):
+            return "Registry unchanged"
 
-        if errors:
-            msg = "Registry fetched with errors: {}"
-            msg = msg.format(errors)
+        if options["staging"]:
+            company_count, person_count, errors = self.sync_staged(registry, options)
         else:
-            msg = "Registry fetched successfully: {} companies, {} persons"
-            msg = msg.format(company_count, person_count)
+            self.prepare(options)
+            self.load_links()
+            self.load_checkpoint(registry, options)
+            self.report("companies")
+            if options["bulk"]:
+                company_count, errors = self.fetch_companies_bulk(registry)
+            else:
+                company_count, errors = self.fetch_companies(registry), []
+            self.report("persons")
+            person_count, person_errors = self.fetch_persons(registry)
+            errors += person_errors
+            self.save_links()
+
+        registry.close()
+        logger.info("Registry requests: %s", registry.get_metrics())
+        errors += [(error, path) for path, error in registry.errors.items()]
+
+        msg = self.get_summary(company_count, person_count, errors)
         logger.info(msg)
         return msg
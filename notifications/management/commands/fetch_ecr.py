@@ -1,7 +1,10 @@
 import logging
+from datetime import timedelta
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 
 from notifications import (
     FGASES_EU_GROUP_CODE,
@@ -13,8 +16,14 @@ from notifications import (
     AMBIGUOUS_TYPE,
 )
 from notifications.management.commands.fetch import BaseFetchCommand
-from notifications.models import CompaniesGroup, Person, Company, PersonCompany
+from notifications.groups import get_group
+from notifications.models import (
+    Company,
+    RegistrySyncState,
+)
 from notifications.registries import EuropeanCacheRegistry
+from notifications.staging import ECRStagingSync
+from notifications.toolz import fingerprint, parse_registry_date
 from notifications.tests.base.registry_mock import EuropeanCacheRegistryMock
 
 logger = logging.getLogger(__name__)
@@ -27,18 +36,26 @@ class Command(BaseFetchCommand, BaseCommand):
     help = "Fetch companies from European Cache Registry"
     registry = EuropeanCacheRegistry
     test_registry = EuropeanCacheRegistryMock
+    group_codes = ECR_GROUP_CODES
+    sync_registry = "ecr"
+    staging_class = ECRStagingSync
 
     def __init__(self):
         super(Command, self).__init__()
-        self.group_eu = CompaniesGroup.objects.get(code=FGASES_EU_GROUP_CODE)
-        self.group_noneu = CompaniesGroup.objects.get(code=FGASES_NONEU_GROUP_CODE)
-        self.group_ods = CompaniesGroup.objects.get(code=ODS_GROUP_CODE)
+        self.group_eu = get_group(FGASES_EU_GROUP_CODE)
+        self.group_noneu = get_group(FGASES_NONEU_GROUP_CODE)
+        self.group_ods = get_group(ODS_GROUP_CODE)
 
-    def set_all_persons_to_current_false(self):
-        persons_companies = PersonCompany.objects.filter(
-            company__group__code__in=ECR_GROUP_CODES
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            dest="incremental",
+            default=False,
+            help="Only process the companies updated since the last sync. "
+            "A full sync is still done every ECR_FULL_SYNC_INTERVAL days.",
         )
-        persons_companies.update(current=False)
 
     def get_group(self, company):
         if company["domain"] == "ODS":
@@ -86,30 +103,29 @@ class Command(BaseFetchCommand, BaseCommand):
         )
 
     def set_current_user_true(self, company, persons):
+        self.links.touch(company.pk)
         for person in persons:
-            try:
-                person_company = PersonCompany.objects.really_all().get(
-                    company=company, person=person
-                )
-                person_company.delete()
-                person_company = PersonCompany.objects.create(
-                    company=company, person=person, current=True
-                )
-            except PersonCompany.DoesNotExist:
-                person_company = PersonCompany.objects.create(
-                    company=company, person=person, current=True
-                )
+            self.links.add(person.pk, company.pk)
 
     def check_company_is_valid(self, company):
         if company["check_passed"]:
             return True
+        self.stats["companies_rejected"] += 1
         external_id = company["company_id"]
         group = self.get_group(company)
         company_obj = Company.objects.really_all().filter(
             external_id=external_id, group=group
         )
+        for company_id in company_obj.values_list("pk", flat=True):
+            # Its links are not current anymore
+            self.links.touch(company_id)
         if company_obj.first():
-            company_obj.update(**self.parse_company_data(company))
+            data = self.parse_company_data(company)
+            data["fingerprint"] = fingerprint(data)
+            if company_obj.exclude(fingerprint=data["fingerprint"]).update(**data):
+                self.stats["companies_updated"] += 1
+            else:
+                self.stats["companies_unchanged"] += 1
             logger.info(
                 "Company rejected %s (%s)",
                 company_obj.first().name,
@@ -117,55 +133,245 @@ class Command(BaseFetchCommand, BaseCommand):
             )
 
     def create_company(self, **kwargs):
-        """Create or update a company."""
+        """Create or update a company, unless it did not change."""
         name = kwargs["name"]
         external_id = kwargs["external_id"]
-        company = Company.objects.really_all().filter(
+        kwargs["fingerprint"] = fingerprint(kwargs)
+        companies = Company.objects.really_all().filter(
             external_id=external_id, group=kwargs["group"]
         )
-        if company.first():
-
-            company.update(**kwargs)
-            company = company.first()
-            logger.info("Updated company %s %s (%s)", company.id, name, external_id)
-        else:
+        company = companies.first()
+        if company is None:
             company = Company.objects.create(**kwargs)
+            self.stats["companies_created"] += 1
             logger.info("Fetched company %s (%s)", name, external_id)
+        elif company.fingerprint == kwargs["fingerprint"]:
+            self.stats["companies_unchanged"] += 1
+        else:
+            companies.update(**kwargs)
+            company = companies.first()
+            self.stats["companies_updated"] += 1
+            logger.info("Updated company %s %s (%s)", company.id, name, external_id)
 
         return company
 
+    def get_company_persons(self, item):
+        """The persons having the username or the email of a company user
+        as username or email.
+        """
+        unique_list = {user["username"] for user in item["users"]}
+        unique_list.update(user["email"] for user in item["users"])
+        return self.person_index.find(unique_list)
+
+    def link_committed_companies(self, batch):
+        """Link the companies of a batch committed by the interrupted sync
+        to their users, without writing them again.
+        """
+        company_count = 0
+        for item in batch:
+            group = self.get_group(item)
+            key = self.company_key(item["company_id"], group and group.pk)
+            company = self.companies.get(key)
+            if company is None or company.pk is None:
+                continue
+            self.links.touch(company.pk)
+            if item.get("check_passed"):
+                self.set_current_user_true(company, self.get_company_persons(item))
+                company_count += 1
+        return company_count
+
     def fetch_companies(self, registry):
         company_count = 0
         errors = []
-        for item in registry.get_companies():
-            try:
-                if not self.check_company_is_valid(item):
+        for batch, committed in self.batches("companies", self.get_companies(registry)):
+            if committed:
+                company_count += self.link_committed_companies(batch)
+                continue
+            for item in batch:
+                try:
+                    # A savepoint, so that a failed row does not abort the batch
+                    with transaction.atomic():
+                        if not self.check_company_is_valid(item):
+                            continue
+                        company = self.create_company(**self.parse_company_data(item))
+                    self.set_current_user_true(company, self.get_company_persons(item))
+                    company_count += 1
+                except IntegrityError as e:
+                    logger.info("Skipped company: %s (%s)", item["name"], e)
+                    errors.append((e, item["name"]))
+        return company_count, errors
+
+    def company_key(self, external_id, group_id):
+        return (str(external_id), group_id)
+
+    def fetch_companies_bulk(self, registry):
+        company_count = 0
+        errors = []
+        for batch, committed in self.batches("companies", self.get_companies(registry)):
+            if committed:
+                company_count += self.link_committed_companies(batch)
+                continue
+            valid = [item for item in batch if item.get("check_passed")]
+            rejected = [item for item in batch if not item.get("check_passed")]
+            self.stats["companies_rejected"] += len(rejected)
+            # Rejected companies are only updated, never created
+            rejected_rows = [self.parse_company_data(item) for item in rejected]
+            errors += self.bulk_upsert_companies(rejected_rows, create=False)
+            for data in rejected_rows:
+                group = data["group"]
+                key = self.company_key(data["external_id"], group and group.pk)
+                company = self.companies.get(key)
+                if company is not None and company.pk is not None:
+                    self.links.touch(company.pk)
+            rows = [self.parse_company_data(item) for item in valid]
+            batch_errors = self.bulk_upsert_companies(rows)
+            company_count += len(rows) - len(batch_errors)
+            errors += batch_errors
+            for item, data in zip(valid, rows):
+                group = data["group"]
+                key = self.company_key(data["external_id"], group and group.pk)
+                company = self.companies[key]
+                if company.pk is None:
                     continue
-                company = self.create_company(**self.parse_company_data(item))
-                unique_list = {user["username"] for user in item["users"]}
-                unique_list.update(user["email"] for user in item["users"])
-
-                people = set()
-                people.update(set(Person.objects.filter(email__in=unique_list)))
-                people.update(set(Person.objects.filter(username__in=unique_list)))
-                self.set_current_user_true(company, people)
-                company_count += 1
-            except IntegrityError as e:
-                logger.info("Skipped company: %s (%s)", item["name"], e)
-                errors.append((e, item["name"]))
+                self.set_current_user_true(company, self.get_company_persons(item))
         return company_count, errors
 
-    def handle(self, *args, **options):
-        self.set_all_persons_to_current_false()
+    # Incremental sync: the highest `date_updated` seen for each domain is
+    # stored at the end of every sync, and only the companies updated since
+    # are processed by the next incremental one.
+
+    def load_sync_state(self):
+        self.sync_states = {
+            state.domain: state
+            for state in RegistrySyncState.objects.filter(registry=self.sync_registry)
+        }
+        self.high_water_marks = {}
+
+    def get_export_paths(self, registry, options):
+        self.load_sync_state()
+        if options["incremental"] and not self.full_sync_due():
+            # The users come with the companies, the persons export is unused
+            return registry.get_company_paths()
+        return None
+
+    def full_sync_due(self):
+        if not self.sync_states:
+            return True
+        due = timezone.now() - timedelta(days=settings.ECR_FULL_SYNC_INTERVAL)
+        return any(
+            not state.last_full_sync or state.last_full_sync <= due
+            for state in self.sync_states.values()
+        )
+
+    def get_companies(self, registry):
+        for item in registry.get_companies():
+            domain = item.get("domain") or ""
+            updated = parse_registry_date(item.get("date_updated"))
+            mark = self.high_water_marks.get(domain)
+            if updated and (mark is None or updated > mark):
+                mark = updated
+            self.high_water_marks[domain] = mark
+            yield item
+
+    def is_updated(self, item):
+        """Whether the company was updated since the last sync."""
+        state = self.sync_states.get(item.get("domain") or "")
+        updated = parse_registry_date(item.get("date_updated"))
+        if not (state and state.last_updated and updated):
+            return True
+        return updated >= state.last_updated
+
+    def save_sync_state(self, registry, full):
+        now = timezone.now()
+        for domain, mark in self.high_water_marks.items():
+            if domain in registry.errors:
+                continue
+            state = self.sync_states.get(domain) or RegistrySyncState(
+                registry=self.sync_registry, domain=domain
+            )
+            if mark and (not state.last_updated or mark > state.last_updated):
+                state.last_updated = mark
+            if full:
+                state.last_full_sync = now
+            state.save()
+
+    def fetch_updated_companies(self, registry):
+        """Create or update only the companies updated since the last sync,
+        together with their users, and refresh their links.
+        """
+        company_count = 0
+        person_count = 0
+        errors = []
+        updated = filter(self.is_updated, self.get_companies(registry))
+        for batch, committed in self.batches("updated companies", updated):
+            if committed:
+                company_count += self.link_committed_companies(batch)
+                continue
+            for item in batch:
+                try:
+                    users = [self.parse_person_data(user) for user in item["users"]]
+                    user_errors = self.upsert_persons(users)
+                    person_count += len(users) - len(user_errors)
+                    errors += user_errors
+                    # Reconciled even if rejected, so its links are not current anymore
+                    companies = Company.objects.really_all().filter(
+                        external_id=item["company_id"], group=self.get_group(item)
+                    )
+                    for company_id in companies.values_list("pk", flat=True):
+                        self.links.touch(company_id)
+                    with transaction.atomic():
+                        if not self.check_company_is_valid(item):
+                            continue
+                        company = self.create_company(**self.parse_company_data(item))
+                    self.set_current_user_true(company, self.get_company_persons(item))
+                    company_count += 1
+                except IntegrityError as e:
+                    logger.info("Skipped company: %s (%s)", item["name"], e)
+                    errors.append((e, item["name"]))
+        return company_count, person_count, errors
+
+    def sync_rows(self, registry, options, full):
+        if not full:
+            logger.info(
+                "Incremental sync since %s",
+                {domain: str(s.last_updated) for domain, s in self.sync_states.items()},
+            )
+            self.load_links(partial=True)
+            self.load_checkpoint(registry, options, mode="incremental")
+            self.report("updated companies")
+            return self.fetch_updated_companies(registry)
+        self.load_links()
+        self.load_checkpoint(registry, options)
+        self.report("persons")
+        person_count, errors = self.fetch_persons(registry)
+        self.report("companies")
+        if options["bulk"]:
+            company_count, company_errors = self.fetch_companies_bulk(registry)
+        else:
+            company_count, company_errors = self.fetch_companies(registry)
+        return company_count, person_count, errors + company_errors
+
+    def sync(self, options):
         registry = self.get_registry(options)
-        person_count = self.fetch_persons(registry)
-        company_count, errors = self.fetch_companies(registry)
+        if self.is_unchanged(registry, options):
+            return "Registry unchanged"
 
-        if errors:
-            msg = "Registry fetched with errors: {}"
-            msg = msg.format(errors)
+        full = not options["incremental"] or self.full_sync_due()
+        if full and options["staging"]:
+            company_count, person_count, errors = self.sync_staged(registry, options)
         else:
-            msg = "Registry fetched successfully: {} companies, {} persons"
-            msg = msg.format(company_count, person_count)
+            self.prepare(options)
+            company_count, person_count, errors = self.sync_rows(
+                registry, options, full
+            )
+            self.save_links()
+
+        registry.close()
+        logger.info("Registry requests: %s", registry.get_metrics())
+        errors += [(error, domain) for domain, error in registry.errors.items()]
+        if not self.dry_run:
+            self.save_sync_state(registry, full)
+
+        msg = self.get_summary(company_count, person_count, errors)
         logger.info(msg)
         return msg
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.8 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0013_auto_20250407_1037"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RegistrySyncState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("registry", models.CharField(max_length=64)),
+                ("domain", models.CharField(blank=True, default="", max_length=64)),
+                ("last_updated", models.DateTimeField(blank=True, null=True)),
+                ("last_full_sync", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "unique_together": {("registry", "domain")},
+            },
+        ),
+    ]
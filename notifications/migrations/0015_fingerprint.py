@@ -0,0 +1,23 @@
+# Generated by Django 5.1.8 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0014_registrysyncstate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="company",
+            name="fingerprint",
+            field=models.CharField(blank=True, default="", max_length=40),
+        ),
+        migrations.AddField(
+            model_name="person",
+            name="fingerprint",
+            field=models.CharField(blank=True, default="", max_length=40),
+        ),
+    ]
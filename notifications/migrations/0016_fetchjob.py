@@ -0,0 +1,53 @@
+# Generated by Django 5.1.8 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0015_fingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FetchJob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("commands", models.JSONField(default=list)),
+                (
+                    "status",
+                    models.SmallIntegerField(
+                        choices=[
+                            (0, "queued"),
+                            (1, "running"),
+                            (2, "done"),
+                            (3, "failed"),
+                        ],
+                        default=0,
+                    ),
+                ),
+                ("progress", models.JSONField(blank=True, default=dict)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        condition=models.Q(("status__in", (0, 1))),
+                        fields=("status",),
+                        name="single_active_fetch_job",
+                    )
+                ],
+            },
+        ),
+    ]
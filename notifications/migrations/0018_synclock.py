@@ -0,0 +1,31 @@
+# Generated by Django 5.1.8 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0017_synccheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SyncLock",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("command", models.CharField(max_length=64, unique=True)),
+                ("holder", models.CharField(max_length=256)),
+                ("acquired_at", models.DateTimeField()),
+                ("expires_at", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.8 on 2026-10-18 15:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0019_sendjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="companiesgroup",
+            name="send_rate",
+            field=models.FloatField(
+                blank=True,
+                help_text="Emails per second sent to the group by all the workers together; 0 for no limit, empty for the EMAIL_SEND_RATE setting.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="companiesgroup",
+            name="send_connections",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                help_text="Connections each worker sends over; empty for the EMAIL_POOL_SIZE setting.",
+                null=True,
+            ),
+        ),
+        migrations.CreateModel(
+            name="SendBucket",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("tokens", models.FloatField()),
+                ("updated_at", models.DateTimeField()),
+                (
+                    "group",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="send_bucket",
+                        to="notifications.companiesgroup",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0020_sendbucket"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="registrysyncstate",
+            name="digest",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
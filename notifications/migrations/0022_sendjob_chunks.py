@@ -0,0 +1,41 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0021_registrysyncstate_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sendjob",
+            name="chunk_states",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="sendjob",
+            name="recipients",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="sendjob",
+            name="retries",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="sendjob",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddConstraint(
+            model_name="sendjob",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status__in", (0, 1))),
+                fields=("emailtemplate",),
+                name="single_active_send_job",
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.8 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0022_sendjob_chunks"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="fetchjob",
+            name="single_active_fetch_job",
+        ),
+        migrations.AddConstraint(
+            model_name="fetchjob",
+            constraint=models.UniqueConstraint(
+                models.Value(1),
+                condition=models.Q(("status__in", (0, 1))),
+                name="single_active_fetch_job",
+            ),
+        ),
+    ]
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from datetime import timedelta
+
+from django.conf import settings
 from django.utils import timezone
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 from ckeditor.fields import RichTextField
 from django.utils.functional import cached_property
@@ -50,6 +53,18 @@ class CompaniesGroup(models.Model):
 
     title = models.CharField(max_length=256)
     code = models.SlugField(max_length=100, unique=True)
+    send_rate = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Emails per second sent to the group by all the workers "
+        "together; 0 for no limit, empty for the EMAIL_SEND_RATE setting.",
+    )
+    send_connections = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        help_text="Connections each worker sends over; empty for the "
+        "EMAIL_POOL_SIZE setting.",
+    )
 
     def __str__(self):
         return self.title
@@ -62,6 +77,17 @@ class CompaniesGroup(models.Model):
 
     count_emailtemplates.short_description = "#Email templates"
 
+    def get_send_rate(self):
+        if self.send_rate is None:
+            return settings.EMAIL_SEND_RATE
+        return self.send_rate
+
+    def get_send_connections(self):
+        return min(
+            self.send_connections or settings.EMAIL_POOL_SIZE,
+            settings.EMAIL_POOL_SIZE,
+        )
+
 
 class Company(models.Model):
     """Base class for a registry, ECR or BDR, company."""
@@ -85,6 +111,7 @@ class Company(models.Model):
         max_length=256, blank=True, null=True
     )
     check_passed = models.BooleanField(default=None, null=True)
+    fingerprint = models.CharField(max_length=40, blank=True, default="")
 
     objects = GetOrNoneManager()
 
@@ -109,6 +136,7 @@ class Person(models.Model):
     username = models.CharField(max_length=128, db_index=True, unique=True)
     name = models.CharField(max_length=256)
     email = models.CharField(max_length=128, db_index=True)
+    fingerprint = models.CharField(max_length=40, blank=True, default="")
     company = models.ManyToManyField(
         Company, related_name="users", through="PersonCompany"
     )
@@ -152,6 +180,206 @@ class PersonCompany(models.Model):
         db_table = "notifications_person_company"
 
 
+class RegistrySyncState(models.Model):
+    """Progress of the registry syncs, kept per registry and domain so that
+    the next sync only processes the records updated since then, or skips
+    exports already synced.
+    """
+
+    registry = models.CharField(max_length=64)
+    domain = models.CharField(max_length=64, blank=True, default="")
+    last_updated = models.DateTimeField(null=True, blank=True)
+    last_full_sync = models.DateTimeField(null=True, blank=True)
+    # Digest of the exports synced successfully, in the state kept under the
+    # name of the fetch command, without a domain
+    digest = models.CharField(max_length=64, blank=True, default="")
+
+    class Meta:
+        unique_together = ("registry", "domain")
+
+    def __str__(self):
+        return "{} {}".format(self.registry, self.domain).strip()
+
+
+class SyncCheckpoint(models.Model):
+    """Batches committed by a registry sync that did not finish yet, by
+    phase, so that the next sync of the same exports resumes after them.
+    """
+
+    command = models.CharField(max_length=64, unique=True)
+    # Identifies the exports and the options of the sync
+    digest = models.CharField(max_length=64, blank=True, default="")
+    done = models.JSONField(default=dict, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.command
+
+    def is_committed(self, phase, batch):
+        return batch <= self.done.get(phase, -1)
+
+    def commit(self, phase, batch):
+        self.done[phase] = batch
+        self.save(update_fields=["done", "updated_at"])
+
+
+class SyncLock(models.Model):
+    """Lease taken by a registry sync, so that only one sync of a registry
+    runs at a time. The lease is renewed while the sync runs, and a sync
+    that died leaves it to expire.
+    """
+
+    command = models.CharField(max_length=64, unique=True)
+    # Host, process and fetch job of the sync holding the lease
+    holder = models.CharField(max_length=256)
+    acquired_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return "{} ({})".format(self.command, self.holder)
+
+    @property
+    def age(self):
+        return timezone.now() - self.acquired_at
+
+    @classmethod
+    def acquire(cls, command, holder, lease):
+        """Take the lease of ``command`` for ``lease`` seconds, unless a
+        lease not expired yet is held. Returns whether it was taken.
+        """
+        now = timezone.now()
+        values = dict(
+            holder=holder,
+            acquired_at=now,
+            expires_at=now + timedelta(seconds=lease),
+        )
+        expired = cls.objects.filter(command=command, expires_at__lte=now)
+        if expired.update(**values):
+            return True
+        try:
+            with transaction.atomic():
+                cls.objects.create(command=command, **values)
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def renew(cls, command, holder, lease):
+        """Extend the lease; returns False if it is not held anymore."""
+        expires_at = timezone.now() + timedelta(seconds=lease)
+        held = cls.objects.filter(command=command, holder=holder)
+        return bool(held.update(expires_at=expires_at))
+
+    @classmethod
+    def release(cls, command, holder):
+        cls.objects.filter(command=command, holder=holder).delete()
+
+
+class SendBucket(models.Model):
+    """Token bucket pacing the emails sent to a company group, shared by
+    the workers sending them. It holds at most a second worth of tokens.
+    """
+
+    group = models.OneToOneField(
+        CompaniesGroup, on_delete=models.CASCADE, related_name="send_bucket"
+    )
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return "{} ({:.1f} tokens)".format(self.group, self.tokens)
+
+    @classmethod
+    def take(cls, group, rate, tokens):
+        """Take up to ``tokens`` tokens from the bucket refilled at ``rate``
+        tokens per second. Returns how many were taken and, when none were,
+        the seconds until the next one.
+        """
+        now = timezone.now()
+        capacity = max(rate, 1)
+        with transaction.atomic():
+            bucket, _ = cls.objects.select_for_update().get_or_create(
+                group=group, defaults={"tokens": capacity, "updated_at": now}
+            )
+            elapsed = max((now - bucket.updated_at).total_seconds(), 0)
+            bucket.tokens = min(bucket.tokens + elapsed * rate, capacity)
+            bucket.updated_at = now
+            taken = min(int(bucket.tokens), tokens)
+            bucket.tokens -= taken
+            bucket.save()
+        if taken:
+            return taken, 0
+        return 0, (1 - bucket.tokens) / rate
+
+
+class FetchJobQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(status__in=(FetchJob.QUEUED, FetchJob.RUNNING))
+
+
+class FetchJob(models.Model):
+    """A sync of the registries started from the fetch endpoint. Each fetch
+    command reports its phase, counts and result in ``progress``.
+    """
+
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+    STATUS = (
+        (QUEUED, "queued"),
+        (RUNNING, "running"),
+        (DONE, "done"),
+        (FAILED, "failed"),
+    )
+
+    commands = models.JSONField(default=list)
+    status = models.SmallIntegerField(choices=STATUS, default=QUEUED)
+    progress = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    objects = FetchJobQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # A single sync is queued or running at a time: the active jobs
+            # all share the same constant value
+            models.UniqueConstraint(
+                models.Value(1),
+                condition=models.Q(status__in=(0, 1)),
+                name="single_active_fetch_job",
+            )
+        ]
+
+    def __str__(self):
+        return "Fetch {} ({})".format(self.pk, self.get_status_display())
+
+    @property
+    def is_finished(self):
+        return all(
+            "result" in self.progress.get(command, {})
+            or "error" in self.progress.get(command, {})
+            for command in self.commands
+        )
+
+    def as_dict(self):
+        end = self.finished_at or timezone.now()
+        return {
+            "id": self.pk,
+            "status": self.get_status_display(),
+            "progress": self.progress,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at and self.started_at.isoformat(),
+            "finished_at": self.finished_at and self.finished_at.isoformat(),
+            "seconds": self.started_at
+            and round((end - self.started_at).total_seconds(), 3),
+        }
+
+
 class Cycle(models.Model):
     """Base class for a reporting cycle - this happens once per year."""
 
@@ -234,6 +462,80 @@ class CycleEmailTemplate(models.Model):
         return self.status in (self.PROCESSING, self.SENT)
 
 
+class SendJobQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(status__in=(SendJob.QUEUED, SendJob.RUNNING))
+
+
+class SendJob(models.Model):
+    """A send of an email template, fanned out to the django_q cluster in
+    chunks of recipients. The template is sent once every chunk is done; the
+    chunks that failed, or whose workers died, can be enqueued again.
+    """
+
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+    STATUS = (
+        (QUEUED, "queued"),
+        (RUNNING, "running"),
+        (DONE, "done"),
+        (FAILED, "failed"),
+    )
+
+    # States of the chunks
+    CHUNK_QUEUED = "queued"
+    CHUNK_DONE = "done"
+    CHUNK_FAILED = "failed"
+
+    emailtemplate = models.ForeignKey(
+        CycleEmailTemplate, on_delete=models.CASCADE, related_name="send_jobs"
+    )
+    status = models.SmallIntegerField(choices=STATUS, default=QUEUED)
+    chunks = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    chunks_failed = models.PositiveIntegerField(default=0)
+    # The (company id, person id) pairs of each chunk, read when the send
+    # started, and the state of each chunk
+    recipients = models.JSONField(default=list, blank=True)
+    chunk_states = models.JSONField(default=list, blank=True)
+    # Times the chunks not done were enqueued again
+    retries = models.PositiveSmallIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    objects = SendJobQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # A single send of a template is queued or running at a time
+            models.UniqueConstraint(
+                fields=["emailtemplate"],
+                condition=models.Q(status__in=(0, 1)),
+                name="single_active_send_job",
+            )
+        ]
+
+    def __str__(self):
+        return "Send {} of {} ({})".format(
+            self.pk, self.emailtemplate_id, self.get_status_display()
+        )
+
+    @property
+    def is_finished(self):
+        return self.CHUNK_QUEUED not in self.chunk_states
+
+    def count_chunks(self):
+        self.chunks_done = self.chunk_states.count(self.CHUNK_DONE)
+        self.chunks_failed = self.chunk_states.count(self.CHUNK_FAILED)
+
+
 class CycleNotification(models.Model):
     """Base class for each sent email."""
 
@@ -1,5 +1,18 @@
+import codecs
+import gzip
+import hashlib
+import json
 import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from django.conf import settings
 
@@ -7,16 +20,124 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+JSON_WHITESPACE = " \t\n\r"
+
+
+DOMAIN_DONE = object()
+SUCCESS_CODES = (requests.codes.ok, requests.codes.not_modified)
+
+
+class RegistryError(Exception):
+    """A registry export could not be retrieved."""
+
+
+# Errors of an export that could not be retrieved or read whole: the request
+# failed, the stream broke, or the body or its snapshot is truncated
+EXPORT_ERRORS = (
+    RegistryError,
+    requests.RequestException,
+    OSError,
+    EOFError,
+    ValueError,
+)
+
+
+def is_number(item):
+    return isinstance(item, (int, float)) and not isinstance(item, bool)
+
+
+def iter_json_array(chunks):
+    """Incrementally parse a JSON array received as a sequence of byte
+    chunks and yield its items one at a time, so that only the item being
+    parsed is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+    exhausted = False
+
+    def read():
+        nonlocal buffer, pos, exhausted
+        for chunk in chunks:
+            if chunk:
+                buffer = buffer[pos:] + utf8.decode(chunk)
+                pos = 0
+                return True
+        buffer = buffer[pos:] + utf8.decode(b"", final=True)
+        pos = 0
+        exhausted = True
+        return False
+
+    def next_char(skip=JSON_WHITESPACE):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in skip:
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if exhausted or not read():
+                return ""
+
+    if next_char() != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    if next_char() == "]":
+        return
+    while True:
+        next_char()
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if exhausted:
+                raise
+            read()
+            continue
+        if is_number(item) and not exhausted:
+            # A number may continue in the next chunk, e.g. after "0." or
+            # "1e": it is only complete once followed by a delimiter
+            rest = buffer[end:].lstrip(JSON_WHITESPACE)
+            if not rest or rest[0] not in ",]":
+                read()
+                continue
+        pos = end
+        yield item
+        char = next_char()
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError("Expected ',' or ']' in JSON array")
+        pos += 1
+
 
 class BaseRegistry(object):
     """Base class for both registries."""
 
-    def __init__(self, name, entrypoint, auth=None, token=None, timeout=500):
+    chunk_size = 64 * 1024
+    workers = 1
+
+    def __init__(
+        self, name, entrypoint, auth=None, token=None, timeout=None, offline=False
+    ):
         self.name = name
         self.entrypoint = entrypoint
         self.auth = auth
         self.token = token
-        self.timeout = timeout
+        self.timeout = timeout or (
+            settings.REGISTRY_CONNECT_TIMEOUT,
+            settings.REGISTRY_READ_TIMEOUT,
+        )
+        self.session = self.get_session()
+        self.metrics = []
+        self.errors = {}
+        self.snapshot_dir = settings.REGISTRY_SNAPSHOT_DIR
+        self.offline = offline
+        self.downloads = {}
+        # Items parsed from the exports and bytes received from the registry
+        self.items = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
 
     def __str__(self):
         return "{} @ {}".format(self.name, self.entrypoint)
@@ -28,6 +149,76 @@ class BaseRegistry(object):
     def get_url(self, path):
         return "{}{}".format(self.entrypoint, path)
 
+    def get_session(self):
+        """A session reusing keep-alive connections to the registry. Only
+        idempotent requests are retried, with an exponential backoff.
+        """
+        retry = Retry(
+            total=settings.REGISTRY_MAX_RETRIES,
+            backoff_factor=settings.REGISTRY_RETRY_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET", "HEAD"),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=settings.REGISTRY_POOL_SIZE,
+            pool_maxsize=settings.REGISTRY_POOL_SIZE,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def record_request(self, method, url, started, response=None, error=None):
+        """Keep the latency and the number of retries of each request."""
+        retries = 0
+        if response is not None and response.raw is not None:
+            history = getattr(response.raw.retries, "history", None) or ()
+            retries = len(history)
+        metric = {
+            "method": method.upper(),
+            "url": url,
+            "status": response.status_code if response is not None else None,
+            "elapsed": round(time.monotonic() - started, 3),
+            "retries": retries,
+            "error": str(error) if error else None,
+        }
+        self.metrics.append(metric)
+        logger.info(
+            "%(method)s %(url)s: %(status)s in %(elapsed)ss (%(retries)s retries)",
+            metric,
+        )
+        return metric
+
+    def get_metrics(self):
+        """Summary of the requests made so far, for monitoring."""
+        return {
+            "requests": len(self.metrics),
+            "retries": sum(metric["retries"] for metric in self.metrics),
+            "errors": sum(
+                1
+                for metric in self.metrics
+                if metric["error"] or metric["status"] not in SUCCESS_CODES
+            ),
+            "elapsed": round(sum(metric["elapsed"] for metric in self.metrics), 3),
+            "bytes": self.bytes_received,
+        }
+
+    def count_bytes(self, chunks):
+        """Yield the ``chunks`` of a response body, counting their size."""
+        received = 0
+        try:
+            for chunk in chunks:
+                received += len(chunk)
+                yield chunk
+        finally:
+            with self.lock:
+                self.bytes_received += received
+
+    def close(self):
+        self.session.close()
+
     def do_request(
         self,
         path,
@@ -37,6 +228,7 @@ class BaseRegistry(object):
         headers=None,
         cookies=None,
         auth=None,
+        stream=False,
     ):
         """Handler for a generic API call:
         - method  -- get/post
@@ -47,14 +239,16 @@ class BaseRegistry(object):
         - headers -- dictionary of HTTP Headers to send with the Request
         - cookies -- dictionary or CookieJar object to send with the Request
         - auth    -- auth tuple to enable Basic/Digest/Custom HTTP Auth
+        - stream  -- do not download the body until it is consumed
         """
-        request = requests.get
+        request = self.session.get
         if method == "post":
-            request = requests.post
+            request = self.session.post
 
         url = self.get_url(path)
         response = None
 
+        started = time.monotonic()
         try:
             response = request(
                 url,
@@ -65,26 +259,187 @@ class BaseRegistry(object):
                 auth=auth,
                 timeout=self.timeout,
                 verify=True,
+                stream=stream,
             )
         except Exception as e:
+            self.record_request(method, url, started, error=e)
             logger.warning("Error contacting {} ({})".format(self.name, e))
         else:
-            if response.status_code != requests.codes.ok:
+            self.record_request(method, url, started, response=response)
+            if response.status_code not in SUCCESS_CODES:
                 logger.warning(
                     "Retrieved a {} status code when contacting"
                     " {}'s url: {} ".format(response.status_code, self.name, url)
                 )
         return response
 
+    def get_export_paths(self):
+        """The paths of all the exports used by a sync."""
+        raise NotImplementedError
+
+    def iter_export(self, path):
+        """Yield the items of the JSON array exported at ``path``, parsed as
+        they are received. Raises RegistryError if the export cannot be
+        retrieved.
+        """
+        if self.snapshot_dir:
+            if not self.offline:
+                self.update_snapshot(path)
+            yield from self.read_snapshot(path)
+            return
+
+        response = self.do_request(path, stream=True)
+        if not response:
+            raise RegistryError(
+                "no response"
+                if response is None
+                else "status {}".format(response.status_code)
+            )
+        try:
+            yield from iter_json_array(
+                self.count_bytes(response.iter_content(chunk_size=self.chunk_size))
+            )
+        finally:
+            response.close()
+
+    def iter_objects(self, path):
+        """Same as `iter_export`, but an export that cannot be retrieved
+        or read whole is recorded in ``errors`` and yields nothing more.
+        """
+        try:
+            for item in self.iter_export(path):
+                self.items += 1
+                yield item
+        except EXPORT_ERRORS as e:
+            self.errors[path] = str(e)
+            logger.error("Error fetching {} ({})".format(self.get_url(path), e))
+
+    # Snapshots: every export is kept on disk, compressed, with the
+    # validators sent by the registry, so that an export that did not change
+    # is not downloaded again, and a sync can be replayed offline.
+
+    def get_snapshot_path(self, path):
+        name = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "index"
+        return os.path.join(self.snapshot_dir, self.name, name + ".json.gz")
+
+    def get_snapshot_meta(self, path):
+        try:
+            with open(self.get_snapshot_path(path) + ".meta") as meta:
+                return json.load(meta)
+        except (OSError, ValueError):
+            return {}
+
+    def read_snapshot(self, path):
+        snapshot = self.get_snapshot_path(path)
+        if not os.path.exists(snapshot):
+            raise RegistryError("no snapshot in {}".format(snapshot))
+        with gzip.open(snapshot, "rb") as body:
+            yield from iter_json_array(iter(lambda: body.read(self.chunk_size), b""))
+
+    def download(self, path):
+        """Save the export at ``path`` as a snapshot, using a conditional
+        request. Returns whether its content changed since the previous
+        snapshot.
+        """
+        snapshot = self.get_snapshot_path(path)
+        meta = self.get_snapshot_meta(path) if os.path.exists(snapshot) else {}
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = self.do_request(path, headers=headers, stream=True)
+        if not response:
+            raise RegistryError(
+                "no response"
+                if response is None
+                else "status {}".format(response.status_code)
+            )
+        try:
+            if response.status_code == requests.codes.not_modified:
+                return False
+            os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+            digest = hashlib.sha256()
+            with gzip.open(snapshot + ".tmp", "wb") as body:
+                chunks = response.iter_content(chunk_size=self.chunk_size)
+                for chunk in self.count_bytes(chunks):
+                    digest.update(chunk)
+                    body.write(chunk)
+        except requests.RequestException as e:
+            raise RegistryError(e)
+        finally:
+            response.close()
+
+        changed = digest.hexdigest() != meta.get("sha256")
+        os.replace(snapshot + ".tmp", snapshot)
+        with open(snapshot + ".meta", "w") as meta_file:
+            json.dump(
+                {
+                    "url": self.get_url(path),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha256": digest.hexdigest(),
+                },
+                meta_file,
+            )
+        return changed
+
+    def get_digest(self, paths=None):
+        """Identifies the content of the exports of this sync, or of only
+        some of them, or None if they are not kept as snapshots.
+        """
+        if not self.snapshot_dir:
+            return None
+        digests = [
+            self.get_snapshot_meta(path).get("sha256")
+            for path in paths or self.get_export_paths()
+        ]
+        if not all(digests):
+            return None
+        return hashlib.sha256(" ".join(digests).encode()).hexdigest()
+
+    def update_snapshot(self, path):
+        """Download the export at ``path`` at most once per sync. Returns
+        whether it changed.
+        """
+        if path not in self.downloads:
+            try:
+                self.downloads[path] = self.download(path)
+            except RegistryError as e:
+                self.downloads[path] = e
+        if isinstance(self.downloads[path], RegistryError):
+            raise self.downloads[path]
+        return self.downloads[path]
+
+    def refresh(self, paths=None):
+        """Download the exports, or only the ones at ``paths``, into
+        snapshots, ``workers`` at a time. Returns False only if all of them
+        were retrieved and none changed since the last sync.
+        """
+        if not self.snapshot_dir or self.offline:
+            return True
+
+        def download(path):
+            try:
+                return self.update_snapshot(path)
+            except RegistryError:
+                # Reported when the export is read
+                return True
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            changed = list(executor.map(download, paths or self.get_export_paths()))
+        return any(changed)
+
 
 class BDRRegistry(BaseRegistry):
     """Middleware to communicate with BDR Registry."""
 
-    def __init__(self):
+    def __init__(self, offline=False):
         entrypoint = settings.BDR_REGISTRY_URL
         token = settings.BDR_REGISTRY_TOKEN
         super(BDRRegistry, self).__init__(
-            "BDRRegistry", entrypoint=entrypoint, token=token
+            "BDRRegistry", entrypoint=entrypoint, token=token, offline=offline
         )
 
     def do_request(
@@ -96,11 +451,12 @@ class BDRRegistry(BaseRegistry):
         headers=None,
         cookies=None,
         auth=None,
+        stream=False,
     ):
         """Handler for BDR API calls - the authorization is done
         using a token.
         """
-        headers = {"Authorization": self.token}
+        headers = dict(headers or {}, Authorization=self.token)
         return super(BDRRegistry, self).do_request(
             path,
             method=method,
@@ -109,10 +465,14 @@ class BDRRegistry(BaseRegistry):
             headers=headers,
             cookies=cookies,
             auth=auth,
+            stream=stream,
         )
 
+    def get_export_paths(self):
+        return [settings.BDR_COMPANIES_PATH, settings.BDR_PERSONS_PATH]
+
     def get_companies(self):
-        """Gets the list with all companies. Each company has
+        """Yields all the companies. Each company has
         the following fields:
         - name
         - country (code)
@@ -135,13 +495,10 @@ class BDRRegistry(BaseRegistry):
             - phone2
             - phone3
         """
-        response = self.do_request(settings.BDR_COMPANIES_PATH)
-        if response:
-            return response.json()
-        return []
+        return self.iter_objects(settings.BDR_COMPANIES_PATH)
 
     def get_persons(self):
-        """Gets the list with all persons. Each person has
+        """Yields all the persons. Each person has
         the following fields:
         - userid
         - companyname
@@ -153,21 +510,19 @@ class BDRRegistry(BaseRegistry):
         - phone3
         - fax
         """
-        response = self.do_request(settings.BDR_PERSONS_PATH)
-        if response:
-            return response.json()
-        return []
+        return self.iter_objects(settings.BDR_PERSONS_PATH)
 
 
 class EuropeanCacheRegistry(BaseRegistry):
     """Middleware to communicate with BDR Registry."""
 
-    def __init__(self):
+    def __init__(self, offline=False):
         entrypoint = settings.ECR_REGISTRY_URL
         token = settings.ECR_REGISTRY_TOKEN
         super(EuropeanCacheRegistry, self).__init__(
-            "EuropeanCacheRegistry", entrypoint=entrypoint, token=token
+            "EuropeanCacheRegistry", entrypoint=entrypoint, token=token, offline=offline
         )
+        self.workers = settings.ECR_FETCH_WORKERS
 
     def do_request(
         self,
@@ -178,11 +533,12 @@ class EuropeanCacheRegistry(BaseRegistry):
         headers=None,
         cookies=None,
         auth=None,
+        stream=False,
     ):
         """Handler for ECR API calls - the authorization is done
         using a token.
         """
-        headers = {"Authorization": self.token}
+        headers = dict(headers or {}, Authorization=self.token)
         return super(EuropeanCacheRegistry, self).do_request(
             path,
             method=method,
@@ -191,10 +547,20 @@ class EuropeanCacheRegistry(BaseRegistry):
             headers=headers,
             cookies=cookies,
             auth=auth,
+            stream=stream,
         )
 
+    def get_domain_path(self, domain):
+        return settings.ECR_COMPANY_PATH.replace("[domain]", domain)
+
+    def get_company_paths(self):
+        return [self.get_domain_path(domain) for domain in settings.ECR_DOMAINS]
+
+    def get_export_paths(self):
+        return self.get_company_paths() + [settings.ECR_PERSON_PATH]
+
     def get_companies(self):
-        """Gets the list with all companies. Each company has
+        """Yields all the companies. Each company has
         the following fields:
          - website
          - status
@@ -220,18 +586,90 @@ class EuropeanCacheRegistry(BaseRegistry):
                 - name,
          - types
          - name
+
+        The domains are downloaded concurrently, by at most
+        ECR_FETCH_WORKERS threads, and their companies are yielded as soon
+        as they are parsed. A domain that fails is recorded in ``errors``
+        and does not stop the others.
+
+        When the exports are kept as snapshots, they are all downloaded
+        first, concurrently, and then read one domain after the other, so
+        that the companies of the same exports always come in the same
+        order: an interrupted sync resumes after the batches it committed.
         """
-        companies = []
-        for domain in settings.ECR_DOMAINS:
-            response = self.do_request(
-                settings.ECR_COMPANY_PATH.replace("[domain]", domain)
+        domains = settings.ECR_DOMAINS
+        if self.snapshot_dir:
+            self.refresh(self.get_company_paths())
+            for domain in domains:
+                yield from self.read_domain(domain)
+            return
+
+        items = queue.Queue(maxsize=settings.ECR_FETCH_QUEUE_SIZE)
+        stop = threading.Event()
+        workers = max(1, min(settings.ECR_FETCH_WORKERS, len(domains)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for domain in domains:
+                executor.submit(self.fetch_domain, domain, items, stop)
+            pending = len(domains)
+            try:
+                while pending:
+                    item = items.get()
+                    if item is DOMAIN_DONE:
+                        pending -= 1
+                        continue
+                    self.items += 1
+                    yield item
+            finally:
+                # Release the workers if the consumer stops early
+                stop.set()
+
+    def read_domain(self, domain):
+        try:
+            for item in self.iter_export(self.get_domain_path(domain)):
+                self.items += 1
+                yield item
+        except EXPORT_ERRORS as e:
+            self.errors[domain] = str(e)
+            logger.error(
+                "Error fetching {} domain {} ({})".format(self.name, domain, e)
+            )
+
+    def fetch_domain(self, domain, items, stop):
+        """Stream the companies of one domain into the ``items`` queue."""
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        started = time.monotonic()
+        count = 0
+        try:
+            for item in self.iter_export(self.get_domain_path(domain)):
+                if not put(item):
+                    break
+                count += 1
+        except Exception as e:
+            self.errors[domain] = str(e)
+            logger.error(
+                "Error fetching {} domain {} ({})".format(self.name, domain, e)
+            )
+        else:
+            logger.info(
+                "Fetched %s companies from domain %s in %.3fs",
+                count,
+                domain,
+                time.monotonic() - started,
             )
-            if response:
-                companies += response.json()
-        return companies
+        finally:
+            put(DOMAIN_DONE)
 
     def get_persons(self):
-        """Gets the list with all persons. Each person has
+        """Yields all the persons. Each person has
         the following fields:
         - username
         - companyname
@@ -240,7 +678,4 @@ class EuropeanCacheRegistry(BaseRegistry):
         - contact_lastname
         - contact_email
         """
-        response = self.do_request(settings.ECR_PERSON_PATH)
-        if response:
-            return response.json()
-        return []
+        return self.iter_objects(settings.ECR_PERSON_PATH)
@@ -0,0 +1,106 @@
+import string
+from operator import attrgetter
+
+from notifications import ACCEPTED_PARAMS
+
+# The parameters are expressions over the template, the company and the
+# person. Sending a template evaluates them for every recipient, so they
+# are compiled once per template instead: the ones depending only on the
+# template (CLOSING_DATE) are evaluated right away, the company and person
+# attributes become attribute getters, and the subject and body are parsed
+# once into their literal text and replacement fields.
+
+RECIPIENT_SOURCES = ("company", "person")
+
+formatter = string.Formatter()
+
+
+def compile_param(emailtemplate, expression):
+    """A ``(source, getter)`` pair for a recipient dependent expression,
+    ``(None, value)`` for a constant one.
+    """
+    if not expression:
+        return None, expression
+    source, _, path = expression.partition(".")
+    if source not in RECIPIENT_SOURCES:
+        return None, eval(expression, {}, {"emailtemplate": emailtemplate})
+    if path and all(name.isidentifier() for name in path.split(".")):
+        return source, attrgetter(path)
+    code = compile(expression, "<{}>".format(expression), "eval")
+    return source, lambda obj: eval(code, {}, {source: obj})
+
+
+def compile_text(text):
+    """The ``(literal, field, conversion, format_spec)`` parts of a format
+    string, or None when it uses anything beyond plain named fields, to be
+    left to ``str.format``.
+    """
+    try:
+        parts = list(formatter.parse(text))
+    except ValueError:
+        return None
+    compiled = []
+    for literal, field, format_spec, conversion in parts:
+        if field is not None and (
+            not field.isidentifier() or "{" in (format_spec or "")
+        ):
+            return None
+        compiled.append((literal, field, conversion, format_spec))
+    return compiled
+
+
+class TemplateRenderer(object):
+    """Renders the subject and body of a CycleEmailTemplate for its
+    recipients, evaluating only the parameters they use.
+    """
+
+    def __init__(self, emailtemplate):
+        self.emailtemplate = emailtemplate
+        self.constants = {}
+        self.getters = {}
+        for param, expression in ACCEPTED_PARAMS.items():
+            source, getter = compile_param(emailtemplate, expression)
+            if source is None:
+                self.constants[param] = getter
+            else:
+                self.getters[param] = (source, getter)
+        self.subject = compile_text(emailtemplate.subject)
+        self.body = compile_text(emailtemplate.body_html)
+        self.fields = self.get_fields(self.subject, self.body)
+
+    def get_fields(self, *texts):
+        if any(parts is None for parts in texts):
+            return None
+        return {field for parts in texts for _, field, _, _ in parts if field}
+
+    def params(self, person, company, fields=None):
+        """The parameter values for the recipient; all of them unless only
+        some ``fields`` are asked for.
+        """
+        sources = {"company": company, "person": person}
+        params = dict(self.constants)
+        for param, (source, getter) in self.getters.items():
+            if fields is None or param in fields:
+                params[param] = getter(sources[source])
+        return params
+
+    def format(self, parts, text, params):
+        if parts is None:
+            return text.format(**params)
+        formatted = []
+        for literal, field, conversion, format_spec in parts:
+            formatted.append(literal)
+            if field is not None:
+                value = params[field]
+                if conversion:
+                    value = formatter.convert_field(value, conversion)
+                formatted.append(format(value, format_spec))
+        return "".join(formatted)
+
+    def render(self, person, company):
+        """The ``(subject, body)`` of the email to the person."""
+        params = self.params(person, company, self.fields)
+        return (
+            self.format(self.subject, self.emailtemplate.subject, params),
+            self.format(self.body, self.emailtemplate.body_html, params),
+        )
@@ -0,0 +1,543 @@
+import logging
+from collections import Counter
+from io import StringIO
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from notifications.groups import get_group_ids
+from notifications.models import Company, Person, PersonCompany
+from notifications.sync import normalize
+from notifications.toolz import chunked, fingerprint
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def copy_value(value):
+    """A value in the text format of COPY."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_lines(rows):
+    return "".join("\t".join(map(copy_value, row)) + "\n" for row in rows)
+
+
+# Full syncs through staging tables: the parsed registry records are copied
+# into temporary tables, which are never WAL-logged, and merged into the
+# companies, persons and links with a few statements. The records are parsed
+# with the same methods as in the row by row sync, so the groups, the
+# fingerprints and the check_passed flags are the same, and the merge follows
+# the rules of `BaseFetchCommand.bulk_upsert_companies`, `upsert_persons` and
+# `LinkReconciler`.
+
+STAGING_TABLES = {
+    "staging_company": (
+        "position bigint",
+        "external_id text",
+        "group_id integer",
+        "name text",
+        "vat text",
+        "country text",
+        "status text",
+        "representative_name text",
+        "representative_vat text",
+        "representative_country_name text",
+        "check_passed boolean",
+        "fingerprint text",
+        "valid boolean",
+    ),
+    "staging_person": (
+        "position bigint",
+        "username text",
+        "email text",
+        "name text",
+        "fingerprint text",
+        "username_key text",
+        "email_key text",
+    ),
+    "staging_link": (
+        "position bigint",
+        "person_key text",
+        "external_id text",
+        "group_id integer",
+        "company_name text",
+        "country text",
+    ),
+}
+
+COMPANY_FIELDS = (
+    "external_id",
+    "group_id",
+    "name",
+    "vat",
+    "country",
+    "status",
+    "representative_name",
+    "representative_vat",
+    "representative_country_name",
+    "check_passed",
+    "fingerprint",
+)
+
+# Every person once by normalized email and once by normalized username
+PERSON_KEYS = """
+    SELECT lower(btrim(email)) AS key, id FROM {person}
+    UNION ALL
+    SELECT lower(btrim(username)), id FROM {person}
+"""
+
+
+class StagingSync(object):
+    """Full sync of a registry through staging tables, in a single
+    transaction. Only available on PostgreSQL.
+
+    Subclasses stage the registry records in `stage` and select the wanted
+    person-company links in ``wanted_links``, and the companies whose links
+    were all read in ``seen_companies``.
+    """
+
+    # Fields of the parsed companies written by the registry
+    company_fields = COMPANY_FIELDS
+    # Fields a registry company is matched on with an existing one
+    company_key = ("external_id",)
+    wanted_links = None
+    seen_companies = None
+
+    def __init__(self, command):
+        self.command = command
+        self.stats = Counter()
+        self.errors = []
+        self.company_count = 0
+        self.person_count = 0
+        self.cursor = None
+        self.temporary_tables = []
+        self.group_ids = get_group_ids(command.group_codes)
+        self.tables = {
+            "company": Company._meta.db_table,
+            "person": Person._meta.db_table,
+            "link": PersonCompany._meta.db_table,
+        }
+
+    def run(self, registry):
+        # The progress reported in the transaction is published by the lock
+        # heartbeat of the command, on a connection of its own
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.cursor = cursor
+            for table, columns in STAGING_TABLES.items():
+                self.create_table(table, columns)
+            self.command.report("staging")
+            self.stage(registry)
+            for table in STAGING_TABLES:
+                self.execute("ANALYZE {}".format(table))
+            self.command.report("merging")
+            self.merge_persons()
+            self.merge_companies()
+            self.command.report("links")
+            self.merge_links(self.get_seen_companies(registry))
+            # Dropped now in case the sync runs in an outer transaction
+            self.execute("DROP TABLE {}".format(", ".join(self.temporary_tables)))
+        self.command.report()
+        return self.stats
+
+    def create_table(self, table, columns=(), query="", params=None):
+        """Create a temporary table, from its ``columns`` or from ``query``."""
+        sql = "CREATE TEMPORARY TABLE {}".format(table)
+        if columns:
+            sql += " ({})".format(", ".join(columns))
+        sql += " ON COMMIT DROP"
+        if query:
+            sql += " AS " + query
+        self.execute(sql, params)
+        self.temporary_tables.append(table)
+
+    def execute(self, sql, params=None):
+        """Run ``sql``, with the table names filled in, and return the
+        number of rows it changed.
+        """
+        self.cursor.execute(sql.format(**self.tables), params)
+        return self.cursor.rowcount
+
+    def scalar(self, sql, params=None):
+        self.execute(sql, params)
+        return self.cursor.fetchone()[0]
+
+    def copy(self, table, rows):
+        if not rows:
+            return
+        columns = [column.split()[0] for column in STAGING_TABLES[table]]
+        self.cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)),
+            StringIO(copy_lines(rows)),
+        )
+
+    def stage(self, registry):
+        raise NotImplementedError
+
+    def company_row(self, position, data, valid):
+        data = dict(data, fingerprint=fingerprint(data))
+        group = data.pop("group")
+        data["group_id"] = group and group.pk
+        data["external_id"] = str(data["external_id"])
+        data.setdefault("status", "")
+        return (
+            (position,) + tuple(data.get(field) for field in COMPANY_FIELDS) + (valid,)
+        )
+
+    def person_row(self, position, data):
+        return (
+            position,
+            data["username"],
+            data["email"],
+            data["name"],
+            self.command.person_fingerprint(data),
+            normalize(data["username"]),
+            normalize(data["email"]),
+        )
+
+    def stage_persons(self, items):
+        for batch in chunked(enumerate(items), self.command.batch_size):
+            rows = [
+                self.person_row(position, self.command.parse_person_data(item))
+                for position, item in batch
+            ]
+            self.copy("staging_person", rows)
+            self.person_count += len(rows)
+
+    def merge_persons(self):
+        """Match the staged persons like `BaseFetchCommand.match_person`
+        does, update the matched persons with their last staged record and
+        create the others, once per email.
+        """
+        self.create_table(
+            "person_match",
+            query="""
+            SELECT s.position, min(k.id) AS person_id, count(DISTINCT k.id) AS matches
+            FROM staging_person s
+            CROSS JOIN LATERAL (VALUES (s.username_key), (s.email_key)) v(key)
+            JOIN ({keys}) k ON k.key = v.key
+            GROUP BY s.position
+            """.replace(
+                "{keys}", PERSON_KEYS
+            ),
+        )
+        self.stats["persons_ambiguous"] = self.scalar(
+            """
+            SELECT count(DISTINCT s.username) FROM person_match m
+            JOIN staging_person s ON s.position = m.position
+            WHERE m.matches > 1
+            """
+        )
+        matched = self.scalar("SELECT count(DISTINCT person_id) FROM person_match")
+        updated = self.execute(
+            """
+            UPDATE {person} p
+            SET email = s.email, name = s.name, fingerprint = s.fingerprint
+            FROM (
+                SELECT DISTINCT ON (m.person_id) m.person_id, s.*
+                FROM person_match m JOIN staging_person s ON s.position = m.position
+                ORDER BY m.person_id, s.position DESC
+            ) s
+            WHERE p.id = s.person_id AND p.fingerprint <> s.fingerprint
+            """
+        )
+        self.stats["persons_updated"] = updated
+        self.stats["persons_unchanged"] = matched - updated
+        # The username of the first record, the email and name of the last one
+        self.stats["persons_created"] = self.execute(
+            """
+            INSERT INTO {person} (username, email, name, fingerprint)
+            SELECT DISTINCT ON (s.email_key)
+                first_value(s.username) OVER w, s.email, s.name, s.fingerprint
+            FROM staging_person s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM person_match m WHERE m.position = s.position
+            )
+            WINDOW w AS (PARTITION BY s.email_key ORDER BY s.position)
+            ORDER BY s.email_key, s.position DESC
+            ON CONFLICT (username) DO NOTHING
+            """
+        )
+
+    def merge_companies(self):
+        """Update the companies matching a staged one, valid or rejected,
+        with its last record, and create the valid ones not existing yet.
+        """
+        key = ", ".join("s." + field for field in self.company_key)
+        self.create_table(
+            "staged_company",
+            query="""
+            SELECT DISTINCT ON ({key}) s.* FROM staging_company s
+            WHERE s.group_id IS NOT NULL
+            ORDER BY {key}, s.position DESC
+            """.replace(
+                "{key}", key
+            ),
+        )
+        self.create_table(
+            "company_match",
+            query="""
+            SELECT DISTINCT ON (s.position) s.position, c.id AS company_id
+            FROM staged_company s JOIN {company} c ON {join}
+            WHERE c.group_id = ANY(%s)
+            ORDER BY s.position, c.id
+            """.replace(
+                "{join}",
+                " AND ".join("c.{0} = s.{0}".format(f) for f in self.company_key),
+            ),
+            params=[self.group_ids],
+        )
+        matched = self.scalar("SELECT count(*) FROM company_match")
+        fields = [field for field in COMPANY_FIELDS if field in self.company_fields]
+        updated = self.execute(
+            """
+            UPDATE {company} c SET %s
+            FROM staged_company s JOIN company_match m ON m.position = s.position
+            WHERE c.id = m.company_id AND c.fingerprint <> s.fingerprint
+            """
+            % ", ".join("{0} = s.{0}".format(field) for field in fields)
+        )
+        self.stats["companies_updated"] = updated
+        self.stats["companies_unchanged"] = matched - updated
+        # Rejected companies are only updated, never created
+        self.stats["companies_created"] = self.execute(
+            """
+            INSERT INTO {company} (%s)
+            SELECT %s FROM staged_company s
+            WHERE s.valid AND NOT EXISTS (
+                SELECT 1 FROM company_match m WHERE m.position = s.position
+            )
+            """
+            % (
+                ", ".join(COMPANY_FIELDS),
+                ", ".join("s." + field for field in COMPANY_FIELDS),
+            )
+        )
+        self.stats["companies_rejected"] = self.scalar(
+            "SELECT count(*) FROM staging_company WHERE NOT valid"
+        )
+        self.company_count = self.scalar(
+            "SELECT count(*) FROM staging_company WHERE valid AND group_id IS NOT NULL"
+        )
+        self.execute(
+            "SELECT name FROM staging_company WHERE valid AND group_id IS NULL"
+        )
+        for (name,) in self.cursor.fetchall():
+            self.errors.append(("No group for the company", name))
+
+    def get_seen_companies(self, registry):
+        """The query selecting the companies whose links are reconciled, or
+        None for all the registry companies: when some exports failed, only
+        the companies read are, like in a partial `LinkReconciler`.
+        """
+        if not registry.errors:
+            return None
+        logger.warning(
+            "Only reconciling the links of the companies read, some exports "
+            "failed: %s",
+            ", ".join(sorted(registry.errors)),
+        )
+        return self.seen_companies
+
+    def merge_links(self, seen=None):
+        """Flag the wanted links as current and the other links of the
+        registry companies, or only of the ``seen`` ones, as not current,
+        insert the missing ones and remove the duplicated rows, as
+        `LinkReconciler` does.
+        """
+        self.create_table(
+            "wanted_link",
+            query=self.wanted_links.replace("{keys}", PERSON_KEYS),
+            params=[self.group_ids],
+        )
+        self.create_table(
+            "registry_link",
+            query="""
+            SELECT l.id, l.person_id, l.company_id, l.current
+            FROM {link} l JOIN {company} c ON c.id = l.company_id
+            WHERE c.group_id = ANY(%s)
+            """,
+            params=[self.group_ids],
+        )
+        self.stats["links_removed"] = self.execute(
+            """
+            DELETE FROM {link} WHERE id IN (
+                SELECT l.id FROM registry_link l WHERE EXISTS (
+                    SELECT 1 FROM registry_link o
+                    WHERE o.person_id = l.person_id
+                    AND o.company_id = l.company_id AND o.id < l.id
+                )
+            )
+            """
+        )
+        self.stats["links_activated"] = self.execute(
+            """
+            UPDATE {link} l SET current = true FROM wanted_link w
+            WHERE l.person_id = w.person_id AND l.company_id = w.company_id
+            AND l.current IS NOT TRUE
+            """
+        )
+        deactivated = """
+            SELECT l.id FROM registry_link l WHERE l.current AND NOT EXISTS (
+                SELECT 1 FROM wanted_link w
+                WHERE w.person_id = l.person_id AND w.company_id = l.company_id
+            )
+        """
+        if seen is not None:
+            deactivated += " AND l.company_id IN ({})".format(seen)
+        self.stats["links_deactivated"] = self.execute(
+            "UPDATE {link} SET current = false WHERE id IN (%s)" % deactivated
+        )
+        self.stats["links_added"] = self.execute(
+            """
+            INSERT INTO {link} (person_id, company_id, current)
+            SELECT w.person_id, w.company_id, true FROM wanted_link w
+            WHERE NOT EXISTS (
+                SELECT 1 FROM registry_link l
+                WHERE l.person_id = w.person_id AND l.company_id = w.company_id
+            )
+            """
+        )
+
+
+class ECRStagingSync(StagingSync):
+    """ECR companies are matched on their id and group; each valid company
+    is linked to every person having the username or the email of one of
+    its users as username or email.
+    """
+
+    company_key = ("external_id", "group_id")
+    wanted_links = """
+        SELECT DISTINCT k.id AS person_id, c.id AS company_id
+        FROM staging_link l
+        JOIN (
+            SELECT DISTINCT ON (external_id, group_id) id, external_id, group_id
+            FROM {company} WHERE group_id = ANY(%s)
+            ORDER BY external_id, group_id, id
+        ) c ON c.external_id = l.external_id AND c.group_id = l.group_id
+        JOIN ({keys}) k ON k.key = l.person_key
+    """
+    # Valid or rejected, their users come with them
+    seen_companies = """
+        SELECT c.id FROM {company} c JOIN staging_company s
+        ON s.external_id = c.external_id AND s.group_id = c.group_id
+    """
+
+    def stage(self, registry):
+        command = self.command
+        self.stage_persons(registry.get_persons())
+        items = enumerate(command.get_companies(registry))
+        for batch in chunked(items, command.batch_size):
+            companies = []
+            links = []
+            for position, item in batch:
+                data = command.parse_company_data(item)
+                valid = bool(item.get("check_passed"))
+                companies.append(self.company_row(position, data, valid))
+                if not (valid and data["group"]):
+                    continue
+                keys = {normalize(user["username"]) for user in item["users"]}
+                keys.update(normalize(user["email"]) for user in item["users"])
+                for key in sorted(keys):
+                    links.append(
+                        (position, key, companies[-1][1], data["group"].pk, None, None)
+                    )
+            self.copy("staging_company", companies)
+            self.copy("staging_link", links)
+            command.report()
+
+
+class BDRStagingSync(StagingSync):
+    """BDR companies are matched on their id; each registry person is linked
+    to the companies with its company name and country, compared
+    normalized.
+    """
+
+    company_fields = (
+        "external_id",
+        "group_id",
+        "name",
+        "vat",
+        "country",
+        "fingerprint",
+    )
+    wanted_links = """
+        SELECT DISTINCT p.person_id, c.id AS company_id
+        FROM (
+            SELECT l.position, l.company_name, l.country, min(k.id) AS person_id
+            FROM staging_link l JOIN ({keys}) k ON k.key = l.person_key
+            GROUP BY l.position, l.company_name, l.country
+        ) p
+        JOIN {company} c ON lower(btrim(c.name)) = p.company_name
+        AND lower(btrim(c.country)) = p.country
+        WHERE c.group_id = ANY(%s)
+    """
+    seen_companies = "SELECT company_id FROM wanted_link"
+
+    def get_seen_companies(self, registry):
+        seen = super(BDRStagingSync, self).get_seen_companies(registry)
+        if seen is not None and settings.BDR_PERSONS_PATH in registry.errors:
+            # The other persons of the companies read may come after the failure
+            return seen + " WHERE false"
+        return seen
+
+    def merge_links(self, seen=None):
+        super(BDRStagingSync, self).merge_links(seen)
+        self.stats["persons_unmatched"] = self.scalar(
+            """
+            SELECT count(*) FROM staging_link l
+            WHERE EXISTS (SELECT 1 FROM ({keys}) k WHERE k.key = l.person_key)
+            AND NOT EXISTS (
+                SELECT 1 FROM {company} c
+                WHERE lower(btrim(c.name)) = l.company_name
+                AND lower(btrim(c.country)) = l.country AND c.group_id = ANY(%s)
+            )
+            """.replace(
+                "{keys}", PERSON_KEYS
+            ),
+            [self.group_ids],
+        )
+
+    def stage(self, registry):
+        command = self.command
+        items = enumerate(registry.get_companies())
+        for batch in chunked(items, command.batch_size):
+            rows = []
+            for position, item in batch:
+                data = command.parse_company_data(item)
+                if data:
+                    rows.append(self.company_row(position, data, True))
+            self.copy("staging_company", rows)
+            command.report()
+
+        for batch in chunked(enumerate(registry.get_persons()), command.batch_size):
+            persons = []
+            links = []
+            for position, item in batch:
+                persons.append(
+                    self.person_row(position, command.parse_person_data(item))
+                )
+                links.append(
+                    (
+                        position,
+                        normalize(item["contactemail"]),
+                        None,
+                        None,
+                        normalize(item["companyname"]),
+                        normalize(item["country"]),
+                    )
+                )
+            self.copy("staging_person", persons)
+            self.copy("staging_link", links)
+            self.person_count += len(persons)
+            command.report()
@@ -0,0 +1,259 @@
+import json
+import logging
+import multiprocessing
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import IntegrityError, connections, transaction
+from django.utils import timezone
+from django_q.tasks import async_task
+
+from notifications.models import FetchJob, Person, PersonCompany
+from notifications.toolz import chunked
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+FETCH_COMMANDS = ("fetch_bdr", "fetch_ecr")
+
+
+def normalize(value):
+    """Normalized form of an email or username, used for matching."""
+    return (value or "").strip().lower()
+
+
+class PersonIndex(object):
+    """Persons indexed by normalized email and username, so that the
+    registry persons are matched in memory instead of with a query each.
+    Persons not saved yet can be added and are matched as well.
+    """
+
+    def __init__(self, persons=()):
+        self.by_email = defaultdict(list)
+        self.by_username = defaultdict(list)
+        for person in persons:
+            self.add(person)
+
+    @classmethod
+    def load(cls):
+        return cls(Person.objects.order_by("pk"))
+
+    def add(self, person):
+        self.by_email[normalize(person.email)].append(person)
+        self.by_username[normalize(person.username)].append(person)
+
+    def set_email(self, person, email):
+        persons = self.by_email.get(normalize(person.email), [])
+        if person in persons:
+            persons.remove(person)
+        person.email = email
+        self.by_email[normalize(email)].append(person)
+
+    def lookup(self, *values):
+        """Distinct persons having one of the values as email or username,
+        the saved ones first, in primary key order.
+        """
+        persons = {}
+        for value in map(normalize, values):
+            for person in self.by_email.get(value, []) + self.by_username.get(
+                value, []
+            ):
+                persons[id(person)] = person
+        return sorted(
+            persons.values(),
+            key=lambda person: (person.pk is None, person.pk or 0),
+        )
+
+    def find(self, values):
+        """The saved persons having one of the values as email or username."""
+        return [person for person in self.lookup(*values) if person.pk is not None]
+
+    def match(self, username, email):
+        """All the persons a registry person matches: by email or username,
+        either of them being compared with both fields. The first one is
+        the one to update; more than one means the match is ambiguous.
+        """
+        return self.lookup(username, email)
+
+
+class LinkReconciler(object):
+    """Collects the person-company links wanted by a sync and applies only
+    the differences with the stored links: new links are inserted, the
+    existing ones are flagged current or not current, and duplicated rows
+    are removed. Links are never deleted, so the past recipients of a
+    company are kept. The differences are applied in one transaction at
+    the end of the sync: until then, readers see the previous links,
+    complete, and sends need not wait for syncs.
+
+    With ``partial``, only the links of the companies passed to `add` or
+    `touch` are reconciled, the others being left as they are.
+    """
+
+    def __init__(self, links, batch_size=1000, partial=False):
+        self.batch_size = batch_size
+        self.partial = partial
+        self.existing = {}
+        self.duplicates = []
+        self.wanted = set()
+        self.companies = set()
+        rows = links.order_by("pk").values_list(
+            "pk", "person_id", "company_id", "current"
+        )
+        for pk, person_id, company_id, current in rows:
+            key = (person_id, company_id)
+            if key in self.existing:
+                self.duplicates.append(pk)
+            else:
+                self.existing[key] = (pk, current)
+
+    def add(self, person_id, company_id):
+        self.wanted.add((person_id, company_id))
+        self.companies.add(company_id)
+
+    def touch(self, company_id):
+        """Reconcile the links of a company, even if it has none wanted."""
+        self.companies.add(company_id)
+
+    def diff(self):
+        """The links to add and the primary keys of the links to flag as
+        current and as not current.
+        """
+        to_add = sorted(self.wanted.difference(self.existing))
+        to_activate = []
+        to_deactivate = []
+        for key, (pk, current) in self.existing.items():
+            if key in self.wanted:
+                if not current:
+                    to_activate.append(pk)
+            elif current and (not self.partial or key[1] in self.companies):
+                to_deactivate.append(pk)
+        return to_add, to_activate, to_deactivate
+
+    def apply(self, dry_run=False):
+        """Write the differences, unless ``dry_run``, and return their counts."""
+        to_add, to_activate, to_deactivate = self.diff()
+        if not dry_run:
+            self.write(to_add, to_activate, to_deactivate)
+        return Counter(
+            links_added=len(to_add),
+            links_activated=len(to_activate),
+            links_deactivated=len(to_deactivate),
+            links_removed=len(self.duplicates),
+        )
+
+    def write(self, to_add, to_activate, to_deactivate):
+        links = PersonCompany.objects.really_all()
+        with transaction.atomic():
+            links.bulk_create(
+                [
+                    PersonCompany(
+                        person_id=person_id, company_id=company_id, current=True
+                    )
+                    for person_id, company_id in to_add
+                ],
+                batch_size=self.batch_size,
+            )
+            for batch in chunked(to_activate, self.batch_size):
+                links.filter(pk__in=batch).update(current=True)
+            for batch in chunked(to_deactivate, self.batch_size):
+                links.filter(pk__in=batch).update(current=False)
+            for batch in chunked(self.duplicates, self.batch_size):
+                links.filter(pk__in=batch).delete()
+
+
+def run_fetch_command(name, options):
+    return call_command(name, **options)
+
+
+def fetch_registries(commands, parallel=False, **options):
+    """Run the fetch ``commands`` with the same ``options`` and return
+    their reports by command name. With ``parallel``, each command runs in
+    its own process; they write disjoint company groups, so they do not
+    wait for each other.
+    """
+    if not parallel:
+        return {name: run_fetch_command(name, options) for name in commands}
+    # The forked processes must open their own database connections
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=len(commands), mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        futures = {
+            name: executor.submit(run_fetch_command, name, options) for name in commands
+        }
+    return {name: future.result() for name, future in futures.items()}
+
+
+# Syncs started from the fetch endpoint run as jobs on the django_q cluster,
+# one task per command when FETCH_PARALLEL is set, and report their progress
+# in a FetchJob.
+
+
+def update_fetch_job(job_id, command, **values):
+    """Merge ``values`` in the progress of ``command``; the job is finished
+    once every command has a result or an error.
+    """
+    with transaction.atomic():
+        job = FetchJob.objects.select_for_update().get(pk=job_id)
+        job.progress.setdefault(command, {}).update(values)
+        if job.status == FetchJob.QUEUED:
+            job.status = FetchJob.RUNNING
+            job.started_at = timezone.now()
+        if job.is_finished:
+            failed = any("error" in job.progress[name] for name in job.commands)
+            job.status = FetchJob.FAILED if failed else FetchJob.DONE
+            job.finished_at = timezone.now()
+        job.save()
+
+
+def run_fetch_job(job_id, commands):
+    for name in commands:
+        update_fetch_job(job_id, name, phase="started")
+        try:
+            result = call_command(name, job=job_id)
+        except Exception as e:
+            logger.exception("Fetch job %s: %s failed", job_id, name)
+            update_fetch_job(job_id, name, phase="failed", error=str(e))
+        else:
+            try:
+                result = json.loads(result)
+            except ValueError:
+                pass
+            update_fetch_job(job_id, name, phase="done", result=result)
+
+
+def expire_fetch_jobs():
+    """Fail the jobs whose workers died before finishing them."""
+    expired = timezone.now() - timedelta(seconds=settings.FETCH_JOB_TIMEOUT)
+    FetchJob.objects.active().filter(created_at__lt=expired).update(
+        status=FetchJob.FAILED, finished_at=timezone.now()
+    )
+
+
+def start_fetch_job(commands=FETCH_COMMANDS):
+    """Enqueue a sync of the registries and return its job, or return the
+    job already queued or running instead of starting a second one.
+    """
+    expire_fetch_jobs()
+    job = FetchJob.objects.active().first()
+    if job is not None:
+        return job
+    try:
+        with transaction.atomic():
+            job = FetchJob.objects.create(commands=list(commands))
+    except IntegrityError:
+        # Started by a concurrent request
+        return FetchJob.objects.active().first() or FetchJob.objects.latest("pk")
+
+    if not settings.ASYNC_FETCH:  # TESTING
+        run_fetch_job(job.pk, commands)
+    elif settings.FETCH_PARALLEL:
+        for name in commands:
+            async_task(run_fetch_job, job.pk, [name])
+    else:
+        async_task(run_fetch_job, job.pk, list(commands))
+    job.refresh_from_db()
+    return job
@@ -1,4 +1,6 @@
 from django.test import TestCase
+
+from notifications.groups import invalidate_groups
 from . import factories
 
 
@@ -7,6 +9,8 @@ class BaseTest(TestCase):
     BODY_FORMAT = "Email company {COMPANY} for person {CONTACT}."
 
     def setUp(self):
+        # The groups cached by a previous test were rolled back
+        invalidate_groups()
         user = factories.UserFactory(is_staff=True)
         self.client.force_login(user)
 
@@ -1,15 +1,36 @@
-import json
+from notifications.registries import iter_json_array
 
 
 class BaseRegistryMock(object):
+    chunk_size = 64
+    errors = {}
+    items = 0
+    bytes_received = 0
+
     def get_objects(self, json_path):
-        json_data = open(json_path)
-        data = json.load(json_data)
-        json_data.close()
-        return data
+        with open(json_path, "rb") as json_data:
+            chunks = iter(lambda: json_data.read(self.chunk_size), b"")
+            for item in iter_json_array(chunks):
+                self.items += 1
+                yield item
+
+    def refresh(self, paths=None):
+        return True
+
+    def get_digest(self, paths=None):
+        return "test"
+
+    def get_metrics(self):
+        return {}
+
+    def close(self):
+        pass
 
 
 class EuropeanCacheRegistryMock(BaseRegistryMock):
+    def get_company_paths(self):
+        return ["notifications/tests/base/json/ecr_companies.json"]
+
     def get_companies(self):
         return self.get_objects("notifications/tests/base/json/ecr_companies.json")
 
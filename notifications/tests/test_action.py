@@ -1,9 +1,24 @@
 import json
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
+from django.contrib import admin
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, transaction
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
 
 from notifications import models
+from notifications.admin import CompanyAdmin, PersonAdmin
+from notifications.groups import invalidate_groups
 from notifications.tests.base.base import BaseTest
+from notifications.tests.base.registry_mock import EuropeanCacheRegistryMock
 
 
 class ECRActionTest(BaseTest):
@@ -13,7 +28,288 @@ class ECRActionTest(BaseTest):
 
     def test_ecr(self):
         call_command("fetch_ecr", "--test")
+        self.check_fetched()
 
+    def test_ecr_bulk(self):
+        call_command("fetch_ecr", "--test", "--bulk", "--batch-size", "1")
+        self.check_fetched()
+
+    def test_ecr_bulk_refetch(self):
+        call_command("fetch_ecr", "--test")
+        call_command("fetch_ecr", "--test", "--bulk")
+        self.check_fetched()
+        self.assertEqual(models.PersonCompany.objects.count(), 3)
+
+    def test_ecr_unchanged(self):
+        call_command("fetch_ecr", "--test")
+        msg = call_command("fetch_ecr", "--test", "--bulk")
+        self.assertIn("companies: 0 created, 0 updated, 2 unchanged", msg)
+        self.assertIn("persons: 0 created, 0 updated, 3 unchanged", msg)
+
+        models.Company.objects.filter(external_id="1234").update(name="Old name")
+        models.Company.objects.update(fingerprint="")
+        msg = call_command("fetch_ecr", "--test")
+        self.assertIn("companies: 0 created, 2 updated, 0 unchanged", msg)
+        self.assertIn("persons: 0 created, 0 updated, 3 unchanged", msg)
+        self.check_fetched()
+
+    def test_ecr_retried_after_failure(self):
+        from notifications.management.commands.fetch_ecr import Command
+
+        # The exports are downloaded, then the sync fails without checkpoint
+        with mock.patch.object(Command, "fetch_persons", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                call_command("fetch_ecr", "--test")
+        models.SyncCheckpoint.objects.all().delete()
+
+        # Not downloaded again, but synced since they never were
+        with mock.patch.object(
+            EuropeanCacheRegistryMock, "refresh", return_value=False
+        ):
+            record = json.loads(call_command("fetch_ecr", "--test"))
+            self.assertIn("Registry fetched successfully", record["summary"])
+            self.check_fetched()
+            record = json.loads(call_command("fetch_ecr", "--test"))
+            self.assertEqual(record["summary"], "Registry unchanged")
+
+    def test_ecr_admin_edits_overwritten(self):
+        call_command("fetch_ecr", "--test")
+        company = models.Company.objects.get(external_id="1234")
+        company.name = "Edited name"
+        CompanyAdmin(models.Company, admin.site).save_model(None, company, None, True)
+        person = models.Person.objects.get(username="test1_user")
+        person.email = "edited@email.com"
+        PersonAdmin(models.Person, admin.site).save_model(None, person, None, True)
+
+        record = json.loads(call_command("fetch_ecr", "--test", "--bulk"))
+        self.assertEqual(record["counts"]["companies_updated"], 1)
+        self.assertEqual(record["counts"]["persons_updated"], 1)
+        self.check_fetched()
+        self.assertTrue(models.Person.objects.filter(email="test1@email.com").exists())
+
+    def test_ecr_rejected_counts(self):
+        call_command("fetch_ecr", "--test")
+        get_companies = EuropeanCacheRegistryMock.get_companies
+
+        def reject_first(registry):
+            for item in get_companies(registry):
+                if item["company_id"] == 1234:
+                    item = dict(item, check_passed=False, name="Rejected name")
+                yield item
+
+        counts = []
+        with mock.patch.object(
+            EuropeanCacheRegistryMock, "get_companies", reject_first
+        ):
+            for options in ([], ["--bulk"]):
+                models.Company.objects.really_all().update(fingerprint="")
+                record = json.loads(call_command("fetch_ecr", "--test", *options))
+                counts.append(
+                    {
+                        key: value
+                        for key, value in record["counts"].items()
+                        if key.startswith("companies_")
+                    }
+                )
+        # The rejected company is updated, and counted, by both paths
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[0]["companies_rejected"], 1)
+        self.assertEqual(counts[0]["companies_updated"], 2)
+        self.assertNotIn("companies_unchanged", counts[0])
+        rejected = models.Company.objects.really_all().get(external_id="1234")
+        self.assertEqual(rejected.name, "Rejected name")
+
+    def test_ecr_record(self):
+        record = json.loads(call_command("fetch_ecr", "--test"))
+        self.assertEqual(record["command"], "fetch_ecr")
+        self.assertIn("Registry fetched successfully", record["summary"])
+        self.assertEqual(
+            [phase["name"] for phase in record["phases"]],
+            ["downloading", "loading", "persons", "companies", "links"],
+        )
+        phases = {phase["name"]: phase for phase in record["phases"]}
+        self.assertEqual(phases["persons"]["rows"], 3)
+        self.assertEqual(phases["links"]["rows"], 3)
+        self.assertEqual(record["rows"], 8)
+        self.assertEqual(
+            record["queries"], sum(phase["queries"] for phase in record["phases"])
+        )
+        self.assertGreater(record["peak_rss"], 0)
+
+    def test_ecr_dry_run(self):
+        dry_run = json.loads(call_command("fetch_ecr", "--test", "--dry-run"))
+        self.assertTrue(dry_run["dry_run"])
+        self.assertIn("Dry run, nothing written", dry_run["summary"])
+        self.assertFalse(models.Company.objects.exists())
+        self.assertFalse(models.Person.objects.exists())
+        self.assertFalse(models.RegistrySyncState.objects.exists())
+        self.assertFalse(models.SyncCheckpoint.objects.exists())
+
+        record = json.loads(call_command("fetch_ecr", "--test", "--bulk"))
+        self.assertEqual(dry_run["counts"], record["counts"])
+        self.check_fetched()
+
+        models.Company.objects.filter(external_id="1234").update(fingerprint="")
+        models.PersonCompany.objects.update(current=False)
+        msg = json.loads(call_command("fetch_ecr", "--test", "--dry-run"))["summary"]
+        self.assertIn("companies: 0 created, 1 updated, 1 unchanged", msg)
+        self.assertIn("links: 0 added, 3 activated, 0 deactivated", msg)
+        self.assertFalse(models.PersonCompany.objects.filter(current=True).exists())
+
+    def test_ecr_lock(self):
+        now = timezone.now()
+        models.SyncLock.objects.create(
+            command="fetch_ecr",
+            holder="other:1",
+            acquired_at=now - timedelta(minutes=5),
+            expires_at=now + timedelta(minutes=5),
+        )
+        record = json.loads(call_command("fetch_ecr", "--test"))
+        self.assertTrue(record["skipped"])
+        self.assertIn("being synced by other:1 for 300 seconds", record["summary"])
+        self.assertFalse(models.Company.objects.exists())
+
+        # Waiting for the running sync to finish
+        def finish(seconds):
+            models.SyncLock.objects.all().delete()
+
+        with mock.patch("notifications.management.commands.fetch.time.sleep") as sleep:
+            sleep.side_effect = finish
+            record = json.loads(call_command("fetch_ecr", "--test", "--wait", "60"))
+        self.assertNotIn("skipped", record)
+        self.check_fetched()
+        self.assertFalse(models.SyncLock.objects.exists())
+
+    def test_ecr_expired_lock(self):
+        models.SyncLock.objects.create(
+            command="fetch_ecr",
+            holder="dead:1",
+            acquired_at=timezone.now() - timedelta(hours=2),
+            expires_at=timezone.now() - timedelta(hours=1),
+        )
+        call_command("fetch_ecr", "--test")
+        self.check_fetched()
+        self.assertFalse(models.SyncLock.objects.exists())
+
+    def test_ecr_job_progress(self):
+        job = models.FetchJob.objects.create(commands=["fetch_ecr"])
+        call_command("fetch_ecr", "--test", "--job", str(job.pk))
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.FetchJob.RUNNING)
+        progress = job.progress["fetch_ecr"]
+        self.assertEqual(progress["phase"], "links")
+        self.assertEqual(progress["counts"]["persons_created"], 3)
+        self.assertIn("seconds", progress)
+
+    def test_ecr_resume(self):
+        from notifications.management.commands.fetch_ecr import Command
+
+        create_company = Command.create_company
+
+        def crash_on_second(command, **kwargs):
+            if kwargs["name"] == "Second company":
+                raise RuntimeError("Killed")
+            return create_company(command, **kwargs)
+
+        with mock.patch.object(Command, "create_company", crash_on_second):
+            with self.assertRaises(RuntimeError):
+                call_command("fetch_ecr", "--test", "--batch-size", "1")
+        checkpoint = models.SyncCheckpoint.objects.get(command="fetch_ecr")
+        self.assertEqual(checkpoint.done, {"persons": 2, "companies": 0})
+        self.assertEqual(models.Company.objects.count(), 1)
+        self.assertEqual(models.PersonCompany.objects.count(), 0)
+
+        record = json.loads(call_command("fetch_ecr", "--test", "--batch-size", "1"))
+        self.assertEqual(record["counts"]["batches_resumed"], 4)
+        self.assertEqual(record["counts"]["companies_created"], 1)
+        self.assertNotIn("persons_created", record["counts"])
+        self.check_fetched()
+        self.assertFalse(models.SyncCheckpoint.objects.exists())
+
+    def test_ecr_resume_reordered(self):
+        from notifications.management.commands.fetch_ecr import Command
+        from notifications.registries import EuropeanCacheRegistry
+
+        with open("notifications/tests/base/json/ecr_companies.json") as f:
+            first, second = json.load(f)
+        with open("notifications/tests/base/json/ecr_persons.json", "rb") as f:
+            persons = f.read()
+        exports = {
+            "/FGAS/list": json.dumps([first]).encode(),
+            "/ODS/list": json.dumps([second]).encode(),
+            "/persons": persons,
+        }
+        slow = []
+        iter_export = EuropeanCacheRegistry.iter_export
+
+        def get_response(registry, path, stream=False, headers=None):
+            response = mock.Mock(status_code=200, headers={})
+            response.iter_content.return_value = [exports[path]]
+            return response
+
+        def slow_export(registry, path):
+            # The slow domain is the last one read
+            if path == slow[-1]:
+                time.sleep(0.1)
+            return iter_export(registry, path)
+
+        create_company = Command.create_company
+
+        def crash_on_second(command, **kwargs):
+            if kwargs["name"] == "Second company":
+                raise RuntimeError("Killed")
+            return create_company(command, **kwargs)
+
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+        with self.settings(
+            REGISTRY_SNAPSHOT_DIR=snapshot_dir,
+            ECR_DOMAINS=["FGAS", "ODS"],
+            ECR_COMPANY_PATH="/[domain]/list",
+            ECR_PERSON_PATH="/persons",
+            ECR_FETCH_WORKERS=2,
+        ), mock.patch.object(
+            EuropeanCacheRegistry, "do_request", get_response
+        ), mock.patch.object(
+            EuropeanCacheRegistry, "iter_export", slow_export
+        ):
+            slow.append("/ODS/list")
+            with mock.patch.object(Command, "create_company", crash_on_second):
+                with self.assertRaises(RuntimeError):
+                    call_command("fetch_ecr", "--batch-size", "1")
+            self.assertEqual(models.Company.objects.get().name, "First company")
+
+            # The exports now arrive in the opposite order
+            slow.append("/FGAS/list")
+            record = json.loads(call_command("fetch_ecr", "--batch-size", "1"))
+        self.assertEqual(record["counts"]["companies_created"], 1)
+        self.check_fetched()
+
+    def test_ecr_incremental(self):
+        # Without a previous sync, the first one is a full sync
+        call_command("fetch_ecr", "--test", "--incremental")
+        self.check_fetched()
+        state = models.RegistrySyncState.objects.get(registry="ecr", domain="FGAS")
+        self.assertEqual(state.last_updated.year, 2020)
+        self.assertIsNotNone(state.last_full_sync)
+
+        models.PersonCompany.objects.update(current=False)
+        call_command("fetch_ecr", "--test", "--incremental")
+        # Only the company updated since the last sync was processed
+        self.assertEqual(
+            list(
+                models.PersonCompany.objects.values_list(
+                    "company__external_id", "person__username"
+                )
+            ),
+            [("3245", "test3_user")],
+        )
+
+        with self.settings(ECR_FULL_SYNC_INTERVAL=0):
+            call_command("fetch_ecr", "--test", "--incremental")
+        self.assertEqual(models.PersonCompany.objects.count(), 3)
+
+    def check_fetched(self):
         # Check companies
         companies = models.Company.objects.all()
         json_data = open("notifications/tests/base/json/ecr_companies.json")
@@ -42,6 +338,48 @@ class ECRActionTest(BaseTest):
                 self.assertIn(company, person.company.all())
 
 
+@override_settings(FETCH_LOCK_LEASE=0.5)
+class LockHeartbeatTest(TransactionTestCase):
+    fixtures = [
+        "companiesgroups.json",
+    ]
+
+    def setUp(self):
+        invalidate_groups()
+
+    def test_lease_renewed_during_long_phase(self):
+        job = models.FetchJob.objects.create(commands=["fetch_ecr"])
+        taken = []
+
+        def slow_refresh(registry, paths=None):
+            # Downloading for longer than the lease
+            time.sleep(1.5)
+            taken.append(models.SyncLock.acquire("fetch_ecr", "other:1", 60))
+            job.refresh_from_db()
+            taken.append(job.progress["fetch_ecr"]["seconds"])
+            return True
+
+        with mock.patch.object(EuropeanCacheRegistryMock, "refresh", slow_refresh):
+            call_command("fetch_ecr", "--test", "--job", str(job.pk))
+        self.assertFalse(taken[0])
+        # The progress was published during the download too
+        self.assertGreater(taken[1], 1)
+        self.assertEqual(models.Company.objects.count(), 2)
+        self.assertFalse(models.SyncLock.objects.exists())
+
+    def test_lock_taken_over(self):
+        def lose_lock(registry, paths=None):
+            models.SyncLock.objects.update(holder="other:1")
+            time.sleep(0.5)
+            return True
+
+        with mock.patch.object(EuropeanCacheRegistryMock, "refresh", lose_lock):
+            with self.assertRaisesMessage(CommandError, "taken over"):
+                call_command("fetch_ecr", "--test")
+        self.assertFalse(models.Company.objects.exists())
+        self.assertEqual(models.SyncLock.objects.get().holder, "other:1")
+
+
 class BDRActionTest(BaseTest):
     fixtures = [
         "companiesgroups.json",
@@ -49,7 +387,32 @@ class BDRActionTest(BaseTest):
 
     def test_bdr(self):
         call_command("fetch_bdr", "--test")
+        self.check_fetched()
+
+    def test_bdr_bulk(self):
+        call_command("fetch_bdr", "--test", "--bulk")
+        call_command("fetch_bdr", "--test", "--bulk")
+        self.check_fetched()
+
+    def test_bdr_company_matching(self):
+        dry_run = json.loads(call_command("fetch_bdr", "--test", "--dry-run"))
+        self.assertEqual(dry_run["counts"]["links_added"], 1)
+        call_command("fetch_bdr", "--test")
+
+        # Names and countries are compared normalized
+        models.Company.objects.filter(name="BDR company 1").update(
+            name=" bdr Company 1", country="CHINA"
+        )
+        record = json.loads(call_command("fetch_bdr", "--test", "--dry-run"))
+        self.assertNotIn("persons_unmatched", record["counts"])
+        self.assertEqual(record["counts"]["links_deactivated"], 0)
+
+        models.Company.objects.filter(country="CHINA").update(country="Taiwan")
+        msg = json.loads(call_command("fetch_bdr", "--test"))["summary"]
+        self.assertIn("1 without a matching company", msg)
+        self.assertIn("links: 0 added, 0 activated, 1 deactivated", msg)
 
+    def check_fetched(self):
         # Check companies
         companies = models.Company.objects.all()
         json_data = open("notifications/tests/base/json/bdr_companies.json")
@@ -76,3 +439,92 @@ class BDRActionTest(BaseTest):
                 person_data["companyname"],
                 person.company.values_list("name", flat=True),
             )
+
+
+class InlineExecutor(object):
+    """Stands for the process pool, which cannot share the test database."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class FetchAllActionTest(BaseTest):
+    fixtures = [
+        "companiesgroups.json",
+    ]
+
+    def test_fetch_all(self):
+        records = json.loads(call_command("fetch_all", "--test"))
+        self.assertEqual(sorted(records), ["fetch_bdr", "fetch_ecr"])
+        for record in records.values():
+            self.assertIn("Registry fetched successfully", record["summary"])
+        self.assertEqual(models.Company.objects.count(), 4)
+
+    @mock.patch("notifications.sync.ProcessPoolExecutor", InlineExecutor)
+    # Run inline, the commands share the connection of the test
+    @mock.patch("notifications.sync.connections.close_all")
+    def test_fetch_all_parallel(self, close_all):
+        records = json.loads(call_command("fetch_all", "--test", "--parallel"))
+        self.assertEqual(records["fetch_bdr"]["counts"]["companies_created"], 2)
+        self.assertEqual(records["fetch_ecr"]["counts"]["companies_created"], 2)
+        self.assertEqual(models.Company.objects.count(), 4)
+        close_all.assert_called_once_with()
+
+
+@override_settings(NOTIFICATIONS_TOKEN="token")
+class FetchViewTest(BaseTest):
+    headers = {"Authorization": "Bearer token"}
+
+    def test_token_required(self):
+        resp = self.client.get(reverse("notifications:fetch"))
+        self.assertEqual(resp.status_code, 403)
+
+    @mock.patch("notifications.sync.call_command", return_value="Fetched")
+    def test_fetch_job(self, call_command):
+        resp = self.client.get(reverse("notifications:fetch"), headers=self.headers)
+        data = resp.json()
+        self.assertEqual(data["status"], "done")
+        self.assertEqual(data["progress"]["fetch_bdr"]["result"], "Fetched")
+        self.assertEqual(data["progress"]["fetch_ecr"]["phase"], "done")
+        call_command.assert_any_call("fetch_ecr", job=data["id"])
+
+        resp = self.client.get(data["status_url"], headers=self.headers)
+        self.assertEqual(resp.json()["id"], data["id"])
+
+    @mock.patch("notifications.sync.call_command", side_effect=RuntimeError("Down"))
+    def test_failed_job(self, call_command):
+        resp = self.client.get(reverse("notifications:fetch"), headers=self.headers)
+        data = resp.json()
+        self.assertEqual(data["status"], "failed")
+        self.assertEqual(data["progress"]["fetch_bdr"]["error"], "Down")
+
+    def test_single_active_job(self):
+        models.FetchJob.objects.create(
+            commands=["fetch_bdr"], status=models.FetchJob.RUNNING
+        )
+        # Not queued while another one runs, e.g. by a concurrent request
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.FetchJob.objects.create(commands=["fetch_ecr"])
+        models.FetchJob.objects.create(
+            commands=["fetch_ecr"], status=models.FetchJob.DONE
+        )
+        self.assertEqual(models.FetchJob.objects.active().count(), 1)
+
+    def test_running_job_is_returned(self):
+        job = models.FetchJob.objects.create(
+            commands=["fetch_bdr"], status=models.FetchJob.RUNNING
+        )
+        resp = self.client.get(reverse("notifications:fetch"), headers=self.headers)
+        self.assertEqual(resp.json()["id"], job.pk)
+        self.assertEqual(models.FetchJob.objects.count(), 1)
@@ -0,0 +1,93 @@
+import gzip
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from notifications import models
+from notifications.benchmark import SyntheticRegistry
+from notifications.tests.base import factories
+from notifications.tests.base.base import BaseTest
+
+
+class SyntheticRegistryTest(BaseTest):
+    def test_exports(self):
+        generator = SyntheticRegistry(companies=100, users=2, churn=0.2)
+        companies = [
+            company
+            for domain in generator.domains
+            for company in generator.ecr_companies(domain)
+        ]
+        self.assertEqual(len(companies), 100)
+        self.assertEqual(len(list(generator.ecr_persons())), 200)
+        self.assertEqual(len(list(generator.bdr_persons())), 200)
+
+        changed = [
+            before
+            for before, after in zip(
+                generator.bdr_companies(0), generator.bdr_companies(1)
+            )
+            if before != after
+        ]
+        self.assertTrue(0 < len(changed) < 50)
+        # The exports are the same for the same seed
+        self.assertEqual(
+            list(generator.ecr_persons(1)),
+            list(SyntheticRegistry(companies=100, users=2, churn=0.2).ecr_persons(1)),
+        )
+
+    def test_write_snapshots(self):
+        generator = SyntheticRegistry(companies=10, users=1)
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            counts = generator.write_snapshots(snapshot_dir)
+            self.assertEqual(counts, {"bdr": 20, "ecr": 20})
+            path = os.path.join(
+                snapshot_dir, "EuropeanCacheRegistry", "undertaking_ODS_list.json.gz"
+            )
+            with gzip.open(path) as export:
+                self.assertEqual(len(json.load(export)), 5)
+
+
+class BenchmarkFetchTest(BaseTest):
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            results = os.path.join(directory, "results.jsonl")
+            for _ in range(2):
+                msg = call_command(
+                    "benchmark_fetch",
+                    "--companies",
+                    "20",
+                    "--runs",
+                    "2",
+                    "--results",
+                    results,
+                    stdout=StringIO(),
+                )
+            with open(results) as lines:
+                records = [json.loads(line) for line in lines]
+
+        self.assertEqual(len(records), 2)
+        phases = records[-1]["phases"]
+        self.assertEqual(
+            [(phase["run"], phase["name"]) for phase in phases],
+            [(0, "generate"), (0, "bdr"), (0, "ecr")]
+            + [(1, "generate"), (1, "bdr"), (1, "ecr")],
+        )
+        self.assertEqual(phases[1]["rows"], 80)
+        self.assertGreater(phases[1]["queries"], 0)
+        self.assertIn("previous", msg)
+        self.assertIn("cumulative peak RSS", msg)
+        # The fetched data, and the groups loaded for it, are deleted
+        self.assertFalse(models.Company.objects.really_all().exists())
+        self.assertFalse(models.Person.objects.exists())
+        self.assertFalse(models.RegistrySyncState.objects.exists())
+        self.assertFalse(models.CompaniesGroup.objects.exists())
+
+    def test_existing_data(self):
+        factories.PersonFactory()
+        with self.assertRaises(CommandError):
+            call_command("benchmark_fetch", "--companies", "20")
+        self.assertEqual(models.Person.objects.count(), 1)
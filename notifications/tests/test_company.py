@@ -1,5 +1,6 @@
 from django.urls import reverse
 
+from notifications import groups, models
 from notifications.tests.base import factories
 from notifications.tests.base.base import BaseTest
 
@@ -37,3 +38,20 @@ class SentNotificationsTest(BaseTest):
         self.assertEqual(len(resp.context["company"].active_users), 2)
         self.assertEqual(person1, resp.context["company"].active_users[0])
         self.assertEqual(person2, resp.context["company"].active_users[1])
+
+
+class GroupRegistryTest(BaseTest):
+    def test_groups_are_cached(self):
+        group = factories.CompaniesGroupFactory(code="vans", title="Vans")
+        self.assertEqual(groups.get_group("vans"), group)
+        with self.assertNumQueries(0):
+            self.assertEqual(groups.get_group_by_id(group.pk).title, "Vans")
+            self.assertEqual(groups.get_group_ids(["cars", "vans"]), [group.pk])
+
+        group.title = "Light vehicles"
+        group.save()
+        self.assertEqual(groups.get_group("vans").title, "Light vehicles")
+
+        group.delete()
+        with self.assertRaises(models.CompaniesGroup.DoesNotExist):
+            groups.get_group("vans")
@@ -1,9 +1,28 @@
+from datetime import date, timedelta
+
+from unittest import mock
+
+from django.test import override_settings
 from django.urls import reverse
 from django.core import mail
+from django.utils import timezone
 
 from notifications.tests.base import factories
 from notifications.tests.base.base import BaseTest
-from notifications.models import CycleNotification
+from notifications.forms import (
+    CycleEmailTemplateTriggerForm,
+    SendHeartbeat,
+    deliver_each,
+    expire_send_jobs,
+    get_recipients,
+    make_messages,
+    resume_send_job,
+    run_send_chunk,
+    send_messages,
+)
+from notifications.mail_send import send_mail
+from notifications.models import Company, CycleNotification, SendJob
+from notifications.rendering import TemplateRenderer
 
 
 class CycleEmailTemplateTest(BaseTest):
@@ -131,3 +150,198 @@ class CycleEmailTemplateTest(BaseTest):
         self.assertEqual(
             len(self.persons), len(resp.context["recipients"].first().active_users)
         )
+
+    def test_template_renderer(self):
+        cycle = factories.CycleFactory(closing_date=date(2025, 3, 31))
+        template = factories.CycleEmailTemplateFactory(
+            subject="{COMPANY} {{CLOSING_DATE}}",
+            body_html="{CONTACT!r} of {COMPANY:>8}, by {CLOSING_DATE}",
+            stage=factories.StageFactory(cycle=cycle),
+        )
+        company = factories.CompanyFactory(name="ACME")
+        person = factories.PersonFactory(name="Jane")
+        renderer = TemplateRenderer(template)
+        self.assertEqual(renderer.constants["CLOSING_DATE"], "31 March 2025")
+        self.assertEqual(renderer.fields, {"COMPANY", "CONTACT", "CLOSING_DATE"})
+        self.assertEqual(
+            renderer.render(person, company),
+            ("ACME {CLOSING_DATE}", "'Jane' of     ACME, by 31 March 2025"),
+        )
+        # Anything else is left to str.format
+        template.body_html = "{COMPANY[0]}"
+        renderer = TemplateRenderer(template)
+        self.assertIsNone(renderer.fields)
+        self.assertEqual(renderer.render(person, company)[1], "A")
+        template.body_html = "{UNKNOWN}"
+        with self.assertRaises(KeyError):
+            TemplateRenderer(template).render(person, company)
+
+    @override_settings(SEND_CHUNK_SIZE=2)
+    def test_cycle_email_trigger_chunks(self):
+        self.prepare_email_testing()
+        other = factories.CompanyFactory(group=self.group)
+        factories.PersonCompanyFactory(person=self.persons[0], company=other)
+        empty = factories.CompanyFactory(group=self.group)
+        companies = Company.objects.filter(pk__in=[self.company.pk, other.pk, empty.pk])
+
+        job = CycleEmailTemplateTriggerForm().send_emails(
+            self.cycle_template, companies
+        )
+        # The persons of a company are sent to in the same chunk
+        self.assertEqual(job.chunks, 2)
+        self.assertEqual(job.chunks_done, 2)
+        self.assertEqual(job.sent, 4)
+        self.assertEqual(job.status, SendJob.DONE)
+        self.assertEqual(len(mail.outbox), 4)
+        self.cycle_template.refresh_from_db()
+        self.assertEqual(self.cycle_template.status, self.cycle_template.SENT)
+
+    @override_settings(SEND_CHUNK_SIZE=1)
+    def test_cycle_email_trigger_failed_chunk(self):
+        self.prepare_email_testing()
+        other = factories.CompanyFactory(group=self.group)
+        factories.PersonCompanyFactory(person=self.persons[0], company=other)
+        companies = Company.objects.filter(pk__in=[self.company.pk, other.pk])
+
+        def fail_for_other(recipients, emailtemplate, renderer=None):
+            if (other.pk, self.persons[0].pk) in recipients:
+                raise RuntimeError("Relay down")
+            return make_messages(recipients, emailtemplate, renderer)
+
+        with mock.patch("notifications.forms.make_messages", fail_for_other):
+            job = CycleEmailTemplateTriggerForm().send_emails(
+                self.cycle_template, companies
+            )
+        self.assertEqual((job.chunks_done, job.chunks_failed), (1, 1))
+        self.assertEqual(job.status, SendJob.FAILED)
+        self.assertEqual(job.errors, ["Relay down"])
+        self.assertEqual(len(mail.outbox), 3)
+        # Not sent to everyone, so not marked as sent
+        self.cycle_template.refresh_from_db()
+        self.assertEqual(self.cycle_template.status, self.cycle_template.PROCESSING)
+
+        # Triggered again, only the failed chunk is sent
+        job = CycleEmailTemplateTriggerForm().send_emails(
+            self.cycle_template, companies
+        )
+        self.assertEqual(job.chunk_states, [SendJob.CHUNK_DONE] * 2)
+        self.assertEqual((job.retries, job.sent), (1, 4))
+        self.assertEqual(job.status, SendJob.DONE)
+        self.assertEqual(len(mail.outbox), 4)
+        self.cycle_template.refresh_from_db()
+        self.assertEqual(self.cycle_template.status, self.cycle_template.SENT)
+
+    def test_cycle_email_trigger_delivery_fails(self):
+        self.prepare_email_testing()
+        companies = Company.objects.filter(pk=self.company.pk)
+        failing = self.persons[1]
+
+        def fail_for_one(subject, message, from_email, recipient_list, **kwargs):
+            if recipient_list == [failing.email]:
+                raise ConnectionResetError("Connection reset")
+            return send_mail(subject, message, from_email, recipient_list, **kwargs)
+
+        with mock.patch("notifications.forms.send_mail", fail_for_one):
+            job = CycleEmailTemplateTriggerForm().send_emails(
+                self.cycle_template, companies
+            )
+        self.assertEqual(job.status, SendJob.FAILED)
+        self.assertEqual(job.errors, ["1 emails not sent"])
+        self.assertEqual(job.sent, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        # Only the emails sent are stored as notified
+        self.assertEqual(
+            set(CycleNotification.objects.values_list("person_id", flat=True)),
+            {self.persons[0].pk, self.persons[2].pk},
+        )
+
+        # Triggered again, only the email not sent is sent
+        job = CycleEmailTemplateTriggerForm().send_emails(
+            self.cycle_template, companies
+        )
+        self.assertEqual(job.status, SendJob.DONE)
+        self.assertEqual(job.sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[-1].to, [failing.email])
+        self.assertEqual(CycleNotification.objects.count(), 3)
+
+    def test_cycle_email_trigger_once(self):
+        self.prepare_email_testing()
+        companies = Company.objects.filter(pk=self.company.pk)
+        with override_settings(ASYNC_EMAILS=True), mock.patch(
+            "notifications.forms.async_task"
+        ) as async_task:
+            job = CycleEmailTemplateTriggerForm().send_emails(
+                self.cycle_template, companies
+            )
+            self.assertEqual(async_task.call_count, 1)
+            # A double post does not send again
+            self.assertEqual(
+                CycleEmailTemplateTriggerForm().send_emails(
+                    self.cycle_template, companies
+                ),
+                job,
+            )
+            self.assertEqual(async_task.call_count, 1)
+        self.assertEqual(job.status, SendJob.QUEUED)
+        self.assertEqual(
+            job.recipients,
+            [[[self.company.pk, person.pk] for person in self.persons]],
+        )
+
+        # The worker died: the job expires, and its chunk is sent when resumed
+        SendJob.objects.filter(pk=job.pk).update(
+            updated_at=timezone.now() - timedelta(days=1)
+        )
+        expire_send_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, SendJob.FAILED)
+        job = resume_send_job(job)
+        self.assertEqual(job.status, SendJob.DONE)
+        self.assertEqual(len(mail.outbox), 3)
+        # The task of the first attempt does nothing once resumed
+        run_send_chunk(job.pk, 0, job.recipients[0], attempt=0)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_send_heartbeat(self):
+        self.prepare_email_testing()
+        companies = Company.objects.filter(pk=self.company.pk)
+        with override_settings(ASYNC_EMAILS=True), mock.patch(
+            "notifications.forms.async_task"
+        ):
+            job = CycleEmailTemplateTriggerForm().send_emails(
+                self.cycle_template, companies
+            )
+        SendJob.objects.filter(pk=job.pk).update(
+            updated_at=timezone.now() - timedelta(days=1)
+        )
+        # A chunk still sending keeps the job from expiring
+        SendHeartbeat(job.pk, 1).beat()
+        expire_send_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, SendJob.QUEUED)
+
+    @override_settings(SEND_BATCH_SIZE=3)
+    def test_send_messages_in_batches(self):
+        self.prepare_email_testing()
+        other = factories.CompanyFactory(group=self.group)
+        factories.PersonCompanyFactory(person=self.persons[0], company=other)
+        stored = []
+
+        def record(sender, emails, *args):
+            stored.append(CycleNotification.objects.count())
+            # Promoted by a sync during the send
+            factories.PersonCompanyFactory(
+                person=factories.PersonFactory(), company=other
+            )
+            return deliver_each(sender, emails, *args)
+
+        companies = Company.objects.filter(group=self.group)
+        recipients = get_recipients(companies)
+        with mock.patch("notifications.forms.deliver_each", record):
+            sent = send_messages("from@test.com", recipients, self.cycle_template)
+        # Each batch is sent and stored before the next one is rendered, to
+        # the recipients read when the send started
+        self.assertEqual(sent, (4, 0))
+        self.assertEqual(stored, [0, 3])
+        self.assertEqual(len(mail.outbox), 4)
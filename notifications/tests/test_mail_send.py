@@ -0,0 +1,140 @@
+import smtplib
+from unittest import mock
+
+from datetime import timedelta
+
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+
+from notifications.forms import deliver_emails, get_throttle
+from notifications.mail_send import ConnectionPool, send_mail
+from notifications.models import SendBucket
+from notifications.tests.base import factories
+from notifications.tests.base.base import BaseTest
+
+
+class FlakyBackend(EmailBackend):
+    """Loses the server once, on the first message sent after ``drop``."""
+
+    opened = []
+    drop = False
+
+    def open(self):
+        self.opened.append(self)
+        return True
+
+    def send_messages(self, messages):
+        if FlakyBackend.drop:
+            FlakyBackend.drop = False
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return super(FlakyBackend, self).send_messages(messages)
+
+
+class ConnectionPoolTest(BaseTest):
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        FlakyBackend.opened = []
+        FlakyBackend.drop = False
+        self.pool = ConnectionPool(
+            max_messages=2, backend="notifications.tests.test_mail_send.FlakyBackend"
+        )
+
+    def message(self, subject):
+        return EmailMessage(subject, "Body", "from@test.com", ["to@test.com"])
+
+    def test_reuses_connections(self):
+        for subject in ("1", "2", "3"):
+            self.assertEqual(self.pool.send(self.message(subject)), 1)
+        # Replaced after two messages
+        self.assertEqual(len(FlakyBackend.opened), 2)
+        self.assertEqual([m.subject for m in mail.outbox], ["1", "2", "3"])
+
+    def test_reconnects(self):
+        self.pool.send(self.message("1"))
+        FlakyBackend.drop = True
+        self.assertEqual(self.pool.send(self.message("2")), 1)
+        self.assertEqual(len(FlakyBackend.opened), 2)
+        self.assertEqual([m.subject for m in mail.outbox], ["1", "2"])
+
+    def test_fail_silently(self):
+        def refuse(self, messages):
+            raise smtplib.SMTPRecipientsRefused({})
+
+        with mock.patch.object(FlakyBackend, "send_messages", refuse):
+            self.assertEqual(self.pool.send(self.message("1"), fail_silently=True), 0)
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                self.pool.send(self.message("2"))
+        # Not a connection problem, so no reconnection
+        self.assertEqual(len(FlakyBackend.opened), 2)
+
+    def test_send_mail(self):
+        send_mail("Subject", "Body", "from@test.com", ["to@test.com"])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_deliver_emails_counts_sent(self):
+        send_messages = EmailBackend.send_messages
+
+        def refuse_some(backend, messages):
+            if messages[0].to == ["refused@test.com"]:
+                raise smtplib.SMTPRecipientsRefused({})
+            return send_messages(backend, messages)
+
+        emails = [
+            ("Subject", [to], "Body", {})
+            for to in ("a@test.com", "refused@test.com", "b@test.com")
+        ]
+        with mock.patch.object(EmailBackend, "send_messages", refuse_some):
+            self.assertEqual(deliver_emails("from@test.com", emails, None), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class ThrottleTest(BaseTest):
+    def setUp(self):
+        super(ThrottleTest, self).setUp()
+        self.group = factories.CompaniesGroupFactory(send_rate=2)
+
+    def rewind(self, seconds):
+        """Pretend ``seconds`` passed since the bucket was last used."""
+        bucket = SendBucket.objects.get(group=self.group)
+        bucket.updated_at -= timedelta(seconds=seconds)
+        bucket.save()
+
+    def test_take(self):
+        # Starts full, with a second worth of tokens
+        self.assertEqual(SendBucket.take(self.group, 2, 5), (2, 0))
+        taken, delay = SendBucket.take(self.group, 2, 5)
+        self.assertEqual(taken, 0)
+        self.assertAlmostEqual(delay, 0.5, places=2)
+        self.rewind(0.5)
+        self.assertEqual(SendBucket.take(self.group, 2, 5), (1, 0))
+        self.rewind(60)
+        self.assertEqual(SendBucket.take(self.group, 2, 5), (2, 0))
+
+    def test_deliver_emails(self):
+        emails = [("Subject", [str(i)], "Body", {}) for i in range(5)]
+        with mock.patch("notifications.mail_send.time.sleep") as sleep:
+            sleep.side_effect = self.rewind
+            self.assertEqual(
+                deliver_emails("from@test.com", emails, None, self.group), 5
+            )
+        # The first two right away, then one every half second
+        self.assertEqual(sleep.call_count, 3)
+        self.assertEqual([m.to for m in mail.outbox], [e[1] for e in emails])
+
+    def test_no_limit(self):
+        self.group.send_rate = 0
+        emails = [("Subject", ["to@test.com"], "Body", {})] * 3
+        deliver_emails("from@test.com", emails, None, self.group)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(SendBucket.objects.exists())
+
+    def test_throttle_kept_across_batches(self):
+        emails = [("Subject", ["to@test.com"], "Body", {})]
+        throttle = get_throttle(self.group)
+        with mock.patch.object(SendBucket, "take", wraps=SendBucket.take) as take:
+            for batch in range(2):
+                deliver_emails("from@test.com", emails, None, self.group, throttle)
+        # Both tokens were taken at once, by the first batch
+        self.assertEqual(take.call_count, 1)
+        self.assertEqual(len(mail.outbox), 2)
@@ -0,0 +1,191 @@
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+import requests
+from django.test import SimpleTestCase, override_settings
+
+from notifications.registries import (
+    BaseRegistry,
+    BDRRegistry,
+    EuropeanCacheRegistry,
+    RegistryError,
+    iter_json_array,
+)
+
+
+class IterJsonArrayTest(SimpleTestCase):
+    DATA = [
+        {"name": "Société {}".format(i), "users": [{"id": i}], "vat": None}
+        for i in range(20)
+    ] + [12345, "text", [], {}]
+
+    def split(self, raw, size):
+        return [raw[i : i + size] for i in range(0, len(raw), size)]
+
+    def test_chunk_boundaries(self):
+        raw = json.dumps(self.DATA, ensure_ascii=False).encode("utf-8")
+        for size in (1, 3, 64, len(raw)):
+            self.assertEqual(list(iter_json_array(self.split(raw, size))), self.DATA)
+
+    def test_number_split_across_chunks(self):
+        self.assertEqual(list(iter_json_array([b"[1", b"23, 4", b"]"])), [123, 4])
+
+    def test_numbers_split_in_small_chunks(self):
+        data = [0.1, -2.5e-3, 1e5, 1e-10, 12345, -7, 3.0, {"a": [1.5, 2]}, 0]
+        for raw in (json.dumps(data).encode(), b"[ 0.1 ,\n 1E5 , -12 ]"):
+            for size in (1, 2, 3):
+                self.assertEqual(
+                    list(iter_json_array(self.split(raw, size))), json.loads(raw)
+                )
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array([b" [ ", b"] "])), [])
+
+    def test_invalid(self):
+        for raw in (b"", b"{}", b"[1,", b"[1 2]"):
+            with self.assertRaises(ValueError):
+                list(iter_json_array([raw]))
+
+
+class BaseRegistryTest(SimpleTestCase):
+    def test_session_is_reused(self):
+        registry = BaseRegistry("Test", "http://registry.test")
+        response = mock.Mock(status_code=200, raw=mock.Mock(retries=None))
+        response.iter_content.return_value = [b'[{"id": 1}, ', b'{"id": 2}]']
+        with mock.patch.object(registry.session, "get", return_value=response) as get:
+            self.assertEqual(list(registry.iter_objects("/a")), [{"id": 1}, {"id": 2}])
+            registry.do_request("/b")
+        self.assertEqual(get.call_count, 2)
+        self.assertTrue(get.call_args.kwargs["timeout"][0] > 0)
+        self.assertEqual(registry.get_metrics()["requests"], 2)
+        self.assertEqual(registry.get_metrics()["errors"], 0)
+        self.assertEqual(registry.get_metrics()["bytes"], 22)
+        self.assertEqual(registry.items, 2)
+
+    def test_broken_stream_is_recorded(self):
+        registry = BaseRegistry("Test", "http://registry.test")
+
+        def chunks(chunk_size):
+            yield b'[{"id": 1}, '
+            raise requests.exceptions.ChunkedEncodingError("Connection reset")
+
+        for body in (chunks, lambda chunk_size: [b'[{"id": 1}, {"id"']):
+            response = mock.Mock(status_code=200, raw=mock.Mock(retries=None))
+            response.iter_content.side_effect = body
+            with mock.patch.object(registry.session, "get", return_value=response):
+                self.assertEqual(list(registry.iter_objects("/a")), [{"id": 1}])
+            self.assertIn("/a", registry.errors)
+            registry.errors.clear()
+
+    def test_connection_error_is_recorded(self):
+        registry = BaseRegistry("Test", "http://registry.test")
+        error = requests.ConnectionError("refused")
+        with mock.patch.object(registry.session, "get", side_effect=error):
+            self.assertIsNone(registry.do_request("/a"))
+        self.assertEqual(registry.metrics[0]["error"], "refused")
+        self.assertEqual(registry.get_metrics()["errors"], 1)
+
+
+@override_settings(
+    ECR_DOMAINS=["FGAS", "ODS", "BROKEN"],
+    ECR_COMPANY_PATH="/[domain]/list",
+    ECR_FETCH_WORKERS=2,
+    ECR_FETCH_QUEUE_SIZE=1,
+)
+class EuropeanCacheRegistryTest(SimpleTestCase):
+    def get_response(self, path, stream=False, headers=None):
+        if path == "/BROKEN/list":
+            return mock.Mock(status_code=503, __bool__=lambda self: False)
+        response = mock.Mock(status_code=200, headers={})
+        domain = path.split("/")[1]
+        response.iter_content.return_value = [
+            json.dumps([{"domain": domain, "id": i} for i in range(5)]).encode()
+        ]
+        return response
+
+    def test_domains_fetched_concurrently(self):
+        registry = EuropeanCacheRegistry()
+        with mock.patch.object(registry, "do_request", side_effect=self.get_response):
+            companies = list(registry.get_companies())
+        self.assertEqual(len(companies), 10)
+        self.assertEqual({company["domain"] for company in companies}, {"FGAS", "ODS"})
+        self.assertEqual(registry.errors, {"BROKEN": "status 503"})
+
+    def test_consumer_stops_early(self):
+        registry = EuropeanCacheRegistry()
+        with mock.patch.object(registry, "do_request", side_effect=self.get_response):
+            companies = registry.get_companies()
+            next(companies)
+            companies.close()
+
+    def test_refresh_company_exports(self):
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+        registry = EuropeanCacheRegistry()
+        registry.snapshot_dir = snapshot_dir
+        with mock.patch.object(
+            registry, "do_request", side_effect=self.get_response
+        ) as do_request:
+            registry.refresh(registry.get_company_paths())
+        self.assertEqual(
+            sorted(call.args[0] for call in do_request.call_args_list),
+            ["/BROKEN/list", "/FGAS/list", "/ODS/list"],
+        )
+
+
+class SnapshotTest(SimpleTestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        settings = self.settings(
+            REGISTRY_SNAPSHOT_DIR=self.snapshot_dir,
+            BDR_COMPANIES_PATH="/companies",
+            BDR_PERSONS_PATH="/persons",
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.requests = []
+
+    def get_response(self, path, headers=None, stream=False):
+        self.requests.append((path, headers))
+        if headers.get("If-None-Match") == '"v1"':
+            return mock.Mock(status_code=304, headers={})
+        response = mock.Mock(status_code=200, headers={"ETag": '"v1"'})
+        response.iter_content.return_value = [b'[{"path": "', path.encode(), b'"}]']
+        return response
+
+    def get_registry(self, **kwargs):
+        registry = BDRRegistry(**kwargs)
+        patch = mock.patch.object(registry, "do_request", side_effect=self.get_response)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return registry
+
+    def test_conditional_requests(self):
+        registry = self.get_registry()
+        self.assertTrue(registry.refresh())
+        self.assertEqual(list(registry.get_companies()), [{"path": "/companies"}])
+        self.assertEqual(len(self.requests), 2)
+
+        registry = self.get_registry()
+        self.assertFalse(registry.refresh())
+        self.assertEqual(self.requests[-1], ("/persons", {"If-None-Match": '"v1"'}))
+        # The unchanged export is read from the snapshot
+        self.assertEqual(list(registry.get_persons()), [{"path": "/persons"}])
+        self.assertEqual(len(self.requests), 4)
+
+    def test_offline_replay(self):
+        self.get_registry().refresh()
+        registry = self.get_registry(offline=True)
+        self.assertTrue(registry.refresh())
+        self.assertEqual(list(registry.get_persons()), [{"path": "/persons"}])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_missing_snapshot(self):
+        registry = self.get_registry(offline=True)
+        with self.assertRaises(RegistryError):
+            list(registry.iter_export("/persons"))
+        self.assertEqual(list(registry.get_persons()), [])
+        self.assertIn("/persons", registry.errors)
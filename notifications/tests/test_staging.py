@@ -0,0 +1,147 @@
+import copy
+import json
+from collections import defaultdict
+from unittest import skipIf, skipUnless
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+
+from notifications import models
+from notifications.management.commands import fetch_bdr, fetch_ecr
+from notifications.staging import BDRStagingSync, ECRStagingSync, copy_lines
+from notifications.tests.base.base import BaseTest
+from notifications.tests.base.registry_mock import (
+    BDRRegistryMock,
+    EuropeanCacheRegistryMock,
+)
+from notifications.toolz import fingerprint
+
+
+def recording(staging_class):
+    """A staging sync keeping the copied rows instead of sending them."""
+
+    class RecordingStagingSync(staging_class):
+        def __init__(self, command):
+            super(RecordingStagingSync, self).__init__(command)
+            self.copied = defaultdict(list)
+
+        def copy(self, table, rows):
+            self.copied[table] += rows
+
+    return RecordingStagingSync
+
+
+class AmbiguousRegistryMock(EuropeanCacheRegistryMock):
+    def get_companies(self):
+        for item in super(AmbiguousRegistryMock, self).get_companies():
+            represented = copy.deepcopy(item)
+            represented["company_id"] += 1
+            represented["address"]["country"]["type"] = "AMBIGUOUS_TYPE"
+            represented["representative"] = {
+                "name": "Representative",
+                "vatnumber": "RO1",
+                "address": {"country": {"name": "Romania"}},
+            }
+            represented["check_passed"] = False
+            yield item
+            yield represented
+
+
+class StagingTest(BaseTest):
+    fixtures = [
+        "companiesgroups.json",
+    ]
+
+    def test_copy_lines(self):
+        self.assertEqual(
+            copy_lines([(1, None, True, "a\tb\\c\nd")]),
+            "1\t\\N\tt\ta\\tb\\\\c\\nd\n",
+        )
+
+    def test_ecr_rows(self):
+        command = fetch_ecr.Command()
+        command.load_sync_state()
+        staging = recording(ECRStagingSync)(command)
+        staging.stage(AmbiguousRegistryMock())
+
+        companies = staging.copied["staging_company"]
+        self.assertEqual(len(companies), 4)
+        noneu = models.CompaniesGroup.objects.get(code="f-gases-noneu")
+        eu = models.CompaniesGroup.objects.get(code="f-gases-eu")
+        self.assertEqual(
+            [row[2] for row in companies], [noneu.pk, noneu.pk, eu.pk, noneu.pk]
+        )
+        # Rejected companies are staged, to be updated, but not linked
+        self.assertEqual([row[-1] for row in companies], [True, False, True, False])
+        self.assertEqual({row[0] for row in staging.copied["staging_link"]}, {0, 2})
+        # Same fingerprints as the row by row sync
+        item = next(AmbiguousRegistryMock().get_companies())
+        self.assertEqual(
+            companies[0][11], fingerprint(command.parse_company_data(item))
+        )
+        self.assertEqual(staging.person_count, 3)
+        self.assertEqual(
+            staging.copied["staging_person"][0][5:], ("test1_user", "test1@email.com")
+        )
+
+    def test_bdr_rows(self):
+        command = fetch_bdr.Command()
+        staging = recording(BDRStagingSync)(command)
+        staging.stage(BDRRegistryMock())
+        companies = staging.copied["staging_company"]
+        self.assertTrue(companies)
+        self.assertTrue(all(row[2] and row[-1] for row in companies))
+        self.assertEqual(len(staging.copied["staging_link"]), staging.person_count)
+
+    @skipIf(connection.vendor == "postgresql", "Staging is supported")
+    def test_requires_postgresql(self):
+        with self.assertRaises(CommandError):
+            call_command("fetch_ecr", "--test", "--staging")
+        with self.assertRaises(CommandError):
+            call_command("fetch_bdr", "--test", "--staging")
+
+    @skipUnless(connection.vendor == "postgresql", "Staging needs PostgreSQL")
+    def test_ecr_staged(self):
+        job = models.FetchJob.objects.create(commands=["fetch_ecr"])
+        record = json.loads(
+            call_command("fetch_ecr", "--test", "--staging", "--job", str(job.pk))
+        )
+        self.assertEqual(record["counts"]["companies_created"], 2)
+        self.assertEqual(record["counts"]["persons_created"], 3)
+        self.assertEqual(
+            set(
+                models.PersonCompany.objects.values_list(
+                    "company__external_id", "person__username"
+                )
+            ),
+            {("1234", "test1_user"), ("1234", "test2_user"), ("3245", "test3_user")},
+        )
+        # Reported once the staging transaction is committed
+        job.refresh_from_db()
+        self.assertEqual(job.progress["fetch_ecr"]["phase"], "links")
+
+        # Unchanged the second time
+        call_command("fetch_ecr", "--test", "--staging", "--force")
+        self.assertEqual(models.Company.objects.count(), 2)
+        self.assertEqual(models.PersonCompany.objects.filter(current=True).count(), 3)
+
+    @skipUnless(connection.vendor == "postgresql", "Staging needs PostgreSQL")
+    def test_bdr_staged(self):
+        call_command("fetch_bdr", "--test", "--staging")
+        staged = set(
+            models.PersonCompany.objects.values_list(
+                "company__external_id", "person__username", "current"
+            )
+        )
+        self.assertTrue(staged)
+        # Same result as the row by row sync
+        call_command("fetch_bdr", "--test", "--force")
+        self.assertEqual(
+            set(
+                models.PersonCompany.objects.values_list(
+                    "company__external_id", "person__username", "current"
+                )
+            ),
+            staged,
+        )
@@ -0,0 +1,150 @@
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+
+from notifications import models
+from notifications.sync import PersonIndex
+from notifications.tests.base import factories
+from notifications.tests.base.base import BaseTest
+from notifications.tests.base.registry_mock import EuropeanCacheRegistryMock
+
+
+class PersonIndexTest(BaseTest):
+    def test_match(self):
+        first = factories.PersonFactory(username="first", email="Shared@Mail.com")
+        second = factories.PersonFactory(username="shared@mail.com", email="other")
+        index = PersonIndex.load()
+        self.assertEqual(index.match("shared@mail.com ", "none"), [first, second])
+        self.assertEqual(index.match("none", "OTHER"), [second])
+        self.assertEqual(index.match("none", "none"), [])
+
+        index.set_email(second, "second@mail.com")
+        self.assertEqual(index.find(["other", "second@mail.com"]), [second])
+
+    def test_unsaved_persons(self):
+        index = PersonIndex()
+        person = models.Person(username="new", email="new@mail.com")
+        index.add(person)
+        self.assertEqual(index.match("new@mail.com", "new@mail.com"), [person])
+        self.assertEqual(index.find(["new"]), [])
+
+
+class FetchPersonMatchingTest(BaseTest):
+    fixtures = [
+        "companiesgroups.json",
+    ]
+
+    def test_ambiguous_persons_are_reported(self):
+        existing = factories.PersonFactory(username="TEST1_user", email="old@mail.com")
+        factories.PersonFactory(username="someone", email="test1@email.com")
+        msg = call_command("fetch_ecr", "--test")
+        self.assertIn("1 ambiguous", msg)
+        existing.refresh_from_db()
+        self.assertEqual(existing.email, "test1@email.com")
+        self.assertEqual(models.Person.objects.count(), 4)
+
+
+class LinkReconciliationTest(BaseTest):
+    fixtures = [
+        "companiesgroups.json",
+    ]
+
+    def test_refetch_keeps_links(self):
+        call_command("fetch_ecr", "--test")
+        pks = set(models.PersonCompany.objects.values_list("pk", flat=True))
+        msg = call_command("fetch_ecr", "--test", "--force")
+        self.assertIn("links: 0 added, 0 activated, 0 deactivated", msg)
+        self.assertEqual(
+            set(models.PersonCompany.objects.values_list("pk", flat=True)), pks
+        )
+
+    def test_stale_links(self):
+        call_command("fetch_ecr", "--test")
+        company = models.Company.objects.first()
+        stale = models.PersonCompany.objects.create(
+            person=factories.PersonFactory(), company=company, current=True
+        )
+        link = models.PersonCompany.objects.exclude(pk=stale.pk).first()
+        models.PersonCompany.objects.filter(pk=link.pk).update(current=False)
+
+        msg = call_command("fetch_ecr", "--test", "--force")
+        self.assertIn("links: 0 added, 1 activated, 1 deactivated", msg)
+        stale.refresh_from_db()
+        self.assertFalse(stale.current)
+        self.assertTrue(models.PersonCompany.objects.get(pk=link.pk).current)
+
+    def test_failed_export_keeps_links(self):
+        call_command("fetch_ecr", "--test")
+        company = models.Company.objects.first()
+        missed = factories.CompanyFactory(group=company.group)
+        stale = models.PersonCompany.objects.create(
+            person=factories.PersonFactory(), company=company, current=True
+        )
+        kept = models.PersonCompany.objects.create(
+            person=factories.PersonFactory(), company=missed, current=True
+        )
+
+        errors = {"ODS": "status 503"}
+        with mock.patch.object(EuropeanCacheRegistryMock, "errors", errors):
+            msg = call_command("fetch_ecr", "--test", "--force")
+        self.assertIn("links: 0 added, 0 activated, 1 deactivated", msg)
+        # Only the links of the companies read are reconciled
+        stale.refresh_from_db()
+        self.assertFalse(stale.current)
+        kept.refresh_from_db()
+        self.assertTrue(kept.current)
+
+    def test_duplicate_links(self):
+        call_command("fetch_ecr", "--test")
+        link = models.PersonCompany.objects.first()
+        models.PersonCompany.objects.filter(pk=link.pk).update(current=False)
+        try:
+            with transaction.atomic():
+                duplicate = models.PersonCompany.objects.create(
+                    person=link.person, company=link.company, current=True
+                )
+        except IntegrityError:
+            self.skipTest("The database does not allow duplicate links")
+
+        msg = call_command("fetch_ecr", "--test", "--force")
+        self.assertIn("links: 0 added, 1 activated, 0 deactivated", msg)
+        self.assertIn("1 duplicates removed", msg)
+        self.assertTrue(models.PersonCompany.objects.get(pk=link.pk).current)
+        self.assertFalse(
+            models.PersonCompany.objects.really_all().filter(pk=duplicate.pk).exists()
+        )
+
+    def test_links_promoted_at_the_end(self):
+        from notifications.management.commands.fetch_ecr import Command
+
+        call_command("fetch_ecr", "--test")
+        company = models.Company.objects.first()
+        models.PersonCompany.objects.filter(company=company).update(current=False)
+        before = set(models.PersonCompany.objects.values_list("pk", flat=True))
+        seen = []
+        fetch_companies = Command.fetch_companies
+
+        def read_recipients(command, registry):
+            seen.append(set(models.PersonCompany.objects.values_list("pk", flat=True)))
+            return fetch_companies(command, registry)
+
+        with mock.patch.object(Command, "fetch_companies", read_recipients):
+            call_command("fetch_ecr", "--test", "--force")
+        # Readers see the previous links until the sync promotes the new ones
+        self.assertEqual(seen, [before])
+        self.assertEqual(len(company.active_users), 2)
+
+    def test_bdr_links_only_bdr_companies(self):
+        ecr_company = factories.CompanyFactory(
+            name="BDR company 1",
+            country="China",
+            group=models.CompaniesGroup.objects.get(code="ods"),
+            check_passed=True,
+        )
+        call_command("fetch_bdr", "--test")
+        msg = call_command("fetch_bdr", "--test")
+        self.assertIn("links: 0 added", msg)
+        self.assertFalse(
+            models.PersonCompany.objects.really_all().filter(company=ecr_company)
+        )
@@ -1,7 +1,54 @@
+import datetime
+import hashlib
+import json
 import re
 
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
 
 def extract_parameters(value):
     param = "\{(\w+)\}"
     params_re = re.compile(param, re.VERBOSE | re.MULTILINE)
     return list(set(params_re.findall(value)))
+
+
+def chunked(iterable, size):
+    """Yield lists of at most ``size`` items from ``iterable``."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_registry_date(value):
+    """Parse a date or datetime string sent by a registry into an aware
+    datetime, or None if it cannot be parsed.
+    """
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            parsed = datetime.datetime.combine(day, datetime.time.min)
+    except (TypeError, ValueError):
+        return None
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return parsed
+
+
+def fingerprint(data):
+    """Hash of the registry-derived fields of a record, used to detect
+    whether the record changed since it was last written.
+    """
+    values = {key: getattr(value, "pk", value) for key, value in data.items()}
+    serialized = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
@@ -47,6 +47,7 @@ urlpatterns = [
     ),
     path("", views.DashboardView.as_view(), name="dashboard"),
     path("fetch/", views.FetchView.as_view(), name="fetch"),
+    path("fetch/<int:pk>/", views.FetchStatusView.as_view(), name="fetch_status"),
     path("companies/", views.CompaniesView.as_view(), name="companies"),
     path("persons/", views.PersonsView.as_view(), name="persons"),
     path("crashme/", views.Crashme.as_view(), name="crashme"),
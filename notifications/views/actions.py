@@ -17,7 +17,8 @@ from notifications import (
     ODS_GROUP_CODE,
     FGASES_NONEU,
 )
-from notifications.models import Company, Person, CompaniesGroup
+from notifications.groups import get_group
+from notifications.models import Company, Person
 from notifications.registries import EuropeanCacheRegistry, BDRRegistry
 from notifications.views.breadcrumb import NotificationsBaseView, Breadcrumb
 from notifications.tests.base.registry_mock import (
@@ -108,9 +109,9 @@ class ActionsECRView(ActionsBaseView):
             self.create_person(**person_data)
             counter_persons += 1
 
-        group_eu = CompaniesGroup.objects.get(code=FGASES_EU_GROUP_CODE)
-        group_noneu = CompaniesGroup.objects.get(code=FGASES_NONEU_GROUP_CODE)
-        group_ods = CompaniesGroup.objects.get(code=ODS_GROUP_CODE)
+        group_eu = get_group(FGASES_EU_GROUP_CODE)
+        group_noneu = get_group(FGASES_NONEU_GROUP_CODE)
+        group_ods = get_group(ODS_GROUP_CODE)
 
         # fetch companies
         counter_companies = 0
@@ -177,7 +178,7 @@ class ActionsBDRView(ActionsBaseView):
 
         # TODO This view has not usage, so it will be deleted in the future.
         # For now, use cars group.
-        group = CompaniesGroup.objects.get(code="cars")
+        group = get_group("cars")
 
         # fetch companies
         company_count = 0
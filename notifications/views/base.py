@@ -3,7 +3,8 @@ from django.urls import reverse
 from django.views import generic
 
 from notifications import BDR_GROUP_CODES, ECR_GROUP_CODES
-from notifications.models import Cycle, CompaniesGroup, Person, Company
+from notifications.groups import get_groups
+from notifications.models import Cycle, Person, Company
 from notifications.views.breadcrumb import NotificationsBaseView, Breadcrumb
 
 
@@ -49,7 +50,7 @@ class CompaniesView(NotificationsBaseView, PaginatedDataViewBase, generic.Templa
         return breadcrumbs
 
     def get_groups(self):
-        return CompaniesGroup.objects.values("pk", "code", "title")
+        return list(get_groups().values())
 
     def get_companies_by_group(self, group):
         return Company.objects.filter(group__code=group).distinct().order_by("name")
@@ -17,9 +17,9 @@ from notifications.forms import (
     CycleEmailTemplateEditForm,
     CycleEmailTemplateTestForm,
     CycleEmailTemplateTriggerForm,
-    set_values_for_parameters,
 )
 from notifications.models import Cycle
+from notifications.rendering import TemplateRenderer
 
 from notifications.models import (
     CycleEmailTemplate,
@@ -420,13 +420,9 @@ class CycleEmailTemplateTest(CycleEmailTemplateBase, generic.FormView):
         context["company"] = company
         context["person"] = person
 
-        # TODO Create a function that takes param values, body_html and
-        # returns the formatted text
-        params = set_values_for_parameters(template, person, company)
-        body = template.body_html
-        template.body_html = body.format(**params)
-        subject = template.subject
-        template.subject = subject.format(**params)
+        renderer = TemplateRenderer(template)
+        params = renderer.params(person, company)
+        template.subject, template.body_html = renderer.render(person, company)
         context["params"] = params
         context["template"] = template
 
@@ -1,22 +1,36 @@
 import json
 
 from django.conf import settings
-from django.core.management import call_command
 from django.http import HttpResponseForbidden, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.views import View
 
+from notifications.models import FetchJob
+from notifications.sync import start_fetch_job
 
-class FetchView(View):
-    def get(self, request, *args, **kwargs):
+
+class FetchTokenMixin(object):
+    def dispatch(self, request, *args, **kwargs):
         # Check for authorization token in request headers
         auth_token = request.headers.get("Authorization")
         if auth_token != "Bearer {}".format(settings.NOTIFICATIONS_TOKEN):
             return HttpResponseForbidden("Authorization token is missing")
+        return super(FetchTokenMixin, self).dispatch(request, *args, **kwargs)
 
-        bdr_result = call_command("fetch_bdr")
-        ecr_result = call_command("fetch_ecr")
-        data = {
-            "bdr": bdr_result,
-            "ecr": ecr_result,
-        }
+    def job_response(self, job):
+        data = job.as_dict()
+        data["status_url"] = reverse("notifications:fetch_status", args=[job.pk])
         return HttpResponse(json.dumps(data, indent=2), content_type="application/json")
+
+
+class FetchView(FetchTokenMixin, View):
+    """Start a sync of the registries, or return the one already running."""
+
+    def get(self, request, *args, **kwargs):
+        return self.job_response(start_fetch_job())
+
+
+class FetchStatusView(FetchTokenMixin, View):
+    def get(self, request, pk, *args, **kwargs):
+        return self.job_response(get_object_or_404(FetchJob, pk=pk))